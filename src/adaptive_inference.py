@@ -0,0 +1,205 @@
+import argparse
+import json
+from pathlib import Path
+
+import numpy as np
+import pescador
+from tqdm import tqdm
+
+import shared
+from data_loaders import overlap_patches, patch_batches
+from ensemble import Ensemble, is_frozen
+
+TOLERANCES = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05]
+MIN_PATCHES = 2
+TEST_BATCH_SIZE = 64
+
+
+def spread_order(n):
+    # the patch indices in van der Corput order: the middle of the track first, then the middles
+    # of the halves, and so on, so that the first patches of the order cover the whole track
+    bits = max(1, int(np.ceil(np.log2(n))))
+    k = np.arange(1, 2 ** bits + 1) % 2 ** bits  # the first patch last
+    reversed_k = np.zeros_like(k)
+    for b in range(bits):
+        reversed_k |= ((k >> b) & 1) << (bits - 1 - b)
+    positions = reversed_k * n // 2 ** bits
+    _, first = np.unique(positions, return_index=True)
+    return positions[np.sort(first)]
+
+
+def has_converged(change, count, tolerance, min_patches=MIN_PATCHES):
+    # the last patch changed the running mean of every class by at most `tolerance`
+    return count >= min_patches and change <= tolerance
+
+
+def exit_point(pred, tolerance, min_patches=MIN_PATCHES):
+    # the number of patches used for the predictions `pred` of a track, in evaluation order
+    means = np.cumsum(pred, axis=0, dtype='float64') / np.arange(1, len(pred) + 1)[:, None]
+    changes = np.abs(np.diff(means, axis=0)).max(axis=1, initial=0)
+    for count, change in enumerate(changes, start=2):
+        if has_converged(change, count, tolerance, min_patches):
+            return count
+    return len(pred)
+
+
+class AdaptiveAverager:
+    # Predicts every track with the running mean of the predictions of its patches, taken in
+    # `spread_order`, and stops once a patch changes the mean by at most `tolerance`. Up to
+    # `batch_size` tracks are predicted at the same time: every batch has the next patch of each
+    # of them (`min_patches` for the new ones), and finished tracks are replaced from the stream
+    def __init__(self, models, window, hop, tolerance, min_patches=MIN_PATCHES, batch_size=TEST_BATCH_SIZE):
+        self.models = models
+        self.window, self.hop = window, hop
+        self.tolerance = tolerance
+        self.min_patches = max(2, min_patches)
+        self.batch_size = batch_size
+
+    def predict(self, tracks):
+        # yields the id, mean prediction, patches used and patches of every track of `tracks`
+        # (one-track batches of `whole_track` sampling)
+        tracks = iter(tracks)
+        active = []
+        while True:
+            while len(active) < self.batch_size:
+                track = next(tracks, None)
+                if track is None:
+                    break
+                patches = overlap_patches(track['X'][0], self.window, self.hop)
+                active.append({'id': track['ID'][0], 'patches': patches[spread_order(len(patches))],
+                               'count': 0, 'sum': 0})
+            if not active:
+                return
+
+            steps = [min(self.min_patches if t['count'] == 0 else 1, len(t['patches']) - t['count']) for t in active]
+            X = np.concatenate([t['patches'][t['count']: t['count'] + step] for t, step in zip(active, steps)])
+            pred = np.vstack([self.models.predict(X[i:i + self.batch_size]) for i in range(0, len(X), self.batch_size)])
+            ends = np.cumsum(steps)
+
+            still_active = []
+            for t, step, end in zip(active, steps, ends):
+                t['sum'] = t['sum'] + pred[end - step: end].astype('float64').sum(axis=0)
+                t['count'] += step
+                mean = t['sum'] / t['count']
+                change = 0
+                if t['count'] > 1:
+                    change = np.abs(mean - (t['sum'] - pred[end - 1]) / (t['count'] - 1)).max()
+                if t['count'] == len(t['patches']) or has_converged(change, t['count'], self.tolerance,
+                                                                    self.min_patches):
+                    yield t['id'], mean, t['count'], len(t['patches'])
+                else:
+                    still_active.append(t)
+            active = still_active
+
+
+def check_pooling(config):
+    # the exit criterion is the convergence of the mean: other poolings are not supported
+    pooling = config.get('prediction_pooling', 'mean')
+    if pooling != 'mean':
+        raise ValueError('The adaptive inference averages the patch predictions, set `prediction_pooling` '
+                         'to "mean" instead of "{}".'.format(pooling))
+
+
+def adaptive_prediction(batch_streamer, models, config, tolerance):
+    # track predictions and ids, as `evaluate.py` and `predict.py` average them
+    check_pooling(config)
+    averager = AdaptiveAverager(models, config['xInput'], config.get('inference_hop') or config['xInput'],
+                                tolerance, min_patches=config.get('adaptive_inference_min_patches', MIN_PATCHES),
+                                batch_size=config.get('test_batch_size', TEST_BATCH_SIZE))
+    results = list(tqdm(averager.predict(batch_streamer)))
+    if not results:
+        print('Adaptive inference: no tracks to predict')
+        return np.zeros([0, config['num_classes_dataset']]), np.array([]), dict()
+
+    ids, preds, used, total = zip(*results)
+    print('Adaptive inference: {} of {} patches ({:.1f}%), {:.1f} patches per track'.format(
+        sum(used), sum(total), 100 * sum(used) / sum(total), np.mean(used)))
+    return np.array(preds), np.array(ids), dict(zip(ids, used))
+
+
+def tradeoff(pred_array, id_array, ids, id2gt, tolerances, min_patches=MIN_PATCHES):
+    # the patches used and the scores of every tolerance, computed from the predictions of all the
+    # patches: the averager would stop at the same patch
+    order = np.argsort(id_array, kind='stable')
+    unique_ids, starts = np.unique(id_array[order], return_index=True)
+    groups = dict(zip(unique_ids, np.split(pred_array[order], starts[1:])))
+    ids = [id for id in ids if id in groups]
+    y_true = [id2gt[id] for id in ids]
+
+    results = []
+    for tolerance in tolerances:
+        y_pred, used = [], 0
+        for id in ids:
+            pred = groups[id][spread_order(len(groups[id]))]
+            n = exit_point(pred, tolerance, min_patches) if tolerance is not None else len(pred)
+            y_pred.append(pred[:n].mean(axis=0))
+            used += n
+        roc_auc, pr_auc = shared.compute_auc(y_true, y_pred)
+        results.append((tolerance, used / len(pred_array), used / len(ids), roc_auc, pr_auc))
+    return results
+
+
+if __name__ == '__main__':
+    # Reports the speed versus ROC-AUC trade-off of the adaptive inference
+    # (`adaptive_inference_tolerance` of `evaluate.py` and `predict.py`) on the validation set:
+    # the fraction of the patches predicted and the scores for several tolerances.
+    # Example: python adaptive_inference.py ../configs/config_0.json -l 1563524626spec
+    parser = argparse.ArgumentParser()
+    parser.add_argument('config_file', help='configuration file')
+    parser.add_argument('-l', '--list', nargs='+', required=True,
+                        help='List of models (experiment ids or frozen .pb graphs) to evaluate as an ensemble')
+    parser.add_argument('-t', '--tolerances', type=float, nargs='+', default=TOLERANCES,
+                        help='maximum change of the mean predictions by the last patch')
+    parser.add_argument('--min_patches', type=int, default=MIN_PATCHES, help='patches predicted at least')
+
+    args = parser.parse_args()
+
+    with open(args.config_file, 'r') as f:
+        full_config = json.load(f)
+    config = full_config['config_train']
+    exp_dir = Path(full_config['exp_dir'])
+    check_pooling(config)
+
+    # set patch parameters
+    config['xInput'] = config['feature_params']['xInput']
+    if 'audio_representation_dirs' in config:
+        config['yInput'] = sum([i['yInput'] for i in config['features_params']])
+        from data_loaders import data_gen_feature_combination as data_gen
+    else:
+        config['yInput'] = config['feature_params']['yInput']
+        from data_loaders import data_gen_standard as data_gen
+
+    [_, id2audio_repr_path] = shared.load_id2path(Path(full_config['data_dir'], 'index_repr.tsv'))
+    ids, id2gt = shared.load_id2gt(config['gt_val'])
+    ids = [id for id in ids if id in id2audio_repr_path]
+
+    # all the patches of the validation tracks, predicted once
+    hop = config.get('inference_hop') or config['xInput']
+    batch_size = config.get('test_batch_size', TEST_BATCH_SIZE)
+    streams = [pescador.Streamer(data_gen, id, id2audio_repr_path[id], id2gt[id], [config, 'whole_track', None])
+               for id in ids]
+    mux_stream = pescador.ChainMux(streams, mode='exhaustive')
+    batch_streamer = pescador.ZMQStreamer(pescador.Streamer(patch_batches, mux_stream, config['xInput'], hop,
+                                                            batch_size))
+    experiment_folders = [Path(model) if is_frozen(model) else exp_dir / 'experiments' / str(model)
+                          for model in args.list]
+    models = Ensemble([config] * len(experiment_folders), experiment_folders)
+    pred_list, id_list = [], []
+    for batch in tqdm(batch_streamer):
+        pred_list.append(models.predict(batch['X']))
+        id_list.append(batch['ID'])
+    models.close()
+
+    results = tradeoff(np.vstack(pred_list), np.hstack(id_list), ids, id2gt, [None] + args.tolerances,
+                       min_patches=args.min_patches)
+
+    results_file = exp_dir / 'adaptive_inference_{}.tsv'.format(config['fold'])
+    with open(results_file, 'w') as f:
+        f.write('tolerance\tpatches\tpatches_per_track\troc_auc\tpr_auc\n')
+        print('\n{:>10} {:>10} {:>10} {:>10} {:>10}'.format('tolerance', 'patches', 'per track', 'ROC-AUC', 'PR-AUC'))
+        for tolerance, fraction, per_track, roc_auc, pr_auc in results:
+            tolerance = 'all' if tolerance is None else '{:g}'.format(tolerance)
+            f.write('{}\t{:g}\t{:g}\t{:g}\t{:g}\n'.format(tolerance, fraction, per_track, roc_auc, pr_auc))
+            print('{:>10} {:>9.1f}% {:>10.1f} {:>10.4f} {:>10.4f}'.format(
+                tolerance, 100 * fraction, per_track, roc_auc, pr_auc))
+    print('Results written to {}'.format(results_file))
@@ -0,0 +1,91 @@
+import argparse
+import hashlib
+import json
+from pathlib import Path
+
+import numpy as np
+import tensorflow.compat.v1 as tf
+tf.disable_v2_behavior()
+from tqdm import tqdm
+
+from checkpoint_writer import checkpoint_prefix
+import train
+import shared
+from models_transfer_learning import FROZEN_FEATURES
+
+BATCH_SIZE = 64
+ACTIVATION_POOL = 16
+
+
+def compute_activations(sess, x, frozen_features, patches):
+    activations = [sess.run(frozen_features, feed_dict={x: patches[i:i + BATCH_SIZE]})
+                   for i in range(0, len(patches), BATCH_SIZE)]
+    return np.vstack(activations).reshape(len(patches), -1)
+
+
+if __name__ == '__main__':
+    # Precomputes the output of the frozen layers of a pre-trained model (`load_model`) for a
+    # fixed pool of random patches of each training track and for all the validation patches.
+    # With `activation_cache` set, `train.py` only runs the trainable layers on top.
+    parser = argparse.ArgumentParser()
+    parser.add_argument('config_file', help='configuration file')
+
+    args = parser.parse_args()
+
+    with open(args.config_file, "r") as f:
+        config = json.load(f)
+    data_dir = Path(config['data_dir'])
+    config = config['config_train']
+
+    if not config.get('load_model') or not config.get('activation_cache'):
+        raise ValueError('Set `load_model` and `activation_cache` to cache the activations.')
+    cache_dir = Path(config['activation_cache'])
+    pool_size = config.get('activation_pool', ACTIVATION_POOL)
+
+    np.random.seed(seed=config['seed'])
+
+    feature_combination = 'audio_representation_dirs' in config
+
+    # set patch parameters
+    config['xInput'] = config['feature_params']['xInput']
+
+    if feature_combination:
+        config['yInput'] = sum([i['yInput'] for i in config['features_params']])
+        from data_loaders import data_gen_feature_combination as data_gen
+    else:
+        config['yInput'] = config['feature_params']['yInput']
+        from data_loaders import data_gen_standard as data_gen
+
+    [audio_repr_paths, id2audio_repr_path] = shared.load_id2path(data_dir / 'index_repr.tsv')
+    [ids_train, id2gt_train] = shared.load_id2gt(config['gt_train'])
+    [ids_val, id2gt_val] = shared.load_id2gt(config['gt_val'])
+
+    sess = tf.Session(config=shared.session_config())
+    [x, y_, is_train, y, normalized_y, cost, model_vars] = train.tf_define_model_and_cost_freeze(config)
+    sess.run(tf.global_variables_initializer())
+    saver = tf.train.Saver(var_list=model_vars[:-4])
+    saver.restore(sess, checkpoint_prefix(config['load_model']))
+    frozen_features = tf.get_collection(FROZEN_FEATURES)[0]
+
+    # training tracks get a pool of random patches, sampled from during training.
+    # Validation tracks are processed with overlap sampling, as in `train.py`
+    jobs = [(id, id2gt_train[id], [config, 'random', pool_size]) for id in ids_train]
+    jobs += [(id, id2gt_val[id], [config, 'overlap_sampling', config['xInput']]) for id in ids_val]
+
+    (cache_dir / 'activations').mkdir(parents=True, exist_ok=True)
+    index = []
+    for id, gt, pack in tqdm(jobs):
+        patches = np.array([patch['X'] for patch in data_gen(id, id2audio_repr_path[id], gt, pack)])
+        if not len(patches):
+            continue
+
+        activations_path = Path('activations', hashlib.sha1(str(id).encode()).hexdigest() + '.dat')
+        activations = compute_activations(sess, x, frozen_features, patches)
+        activations.astype('float16').tofile(str(cache_dir / activations_path))
+        index.append('{}\t{}\n'.format(id, activations_path))
+
+    with open(cache_dir / 'index_activations.tsv', 'w') as f:
+        f.writelines(index)
+
+    print('Activations of {} tracks ({} dimensions) stored in {}'.format(
+        len(index), int(frozen_features.shape[-1]), cache_dir))
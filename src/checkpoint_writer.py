@@ -0,0 +1,118 @@
+import json
+import os
+import queue
+import shutil
+import threading
+
+import tensorflow.compat.v1 as tf
+tf.disable_v2_behavior()
+
+
+class CheckpointWriter:
+    # Writes checkpoints in a background thread so that the training does not stall. The values of
+    # the variables are copied (`snapshot`) and stored through a shadow graph with the same
+    # variable names, so the checkpoints can be restored as if written by `tf.train.Saver()`.
+    # At most `max_pending` snapshots wait to be written, `submit` blocks when the backlog is full.
+    def __init__(self, variables, max_pending=2):
+        self.variables = variables
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.shadow_variables = [tf.Variable(tf.zeros(v.shape, v.dtype.base_dtype), name=v.op.name)
+                                     for v in variables]
+            self.saver = tf.train.Saver({v.op.name: s for v, s in zip(variables, self.shadow_variables)},
+                                        max_to_keep=None)
+        self.sess = tf.Session(graph=self.graph)
+
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def snapshot(self, sess):
+        return sess.run(self.variables)
+
+    def submit(self, values, writes):
+        # every `write(save)` is called in the background thread, where `save(prefix)` stores the
+        # snapshot `values` and returns the checkpoint path. Jobs are written in submission order
+        self._raise()
+        self.queue.put((values, writes))
+
+    def flush(self):
+        self.queue.join()
+        self._raise()
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        self.sess.close()
+
+    def _save(self, prefix):
+        return self.saver.save(self.sess, prefix, write_meta_graph=False, write_state=False)
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                return
+
+            values, writes = job
+            try:
+                if self.error is None:
+                    for variable, value in zip(self.shadow_variables, values):
+                        variable.load(value, self.sess)
+                    for write in writes:
+                        write(self._save)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _raise(self):
+        if self.error is not None:
+            raise RuntimeError('Writing a checkpoint failed') from self.error
+
+
+def write_best_model(save, model_folder, epoch, keep=1):
+    # The checkpoint is written to a temporary folder and renamed to `checkpoints/epoch-{epoch}`,
+    # keeping the last `keep` of them. Only then the `checkpoint` file of `model_folder` (replaced
+    # atomically) points to it, so the readers (see `checkpoint_prefix`) never see a partial one.
+    checkpoints_folder = model_folder / 'checkpoints'
+    tmp_folder = checkpoints_folder / '.tmp-epoch-{}'.format(epoch)
+    epoch_folder = checkpoints_folder / 'epoch-{}'.format(epoch)
+    for folder in [tmp_folder, epoch_folder]:
+        if folder.exists():
+            shutil.rmtree(folder)
+
+    tmp_folder.mkdir(parents=True)
+    save(str(tmp_folder) + '/')  # TF needs this trailing `/`
+    tmp_folder.rename(epoch_folder)
+    # relative to `model_folder`, which can be moved
+    tf.train.update_checkpoint_state(str(model_folder), os.path.join(checkpoints_folder.name, epoch_folder.name, ''))
+
+    epoch_folders = sorted(checkpoints_folder.glob('epoch-*'), key=lambda f: int(f.name.split('-')[1]))
+    for folder in epoch_folders[:-keep]:
+        shutil.rmtree(folder)
+
+
+def checkpoint_prefix(model_folder):
+    # the checkpoint of the best model of an experiment, named by its `checkpoint` file, or the
+    # `model_folder/` prefix of the experiments written by `tf.train.Saver` (e.g., `linear_probe.py`)
+    return tf.train.latest_checkpoint(str(model_folder)) or os.path.join(str(model_folder), '')
+
+
+def write_resume_state(save, resume_folder, state):
+    # The checkpoint contains all the global variables (model, batchnorm statistics and
+    # optimizer slots). The training loop state is stored next to it, and written last so
+    # that it always points to a complete checkpoint. Then the previous checkpoint is removed.
+    resume_folder.mkdir(parents=True, exist_ok=True)
+    prefix = resume_folder / 'model-{}'.format(state['epoch'])
+    state['checkpoint'] = save(str(prefix))
+    with open(resume_folder / 'state.json.tmp', 'w') as f:
+        json.dump(state, f)
+    (resume_folder / 'state.json.tmp').replace(resume_folder / 'state.json')
+
+    for f in resume_folder.glob('model-*'):
+        if not f.name.startswith(prefix.name + '.'):
+            f.unlink()
@@ -1,6 +1,12 @@
+from collections import deque
 import numpy as np
 import os
 from pathlib import Path
+import queue
+import threading
+
+# int16 full scale, used to map int16 representations back to [-1, 1)
+INT16_SCALE = 32768
 
 
 def compress(audio_rep, compression=None):
@@ -15,34 +21,171 @@ def compress(audio_rep, compression=None):
         raise('get_audio_rep: Preprocessing not available.')
 
 
-def get_short_rep(audio_repr_path, x, y, frames_num):
-    fp = np.memmap(audio_repr_path, dtype='float16',
+def to_float(audio_rep, dtype='float16'):
+    # int16 representations (e.g., waveforms) are scaled back to [-1, 1)
+    if np.dtype(dtype) == np.int16:
+        return audio_rep.astype('float32') / INT16_SCALE
+    return audio_rep
+
+
+def get_short_rep(audio_repr_path, x, y, frames_num, dtype='float16'):
+    fp = np.memmap(audio_repr_path, dtype=dtype,
                    mode='r', shape=(frames_num, y))
     audio_rep = np.zeros([x, y])
-    audio_rep[:frames_num, :] = np.array(fp)
+    audio_rep[:frames_num, :] = to_float(np.array(fp), dtype=dtype)
     del fp
 
     return audio_rep
 
 
-def read_mmap(audio_repr_path, x, y, frames_num, single_patch=False, offset=0, compression=None):
+def read_mmap(audio_repr_path, x, y, frames_num, single_patch=False, offset=0, compression=None, dtype='float16'):
     if frames_num < x:
-        audio_repr = get_short_rep(audio_repr_path, x, y, frames_num)
+        audio_repr = get_short_rep(audio_repr_path, x, y, frames_num, dtype=dtype)
     else:
         read_x = x if single_patch else frames_num
-        fp = np.memmap(audio_repr_path, dtype='float16',
+        fp = np.memmap(audio_repr_path, dtype=dtype,
                        mode='r', shape=(read_x, y), offset=offset)
-        audio_repr = np.array(fp)
+        audio_repr = to_float(np.array(fp), dtype=dtype)
         del fp
     return compress(audio_repr, compression=compression)
 
 
+def cache_patches(batches, cache_file=None):
+    # materialises a finite stream of batches (e.g., the validation set, which does not change
+    # across epochs) as float16 arrays, in memory or in a memmap when `cache_file` is given
+    empty_error = 'No patches to cache: the stream of batches is empty.'
+    if not cache_file:
+        cached = [(batch['X'].astype('float16'), batch['Y'].astype('float16')) for batch in batches]
+        if not cached:
+            raise ValueError(empty_error)
+        xs, ys = zip(*cached)
+        return np.concatenate(xs), np.concatenate(ys)
+
+    x_file, y_file = str(cache_file) + '.X', str(cache_file) + '.Y'
+    n_patches = 0
+    with open(x_file, 'wb') as fx, open(y_file, 'wb') as fy:
+        for batch in batches:
+            batch['X'].astype('float16').tofile(fx)
+            batch['Y'].astype('float16').tofile(fy)
+            n_patches += len(batch['X'])
+            x_shape, y_shape = batch['X'].shape[1:], batch['Y'].shape[1:]
+    if not n_patches:
+        os.remove(x_file)
+        os.remove(y_file)
+        raise ValueError(empty_error)
+
+    X = np.memmap(x_file, dtype='float16', mode='r', shape=(n_patches, *x_shape))
+    Y = np.memmap(y_file, dtype='float16', mode='r', shape=(n_patches, *y_shape))
+    # the data stays available through the maps and is released with the process
+    os.remove(x_file)
+    os.remove(y_file)
+    return X, Y
+
+
+def iterate_patches(X, Y, batch_size):
+    for i in range(0, len(X), batch_size):
+        yield {'X': X[i:i + batch_size], 'Y': Y[i:i + batch_size]}
+
+
+def overlap_patches(audio_rep, window, hop):
+    # the patches of `overlap_sampling`, as a read-only [patches, window, bands] view of `audio_rep`
+    audio_rep = np.asarray(audio_rep)
+    if len(audio_rep) < window:
+        raise ValueError('Tracks of at least {} frames expected, got {}.'.format(window, len(audio_rep)))
+    patches = (len(audio_rep) - window) // hop + 1
+    s0, s1 = audio_rep.strides
+    return np.lib.stride_tricks.as_strided(audio_rep, shape=(patches, window, audio_rep.shape[1]),
+                                           strides=(hop * s0, s0, s1), writeable=False)
+
+
+def take_patches(pending, size):
+    # the first `size` patches of the `pending` [patches, id] of the tracks, as a batch
+    X, ids, counts = [], [], []
+    while size and pending:
+        patches, id = pending[0]
+        n = min(size, len(patches))
+        X.append(patches[:n])
+        ids.append(id)
+        counts.append(n)
+        if n == len(patches):
+            pending.popleft()
+        else:
+            pending[0][0] = patches[n:]
+        size -= n
+    return {'X': np.concatenate(X), 'ID': np.repeat(np.array(ids), counts)}
+
+
+def patch_batches(tracks, window, hop, batch_size, variable_length=False):
+    # Batches of `batch_size` patches of `window` frames every `hop` frames (as `overlap_sampling`)
+    # cut from a stream of tracks (`whole_track` sampling): the patches of consecutive tracks fill
+    # the same batch, and are views of the tracks until the batch is copied. The ids are kept per
+    # track and repeated per patch. With `variable_length`, the tracks shorter than `window` are
+    # not zero-padded: they are batched with the tracks of the same number of frames, for models
+    # taking patches of any length.
+    pending, n_pending = deque(), 0
+    buckets = dict()
+    for track in tracks:
+        if variable_length and track['frames'] < window:
+            bucket = buckets.setdefault(track['frames'], deque())
+            bucket.append([track['X'][None, :track['frames']], track['ID']])
+            if len(bucket) == batch_size:
+                yield take_patches(buckets.pop(track['frames']), batch_size)
+            continue
+
+        patches = overlap_patches(track['X'], window, hop)
+        pending.append([patches, track['ID']])
+        n_pending += len(patches)
+        while n_pending >= batch_size:
+            yield take_patches(pending, batch_size)
+            n_pending -= batch_size
+
+    if pending:
+        yield take_patches(pending, n_pending)
+    for bucket in buckets.values():
+        yield take_patches(bucket, len(bucket))
+
+
+class Prefetcher:
+    # iterates `batches` in a background thread keeping up to `size` batches ready. The
+    # number of waiting batches (`depth`) shows whether the loader keeps up with the training
+    _end = object()
+
+    def __init__(self, batches, size=4):
+        self.queue = queue.Queue(maxsize=size)
+        self.thread = threading.Thread(target=self._fill, args=(batches,), daemon=True)
+        self.thread.start()
+
+    def _fill(self, batches):
+        try:
+            for batch in batches:
+                self.queue.put(batch)
+        except Exception as e:
+            self.queue.put(e)
+        self.queue.put(self._end)
+
+    def __iter__(self):
+        while True:
+            batch = self.queue.get()
+            if batch is self._end:
+                return
+            if isinstance(batch, Exception):
+                raise batch
+            yield batch
+
+    def depth(self):
+        return self.queue.qsize()
+
+
 def data_gen_standard(id, audio_repr_path, gt, pack):
     config, sampling, param_sampling = pack
     audio_repr_path = Path(config['audio_representation_dir'], audio_repr_path)
 
+    # storage type of the representation: float16 by default, or int16 for waveforms
+    dtype = config['feature_params'].get('dtype', 'float16')
+    itemsize = np.dtype(dtype).itemsize
+
     try:
-        floats_num = os.path.getsize(audio_repr_path) // 2  # each float16 has 2 bytes
+        floats_num = os.path.getsize(audio_repr_path) // itemsize  # each float16 has 2 bytes
         frames_num = floats_num // config['yInput']
 
         # let's deliver some data!
@@ -57,7 +200,7 @@ def data_gen_standard(id, audio_repr_path, gt, pack):
                     random_uniform * (frames_num - config['xInput'])))
 
                 # idx * bands * bytes per float
-                offset = random_frame_offset * config['yInput'] * 2
+                offset = random_frame_offset * config['yInput'] * itemsize
                 yield {
                     'X': read_mmap(audio_repr_path,
                                    config['xInput'],
@@ -65,19 +208,24 @@ def data_gen_standard(id, audio_repr_path, gt, pack):
                                    frames_num,
                                    single_patch=True,
                                    offset=offset,
-                                   compression=config['feature_params']['compression']
+                                   compression=config['feature_params']['compression'],
+                                   dtype=dtype
                                    ),
                     'Y': gt,
                     'ID': id
                 }
 
-        elif sampling == 'overlap_sampling':
+        elif sampling in ['overlap_sampling', 'whole_track']:
             audio_rep = read_mmap(audio_repr_path,
                                   config['xInput'],
                                   config['yInput'],
                                   frames_num,
-                                  compression=config['feature_params']['compression']
+                                  compression=config['feature_params']['compression'],
+                                  dtype=dtype
                                   )
+            if sampling == 'whole_track':  # the patches are cut later (`patch_batches`, `track_inference.py`)
+                yield {'X': audio_rep, 'Y': gt, 'ID': id, 'frames': frames_num}
+                return
             last_frame = int(audio_rep.shape[0]) - int(config['xInput']) + 1
             for time_stamp in range(0, last_frame, param_sampling):
                 yield {
@@ -137,7 +285,7 @@ def data_gen_feature_combination(id, audio_repr_path, gt, pack):
                     'ID': id
                 }
 
-        elif sampling == 'overlap_sampling':
+        elif sampling in ['overlap_sampling', 'whole_track']:
             x = np.hstack([read_mmap(path,
                                      config['xInput'],
                                      yInputs[i],
@@ -145,6 +293,9 @@ def data_gen_feature_combination(id, audio_repr_path, gt, pack):
                                      compression=config['feature_params']['compression']
                                      ) for i, path in enumerate(audio_repr_paths)]
                           )
+            if sampling == 'whole_track':
+                yield {'X': x, 'Y': gt, 'ID': id, 'frames': frames_num}
+                return
             last_frame = int(x.shape[0]) - int(config['xInput']) + 1
             for time_stamp in range(0, last_frame, param_sampling):
                 yield {
@@ -154,3 +305,31 @@ def data_gen_feature_combination(id, audio_repr_path, gt, pack):
                 }
     except FileNotFoundError:
         print('"{}" not found'.format(audio_repr_path))
+
+
+def data_gen_activations(id, activations_path, gt, pack):
+    # activations of the frozen layers of a pre-trained model, precomputed for a fixed pool
+    # of patches per track (see `cache_activations.py`)
+    config, sampling, param_sampling = pack
+    activations_path = Path(config['activation_cache'], activations_path)
+
+    try:
+        activations = np.fromfile(activations_path, dtype='float16').reshape(-1, config['activation_dims'])
+
+        if sampling == 'random':
+            for i in range(0, param_sampling):
+                yield {
+                    'X': activations[np.random.randint(len(activations))],
+                    'Y': gt,
+                    'ID': id
+                }
+
+        elif sampling == 'overlap_sampling':
+            for patch in activations:
+                yield {
+                    'X': patch,
+                    'Y': gt,
+                    'ID': id
+                }
+    except FileNotFoundError:
+        print('"{}" not found'.format(activations_path))
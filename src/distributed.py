@@ -0,0 +1,125 @@
+import itertools
+import os
+import socket
+import subprocess
+import sys
+
+import tensorflow.compat.v1 as tf
+tf.disable_v2_behavior()
+from tensorflow.python.ops import collective_ops
+
+import shared
+
+# Synchronous data-parallel training without parameter servers. Every worker builds the same
+# graph, computes the gradients on its own shard of the training set and averages them with a
+# collective all-reduce before applying them locally, so the model replicas never diverge.
+
+GROUP_KEY = 1
+_instance_keys = itertools.count(1)
+
+
+class Cluster:
+    def __init__(self, worker_hosts, task_index):
+        self.worker_hosts = worker_hosts
+        self.task_index = task_index
+        self.num_workers = len(worker_hosts)
+        self.is_chief = task_index == 0
+
+        self.session_config = shared.session_config()
+        self.session_config.experimental.collective_group_leader = '/job:worker/replica:0/task:0'
+
+        cluster_spec = tf.train.ClusterSpec({'worker': worker_hosts})
+        self.server = tf.train.Server(cluster_spec, job_name='worker', task_index=task_index,
+                                      config=self.session_config)
+
+    def session(self):
+        return tf.Session(self.server.target, config=self.session_config)
+
+    def shard(self, ids):
+        # disjoint shards of the same size, so that every worker runs the same number of steps.
+        # The last `len(ids) % num_workers` ids are left out of the epoch
+        size = len(ids) // self.num_workers
+        return list(ids[self.task_index * size:(self.task_index + 1) * size])
+
+    def all_reduce(self, tensors, merge_op='Add', final_op='Div'):
+        # reduces a list of tensors with a single collective by flattening and concatenating them
+        shapes = [tf.shape(t) for t in tensors]
+        sizes = [tf.size(t) for t in tensors]
+        flat = tf.concat([tf.reshape(tf.cast(t, tf.float32), [-1]) for t in tensors], axis=0)
+        reduced = collective_ops.all_reduce(flat, self.num_workers, GROUP_KEY, next(_instance_keys),
+                                            merge_op, final_op)
+        return [tf.cast(tf.reshape(r, s), t.dtype)
+                for r, s, t in zip(tf.split(reduced, sizes), shapes, tensors)]
+
+    def average_gradients(self, grads_and_vars):
+        grads_and_vars = [(g, v) for g, v in grads_and_vars if g is not None]
+        gradients, variables = zip(*grads_and_vars)
+        gradients = [tf.convert_to_tensor(g) for g in gradients]
+        return list(zip(self.all_reduce(gradients), variables))
+
+    def sync_variables(self, variables, broadcast=False):
+        # `broadcast` copies the chief values to all workers (initialization, restored
+        # checkpoints), otherwise the values are averaged (batchnorm statistics)
+        values = [v.read_value() for v in variables]
+        if broadcast:
+            if not self.is_chief:
+                values = [tf.zeros_like(v) for v in values]
+            values = self.all_reduce(values, final_op='Id')
+        else:
+            values = self.all_reduce(values)
+        return tf.group(*[v.assign(r) for v, r in zip(variables, values)])
+
+    def scalars(self, size, broadcast=False):
+        # returns a placeholder for a vector of scalars and its reduced (summed or broadcasted) value
+        values = tf.placeholder(tf.float32, [size])
+        if broadcast and not self.is_chief:
+            values_in = tf.zeros_like(values)
+        else:
+            values_in = values
+        return values, self.all_reduce([values_in], final_op='Id')[0]
+
+
+def batchnorm_statistics():
+    return [v for v in tf.global_variables() if 'moving_mean' in v.name or 'moving_variance' in v.name]
+
+
+def repeat(streamer, n_batches):
+    # yields exactly `n_batches` batches, restarting the streamer if it runs out. Workers must run
+    # the same number of steps since every step waits for the gradients of all of them
+    count = 0
+    while count < n_batches:
+        empty = True
+        for batch in streamer:
+            empty = False
+            yield batch
+            count += 1
+            if count == n_batches:
+                return
+        if empty:
+            raise RuntimeError('The training stream of this worker is empty.')
+
+
+def free_ports(n):
+    sockets = [socket.socket() for _ in range(n)]
+    for s in sockets:
+        s.bind(('localhost', 0))
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+    return ports
+
+
+def launch_local_workers(num_workers, argv):
+    # runs `num_workers` copies of the training script on this machine, splitting the CPU
+    # threads among them. Returns the first non-zero exit code
+    worker_hosts = ','.join('localhost:{}'.format(p) for p in free_ports(num_workers))
+    env = dict(os.environ)
+    threads = str(max(1, len(os.sched_getaffinity(0)) // num_workers))
+    env.setdefault('TF_NUM_INTRAOP_THREADS', threads)
+    env.setdefault('OMP_NUM_THREADS', threads)
+
+    processes = [subprocess.Popen([sys.executable] + argv + ['--worker_hosts', worker_hosts,
+                                                              '--task_index', str(i)], env=env)
+                 for i in range(num_workers)]
+    exit_codes = [p.wait() for p in processes]
+    return next((c for c in exit_codes if c), 0)
@@ -0,0 +1,102 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tensorflow.compat.v1 as tf
+tf.disable_v2_behavior()
+
+from checkpoint_writer import checkpoint_prefix
+import shared
+import train
+
+# patch parameters that have to be the same for all the models of an ensemble
+SHARED_INPUT_KEYS = ['xInput', 'yInput', 'num_classes_dataset']
+# input and output tensors of the graphs written by `freeze_model.py`
+FROZEN_INPUT = 'model/Placeholder:0'
+FROZEN_OUTPUT = {True: 'model/Sigmoid:0', False: 'model/Softmax:0'}
+# models pooling their feature map globally over time, which take patches of any number of frames
+GLOBAL_POOLING_MODELS = [10, 11]
+
+
+def is_frozen(model):
+    return str(model).endswith('.pb')
+
+
+def variable_length_config(config):
+    # the configuration of a model taking patches of any number of frames (`xInput` None)
+    if (config['model_number'] not in GLOBAL_POOLING_MODELS or config['load_model'] is not None
+            or config['feature_params'].get('melspectrogram')):
+        raise ValueError('Patches of any length need a global pooling model {} on spectrograms.'.format(
+            GLOBAL_POOLING_MODELS))
+    return dict(config, xInput=None)
+
+
+def load_frozen_model(pb_file, config):
+    # a graph written by `freeze_model.py`, with the weights as constants. Only the input patches
+    # are fed and only the predictions are computed: there is no training flag, label or cost
+    graph_def = tf.GraphDef()
+    with open(pb_file, 'rb') as f:
+        graph_def.ParseFromString(f.read())
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name='')
+    x = graph.get_tensor_by_name(FROZEN_INPUT)
+    normalized_y = graph.get_tensor_by_name(FROZEN_OUTPUT[bool(config['is_multilabel_task'])])
+    return tf.Session(graph=graph, config=shared.session_config()), x, None, normalized_y
+
+
+class Ensemble:
+    # Trained models, each one in its own graph and session, run on the same batches so that the
+    # features are read once. Their per-patch predictions are averaged, weighted by `weights`.
+    # A model is an experiment folder (checkpoint) or a frozen `.pb` graph. With `parallel`, the
+    # sessions of the models run at the same time.
+    def __init__(self, configs, experiment_folders, weights=None, parallel=True):
+        for key in SHARED_INPUT_KEYS:
+            if len(set(config[key] for config in configs)) > 1:
+                raise ValueError('The models of an ensemble need the same `{}`.'.format(key))
+        if weights is None:
+            weights = np.ones(len(configs))
+        if len(weights) != len(configs):
+            raise ValueError('{} weights given for {} models.'.format(len(weights), len(configs)))
+        self.weights = np.array(weights, dtype='float64') / np.sum(weights)
+
+        self.models = []
+        for config, experiment_folder in zip(configs, experiment_folders):
+            if is_frozen(experiment_folder):
+                if config['xInput'] is None:
+                    raise ValueError('Frozen graphs take patches of `xInput` frames only.')
+                self.models.append(load_frozen_model(experiment_folder, config))
+                continue
+
+            graph = tf.Graph()
+            with graph.as_default():
+                sess = tf.Session(graph=graph, config=shared.session_config())
+                [x, y_, is_train, y, normalized_y, cost, _] = train.tf_define_model_and_cost(config)
+                sess.run(tf.global_variables_initializer())
+                tf.train.Saver().restore(sess, checkpoint_prefix(experiment_folder))
+            self.models.append((sess, x, is_train, normalized_y))
+
+        self.executor = None
+        if parallel and len(self.models) > 1:
+            self.executor = ThreadPoolExecutor(max_workers=len(self.models))
+
+    def _predict(self, model, X):
+        sess, x, is_train, normalized_y = model
+        feed_dict = {x: X}
+        if is_train is not None:
+            feed_dict[is_train] = False
+        return sess.run(normalized_y, feed_dict=feed_dict)
+
+    def predict(self, X):
+        if self.executor:
+            predictions = list(self.executor.map(lambda model: self._predict(model, X), self.models))
+        else:
+            predictions = [self._predict(model, X) for model in self.models]
+        if len(predictions) == 1:
+            return predictions[0]
+        return np.tensordot(self.weights, np.array(predictions), axes=1).astype(predictions[0].dtype)
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown()
+        for sess, _, _, _ in self.models:
+            sess.close()
@@ -8,33 +8,53 @@ tf.disable_v2_behavior()
 from tqdm import tqdm
 import pescador
 
-import train
 import shared
+from adaptive_inference import adaptive_prediction
+from data_loaders import patch_batches
+from ensemble import Ensemble, is_frozen, variable_length_config
+import track_inference
 
 TEST_BATCH_SIZE = 64
 
 
-def prediction(config, experiment_folder, id2audio_repr_path, id2gt, ids):
-    # pescador: define (finite, batched & parallel) streamer
-    pack = [config, 'overlap_sampling', config['xInput']]
-    streams = [pescador.Streamer(data_gen, id, id2audio_repr_path[id], id2gt[id], pack) for id in ids]
-    mux_stream = pescador.ChainMux(streams, mode='exhaustive')
-    batch_streamer = pescador.Streamer(pescador.buffer_stream, mux_stream, buffer_size=TEST_BATCH_SIZE, partial=True)
-    batch_streamer = pescador.ZMQStreamer(batch_streamer)
+def prediction(config, experiment_folders, id2audio_repr_path, id2gt, ids, weights=None):
+    # patches every `inference_hop` frames (by default, not overlapping)
+    hop = config.get('inference_hop') or config['xInput']
+    batch_size = config.get('test_batch_size', TEST_BATCH_SIZE)
     num_classes_dataset = config['num_classes_dataset']
 
-    # tensorflow: define model and cost
-    tf_graph = tf.Graph()
-    with tf_graph.as_default():
-        sess = tf.Session()
-        [x, y_, is_train, y, normalized_y, cost, _] = train.tf_define_model_and_cost(config)
-        sess.run(tf.global_variables_initializer())
-        saver = tf.train.Saver()
-        saver.restore(sess, str(experiment_folder) + '/')
+    if track_inference.shares_patches(config):
+        # the models run once over chunks of patches of every track, see `track_inference.py`
+        batch_streamer = track_inference.track_streamer(config, data_gen, ids, id2audio_repr_path, id2gt)
+        models = track_inference.TrackEnsemble([config] * len(experiment_folders), experiment_folders, hop,
+                                               chunk_windows=config.get('inference_chunk_windows',
+                                                                        track_inference.CHUNK_WINDOWS),
+                                               weights=weights, batch_size=batch_size)
+        pred_array, id_array = track_inference.predict_tracks(batch_streamer, models)
+    elif config.get('adaptive_inference_tolerance') is not None:
+        # only the patches needed for the mean of each track to settle, see `adaptive_inference.py`
+        batch_streamer = track_inference.track_streamer(config, data_gen, ids, id2audio_repr_path, id2gt)
+        models = Ensemble([config] * len(experiment_folders), experiment_folders, weights=weights)
+        pred_array, id_array, _ = adaptive_prediction(batch_streamer, models, config,
+                                                      config['adaptive_inference_tolerance'])
+    else:
+        # pescador: define (finite, batched & parallel) streamer. The tracks are read whole and
+        # their patches fill the batches (short tracks at their length with `variable_length_inference`)
+        variable_length = config.get('variable_length_inference', False)
+        pack = [config, 'whole_track', None]
+        streams = [pescador.Streamer(data_gen, id, id2audio_repr_path[id], id2gt[id], pack) for id in ids]
+        mux_stream = pescador.ChainMux(streams, mode='exhaustive')
+        batch_streamer = pescador.Streamer(patch_batches, mux_stream, config['xInput'], hop, batch_size,
+                                           variable_length=variable_length)
+        batch_streamer = pescador.ZMQStreamer(batch_streamer)
+
+        # tensorflow: every batch is read once and predicted by all the models
+        model_config = variable_length_config(config) if variable_length else config
+        models = Ensemble([model_config] * len(experiment_folders), experiment_folders, weights=weights)
 
         pred_list, id_list = [], []
         for batch in tqdm(batch_streamer):
-            pred, _ = sess.run([normalized_y, cost], feed_dict={x: batch['X'], y_: batch['Y'], is_train: False})
+            pred = models.predict(batch['X'])
             # make sure our predictions are in a numpy
             # array with the proper shape
             pred = np.array(pred).reshape(-1, num_classes_dataset)
@@ -44,13 +64,14 @@ def prediction(config, experiment_folder, id2audio_repr_path, id2gt, ids):
         pred_array = np.vstack(pred_list)
         id_array = np.hstack(id_list)
 
-        sess.close()
+    models.close()
 
     print(pred_array.shape)
     print(id_array.shape)
 
     print('Predictions computed, now evaluating...')
-    y_true, y_pred, healthy_ids = shared.average_predictions(pred_array, id_array, ids, id2gt)
+    y_true, y_pred, healthy_ids = shared.average_predictions(pred_array, id_array, ids, id2gt,
+                                                             pooling=config.get('prediction_pooling', 'mean'))
     roc_auc, pr_auc = shared.compute_auc(y_true, y_pred)
     acc = shared.compute_accuracy(y_true, y_pred)
 
@@ -86,9 +107,12 @@ def store_results(results_file, predictions_file, models, ids, y_pred, metrics):
 if __name__ == '__main__':
     # which experiment we want to evaluate?
     # Use the -l functionality to ensemble models: python arg.py -l 1234 2345 3456 4567
+    # (their per-patch predictions are averaged, or weighted with -w)
     parser = argparse.ArgumentParser()
     parser.add_argument('config_file', help='configuration file')
-    parser.add_argument('-l', '--list', nargs='+', help='List of models to evaluate', required=True)
+    parser.add_argument('-l', '--list', nargs='+', required=True,
+                        help='List of models (experiment ids or frozen .pb graphs) to evaluate')
+    parser.add_argument('-w', '--weights', type=float, nargs='+', help='weights of the models of the ensemble')
 
     args = parser.parse_args()
 
@@ -104,41 +128,42 @@ if __name__ == '__main__':
     # load all audio representation paths
     [audio_repr_paths, id2audio_repr_path] = shared.load_id2path(file_index)
 
-    for model in models:
-        experiment_folder = Path(exp_dir, 'experiments', str(model))
-        print('Experiment: ' + str(model))
-        print('\n' + str(config))
-
-        feature_combination = 'audio_representation_dirs' in config_train
-
-        # set patch parameters
-        config_train['xInput'] = config_train['feature_params']['xInput']
-
-        if feature_combination:
-            config_train['yInput'] = sum([i['yInput'] for i in config_train['features_params']])
-        else:
-            config_train['yInput'] = config_train['feature_params']['yInput']
-
-        # get the data loader
-        print('Loading data generator for regular training')
-        if feature_combination:
-            from data_loaders import data_gen_feature_combination as data_gen
-        else:
-            from data_loaders import data_gen_standard as data_gen
-
-        # load ground truth
-        print('groundtruth file: {}'.format(config_train['gt_test']))
-        ids, id2gt = shared.load_id2gt(config_train['gt_test'])
-        print('# Test set size: ', len(ids))
-
-        print('Performing regular evaluation')
-        y_pred, metrics, healthy_ids = prediction(
-            config_train, experiment_folder, id2audio_repr_path, id2gt, ids)
-
-        # store experimental results
-        results_file = Path(
-            exp_dir, f"results_{config_train['fold']}")
-        predictions_file = Path(
-            exp_dir, f"predictions_{config_train['fold']}.json")
-
-        store_results(results_file, predictions_file, models, healthy_ids, y_pred, metrics)
+    # the listed models are evaluated as an ensemble, reading the features once
+    experiment_folders = [Path(model) if is_frozen(model) else Path(exp_dir, 'experiments', str(model))
+                          for model in models]
+    print('Experiment: ' + str(models))
+    print('\n' + str(config))
+
+    feature_combination = 'audio_representation_dirs' in config_train
+
+    # set patch parameters
+    config_train['xInput'] = config_train['feature_params']['xInput']
+
+    if feature_combination:
+        config_train['yInput'] = sum([i['yInput'] for i in config_train['features_params']])
+    else:
+        config_train['yInput'] = config_train['feature_params']['yInput']
+
+    # get the data loader
+    print('Loading data generator for regular training')
+    if feature_combination:
+        from data_loaders import data_gen_feature_combination as data_gen
+    else:
+        from data_loaders import data_gen_standard as data_gen
+
+    # load ground truth
+    print('groundtruth file: {}'.format(config_train['gt_test']))
+    ids, id2gt = shared.load_id2gt(config_train['gt_test'])
+    print('# Test set size: ', len(ids))
+
+    print('Performing regular evaluation')
+    y_pred, metrics, healthy_ids = prediction(
+        config_train, experiment_folders, id2audio_repr_path, id2gt, ids, weights=args.weights)
+
+    # store experimental results
+    results_file = Path(
+        exp_dir, f"results_{config_train['fold']}")
+    predictions_file = Path(
+        exp_dir, f"predictions_{config_train['fold']}.json")
+
+    store_results(results_file, predictions_file, models, healthy_ids, y_pred, metrics)
@@ -9,15 +9,18 @@ from feature_melspectrogram import (
     MelSpectrogramVGGish,
     MelSpectrogramMusiCNN,
     MelSpectrogramOpenL3,
+    MelSpectrogramFromFile,
 )
 
 
 class EmbeddingFromMelSpectrogram:
-    def __init__(self, model_type, hop_time=1, batch_size=60, models_path='models/'):
+    def __init__(self, model_type, hop_time=1, batch_size=60, models_path='models/', from_melspectrogram=False):
         self.model_type = model_type
         self.hop_time = hop_time
         self.batch_size = batch_size
         self.models_path = models_path
+        # when set, `compute` expects a mel-spectrogram .dat file instead of an audio file
+        self.from_melspectrogram = from_melspectrogram
 
         with open(Path(self.models_path, "models_config.json"), "r") as config_file:
             config = json.load(config_file)
@@ -34,7 +37,11 @@ class EmbeddingFromMelSpectrogram:
 
         self.seconds_to_patches = self.config["seconds_to_patches"]
 
-        if self.model_type in ("musicnn", "effnet_b0"):
+        if self.from_melspectrogram:
+            if self.config["input_type"] not in ("mel_musicnn", "mel_vggish"):
+                raise ValueError("{} can not be computed from stored mel-spectrograms".format(self.model_type))
+            self.mel_extractor = MelSpectrogramFromFile(self.y_size)
+        elif self.model_type in ("musicnn", "effnet_b0"):
             self.mel_extractor = MelSpectrogramMusiCNN()
         elif self.model_type in ("vggish", "yamnet"):
             self.mel_extractor = MelSpectrogramVGGish()
@@ -49,6 +56,9 @@ class EmbeddingFromMelSpectrogram:
         )
 
     def compute(self, audio_file):
+        return np.vstack(list(self.compute_batches(audio_file)))
+
+    def compute_batches(self, audio_file):
         mel_spectrogram = self.mel_extractor.compute(audio_file)
         # in OpenL3 the hop size is computed in the feature extraction level
         if self.model_type == "openl3":
@@ -59,16 +69,14 @@ class EmbeddingFromMelSpectrogram:
         batch = self.__melspectrogram_to_batch(mel_spectrogram, hop_size_samples)
 
         pool = Pool()
-        embeddings = []
         nbatches = int(np.ceil(batch.shape[0] / self.batch_size))
         for i in range(nbatches):
             start = i * self.batch_size
             end = min(batch.shape[0], (i + 1) * self.batch_size)
             pool.set(self.input_layer, batch[start:end])
             out_pool = self.model(pool)
-            embeddings.append(out_pool[self.output_layer].squeeze())
-
-        return np.vstack(embeddings)
+            # keep the batch dimension even if the batch contains a single patch
+            yield np.atleast_2d(out_pool[self.output_layer].squeeze())
 
     def __melspectrogram_to_batch(self, melspectrogram, hop_time):
         npatches = int(np.ceil((melspectrogram.shape[0] - self.x_size) / hop_time) + 1)
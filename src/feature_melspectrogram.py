@@ -2,6 +2,9 @@ from essentia.streaming import MonoLoader, TensorflowInputMusiCNN, TensorflowInp
 import essentia.standard as es
 from essentia import Pool, run, reset
 import numpy as np
+import os
+
+from data_loaders import read_mmap
 
 
 class MelSpectrogramMusiCNN():
@@ -56,6 +59,17 @@ class MelSpectrogramVGGish():
         return melbands
 
 
+class MelSpectrogramFromFile():
+    # Reads the mel-spectrograms stored by `preprocess.py` (e.g., `musicnn-melspectrogram`
+    # or `vggish-melspectrogram`) instead of decoding and analysing the audio again.
+    def __init__(self, number_bands):
+        self.number_bands = number_bands
+
+    def compute(self, audio_repr_file):
+        frames_num = os.path.getsize(audio_repr_file) // 2 // self.number_bands  # float16 has 2 bytes
+        return read_mmap(audio_repr_file, frames_num, self.number_bands, frames_num).astype('float32')
+
+
 class MelSpectrogramOpenL3():
     def __init__(self, hop_time):
         self.hop_time = hop_time
@@ -0,0 +1,21 @@
+from essentia.standard import MonoLoader
+import numpy as np
+
+from data_loaders import INT16_SCALE
+
+
+class Waveform():
+    # Decoded mono audio stored as a [samples, 1] representation, so the
+    # `xInput` of a waveform patch is its length in samples and `yInput` is 1.
+    def __init__(self, sample_rate=16000, dtype='int16'):
+        self.sample_rate = sample_rate
+        # int16 halves the storage of float32 PCM. float16 is also supported.
+        self.dtype = dtype
+
+    def compute(self, audio_file):
+        audio = MonoLoader(filename=audio_file, sampleRate=self.sample_rate)()
+
+        if self.dtype == 'int16':
+            audio = np.clip(np.round(audio * INT16_SCALE), -INT16_SCALE, INT16_SCALE - 1).astype('int16')
+
+        return audio.reshape(-1, 1)
@@ -8,6 +8,7 @@ from tensorflow.core.framework import graph_pb2
 from tensorflow.core.framework import node_def_pb2
 tf.disable_v2_behavior()
 
+from checkpoint_writer import checkpoint_prefix
 import train
 
 
@@ -108,8 +109,7 @@ if __name__ == '__main__':
         # call training script
         with open(exp_dir / 'experiment_id_whole') as f:
             model = f.read().rstrip()
-        results_folder = str(exp_dir / 'experiments' / model) + '/'
-        saver.restore(sess, results_folder)
+        saver.restore(sess, checkpoint_prefix(exp_dir / 'experiments' / model))
         tf_vars = [sess, normalized_y, cost, x, y_, is_train]
 
         gd = sess.graph.as_graph_def()
@@ -186,4 +186,8 @@ if __name__ == '__main__':
             node_names  # .split(",")   # The output node names are used to select the usefull nodes
         )
         tf.io.write_graph(output_graph_def, '.', output_graph, as_text=False)
+
+        # the configuration of the model, read by `predict.py` to run the frozen graph
+        with open(os.path.splitext(output_graph)[0] + '.json', 'w') as f:
+            json.dump(config_train, f)
         sess.close()
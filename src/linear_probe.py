@@ -0,0 +1,188 @@
+import argparse
+import json
+from pathlib import Path
+import time
+
+import numpy as np
+import tensorflow.compat.v1 as tf
+tf.disable_v2_behavior()
+from sklearn.linear_model import LogisticRegression, Ridge
+from sklearn.multiclass import OneVsRestClassifier
+
+import train
+import shared
+from data_loaders import data_gen_standard as data_gen
+
+# inverse regularisation strengths, selected on the validation set (ridge uses alpha = 1 / C)
+C_VALUES = [0.001, 0.01, 0.1, 1, 10, 100, 1000]
+# logit of the classes without positive (or negative) training examples
+CONSTANT_LOGIT = 10.
+
+
+def track_patches(config, id, audio_repr_path, gt, patches=0):
+    # all the patches of a track (as `evaluate.py`), or `patches` random ones
+    if patches:
+        pack = [config, 'random', patches]
+    else:
+        pack = [config, 'overlap_sampling', config['xInput']]
+    return np.array([p['X'] for p in data_gen(id, audio_repr_path, gt, pack)], dtype='float32').reshape(
+        -1, config['xInput'] * config['yInput'])
+
+
+def design_matrix(config, ids, id2audio_repr_path, id2gt, patches=0):
+    # one row per track (the mean of its embeddings), or `patches` random patches per track
+    X, Y = [], []
+    for id in ids:
+        track = track_patches(config, id, id2audio_repr_path[id], id2gt[id], patches)
+        if not len(track):
+            continue
+        if not patches:
+            track = track.mean(axis=0, keepdims=True)
+        X.append(track)
+        Y += [id2gt[id]] * len(track)
+    return np.vstack(X), np.array(Y, dtype='float32')
+
+
+def fit(X, Y, C, solver='logistic', multilabel=True, jobs=None):
+    # returns the weights and biases of the logits
+    n_classes = Y.shape[1]
+    if solver == 'ridge':
+        model = Ridge(alpha=1 / C).fit(X, Y)
+        return model.coef_.T, model.intercept_
+
+    W, b = np.zeros((X.shape[1], n_classes)), np.zeros(n_classes)
+    if multilabel:
+        model = OneVsRestClassifier(LogisticRegression(C=C, max_iter=1000), n_jobs=jobs).fit(X, Y)
+        for i, estimator in enumerate(model.estimators_):
+            if hasattr(estimator, 'coef_'):
+                W[:, i], b[i] = estimator.coef_[0], estimator.intercept_[0]
+            else:  # a constant label
+                b[i] = CONSTANT_LOGIT if estimator.y_.any() else -CONSTANT_LOGIT
+    else:
+        model = LogisticRegression(C=C, max_iter=1000).fit(X, np.argmax(Y, axis=1))
+        b[:] = -CONSTANT_LOGIT
+        if len(model.classes_) == 2:
+            # softmax([-z / 2, z / 2]) is the probability of the binary model
+            W[:, model.classes_] = np.hstack([-model.coef_.T, model.coef_.T]) / 2
+            b[model.classes_] = np.hstack([-model.intercept_, model.intercept_]) / 2
+        else:
+            W[:, model.classes_], b[model.classes_] = model.coef_.T, model.intercept_
+    return W, b
+
+
+def predict(X, W, b, multilabel=True):
+    logits = X @ W + b
+    if multilabel:
+        return shared.sigmoid(logits)
+    logits -= logits.max(axis=1, keepdims=True)
+    return np.exp(logits) / np.exp(logits).sum(axis=1, keepdims=True)
+
+
+def perceptron_weights(W, b, units):
+    # the linear model as the perceptron (model 0): relu(z) - relu(-z) = z with the logits z in
+    # the first 2 * classes units of the coupling layer, and the others unused
+    dims, n_classes = W.shape
+    if units < 2 * n_classes:
+        raise ValueError('The linear probe needs `coupling_layer_units` >= 2 * `num_classes_dataset` ({}).'.format(
+            2 * n_classes))
+    hidden_kernel, hidden_bias = np.zeros((dims, units)), np.zeros(units)
+    hidden_kernel[:, :2 * n_classes] = np.hstack([W, -W])
+    hidden_bias[:2 * n_classes] = np.hstack([b, -b])
+    output_kernel = np.zeros((units, n_classes))
+    output_kernel[:2 * n_classes] = np.vstack([np.eye(n_classes), -np.eye(n_classes)])
+    return [hidden_kernel, hidden_bias, output_kernel, np.zeros(n_classes)]
+
+
+def export_model(config, W, b, model_folder):
+    # writes the checkpoint restored by `evaluate.py` and `predict.py`
+    graph = tf.Graph()
+    with graph.as_default():
+        train.tf_define_model_and_cost(config)
+        values = perceptron_weights(W, b, config['coupling_layer_units'])
+        sess = tf.Session(config=shared.session_config())
+        sess.run(tf.global_variables_initializer())
+        for variable, value in zip(tf.trainable_variables(), values):
+            variable.load(value.astype(variable.dtype.base_dtype.as_numpy_dtype), sess)
+        tf.train.Saver().save(sess, str(model_folder) + '/')
+        sess.close()
+
+
+if __name__ == '__main__':
+    # Fits the perceptron (model 0) on embedding features as a linear probe: the embeddings are
+    # aggregated per track (or a few patches are sampled) and a logistic or ridge regression is
+    # solved for every regularisation strength, keeping the best one on `gt_val`. The weights
+    # are stored as a trained perceptron, so `evaluate.py` works as after `train.py`.
+    parser = argparse.ArgumentParser()
+    parser.add_argument('config_file', help='configuration file')
+    parser.add_argument('--solver', choices=['logistic', 'ridge'], default='logistic')
+    parser.add_argument('-C', type=float, nargs='+', default=C_VALUES,
+                        help='inverse regularisation strengths to try')
+    parser.add_argument('-p', '--patches', type=int, default=0,
+                        help='random patches per training track. By default, the mean embedding of each track')
+    parser.add_argument('-j', '--jobs', type=int, default=-1, help='parallel jobs of the logistic solver')
+
+    args = parser.parse_args()
+
+    with open(args.config_file, 'r') as f:
+        config = json.load(f)
+    exp_dir = Path(config['exp_dir'])
+    data_dir = Path(config['data_dir'])
+    config = config['config_train']
+
+    config['xInput'] = config['feature_params']['xInput']
+    config['yInput'] = config['feature_params']['yInput']
+    if config['model_number'] != 0 or config['load_model'] is not None or config['xInput'] != 1:
+        raise ValueError('Linear probes are stored as the perceptron (`model_number` 0) on single frame embeddings.')
+    config['classes_vector'] = list(range(config['num_classes_dataset']))
+    multilabel = config['is_multilabel_task']
+
+    np.random.seed(seed=config['seed'])
+    start = time.time()
+
+    [_, id2audio_repr_path] = shared.load_id2path(data_dir / 'index_repr.tsv')
+    [ids_train, id2gt_train] = shared.load_id2gt(config['gt_train'])
+    [ids_val, id2gt_val] = shared.load_id2gt(config['gt_val'])
+
+    X_train, Y_train = design_matrix(config, ids_train, id2audio_repr_path, id2gt_train, args.patches)
+
+    # validation as in `evaluate.py`: predictions of all the patches averaged per track
+    val_patches, val_ids = [], []
+    for id in ids_val:
+        track = track_patches(config, id, id2audio_repr_path[id], id2gt_val[id])
+        val_patches.append(track)
+        val_ids += [id] * len(track)
+    X_val, val_ids = np.vstack(val_patches), np.array(val_ids)
+    print('Design matrix: {} x {} ({:.1f}s)'.format(*X_train.shape, time.time() - start))
+
+    # standardised features, folded into the weights afterwards
+    mean, std = X_train.mean(axis=0), X_train.std(axis=0) + 1e-8
+
+    results = []
+    for C in args.C:
+        W, b = fit((X_train - mean) / std, Y_train, C, solver=args.solver, multilabel=multilabel, jobs=args.jobs)
+        W, b = W / std[:, None], b - (mean / std) @ W
+        pred = predict(X_val, W, b, multilabel=multilabel)
+        y_true, y_pred, _ = shared.average_predictions(pred, val_ids, ids_val, id2gt_val)
+        score = shared.compute_auc(y_true, y_pred)[0] if multilabel else shared.compute_accuracy(y_true, y_pred)
+        print('C {:g}: validation {} {:.4f}'.format(C, 'ROC-AUC' if multilabel else 'accuracy', score))
+        results.append((score, C, W, b))
+    score, C, W, b = max(results, key=lambda r: r[0])
+
+    # same experiment layout as `train.py`
+    experiment_id = str(shared.get_epoch_time()) + config['feature_type']
+    model_folder = shared.make_experiment_folder(exp_dir / 'experiments', experiment_id)
+    experiment_id = model_folder.name
+
+    config['linear_probe'] = {'solver': args.solver, 'C': C, 'patches': args.patches}
+    json.dump(config, open(model_folder / 'config.json', 'w'))
+    export_model(config, W, b, model_folder)
+    with open(model_folder / 'linear_probe.tsv', 'w') as f:
+        f.write('C\tval_score\n')
+        for result in results:
+            f.write('%g\t%g\n' % result[:2])
+    with open(exp_dir / 'experiment_id_{}'.format(config['fold']), 'w') as f:
+        f.write(experiment_id)
+
+    print('Best C {:g} (validation {:.4f}), model saved in: {}'.format(C, score, model_folder))
+    print('It took {:.1f}s'.format(time.time() - start))
+    print('\nEVALUATE EXPERIMENT -> ' + experiment_id)
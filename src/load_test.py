@@ -0,0 +1,78 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import http.client
+import io
+import json
+import time
+from urllib.parse import urlparse
+
+import numpy as np
+
+# as `serve.py`, which is not imported to keep TensorFlow out of the clients
+NPY_CONTENT_TYPE = 'application/x-npy'
+
+
+def request_body(frames, y_input, audio=None, rng=np.random):
+    # an audio file (JSON) or random features (.npy) of `frames` frames
+    if audio:
+        return json.dumps({'audio': [audio]}).encode(), 'application/json'
+    buffer = io.BytesIO()
+    np.save(buffer, rng.rand(frames, y_input).astype('float32'))
+    return buffer.getvalue(), NPY_CONTENT_TYPE
+
+
+def run_client(url, bodies):
+    # sends the requests one after the other on a persistent connection, returns their latencies
+    connection = http.client.HTTPConnection(url.hostname, url.port)
+    latencies = []
+    for body, content_type in bodies:
+        start = time.perf_counter()
+        connection.request('POST', '/predict', body=body, headers={'Content-Type': content_type})
+        response = connection.getresponse()
+        answer = response.read()
+        latencies.append(time.perf_counter() - start)
+        if response.status != 200:
+            raise RuntimeError('Request failed ({}): {}'.format(response.status, answer.decode()))
+    connection.close()
+    return latencies
+
+
+if __name__ == '__main__':
+    # Sends requests to `serve.py` from several concurrent clients and reports the throughput
+    # and the latency percentiles.
+    # Example: python load_test.py http://127.0.0.1:8000 -n 2000 -c 16 --patches 4
+    parser = argparse.ArgumentParser()
+    parser.add_argument('url', help='address of the server')
+    parser.add_argument('-n', '--requests', type=int, default=1000, help='number of requests')
+    parser.add_argument('-c', '--clients', type=int, default=8, help='concurrent clients')
+    parser.add_argument('--patches', type=float, default=1, help='length of the tracks, in patches')
+    parser.add_argument('--audio', help='send this audio file instead of random features')
+    parser.add_argument('--warmup', type=int, default=10, help='requests sent before measuring')
+
+    args = parser.parse_args()
+
+    url = urlparse(args.url)
+    connection = http.client.HTTPConnection(url.hostname, url.port)
+    connection.request('GET', '/health')
+    health = json.loads(connection.getresponse().read())
+    connection.close()
+    print('Server: {}'.format(health))
+
+    rng = np.random.RandomState(0)
+    frames = int(args.patches * health['xInput'])
+    bodies = [request_body(frames, health['yInput'], audio=args.audio, rng=rng)
+              for _ in range(min(args.requests, 100))]
+    bodies = [bodies[i % len(bodies)] for i in range(args.requests)]
+
+    run_client(url, bodies[:args.warmup])
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.clients) as executor:
+        latencies = list(executor.map(lambda i: run_client(url, bodies[i::args.clients]), range(args.clients)))
+    duration = time.perf_counter() - start
+
+    latencies = np.hstack(latencies) * 1000
+    print('{} requests of {} frames, {} clients: {:.1f} requests/s'.format(
+        len(latencies), frames, args.clients, len(latencies) / duration))
+    print('latency (ms): mean {:.1f}, p50 {:.1f}, p95 {:.1f}, p99 {:.1f}, max {:.1f}'.format(
+        latencies.mean(), *np.percentile(latencies, [50, 95, 99]), latencies.max()))
@@ -57,9 +57,17 @@ def temporal_pooling(feature_map, is_training, num_classes_dataset, num_units_ba
 
     else:
         print('Max/Avg pooling')
-        max_pool = tf.reduce_max(feature_map, axis=1)
-        avg_pool, var_pool = tf.nn.moments(feature_map, axes=[1])
-        tmp_pool = tf.concat([max_pool, avg_pool], 1)
+        window = config.get('pooling_window')
+        if window:
+            # whole-track inference (see track_inference.py): the pooling is applied to windows of
+            # `window[0]` frames every `window[1]` frames, which are moved to the batch dimension
+            max_pool = tf.layers.max_pooling1d(feature_map, window[0], window[1])
+            avg_pool = tf.layers.average_pooling1d(feature_map, window[0], window[1])
+            tmp_pool = tf.reshape(tf.concat([max_pool, avg_pool], 2), [-1, 2 * int(feature_map.shape[2])])
+        else:
+            max_pool = tf.reduce_max(feature_map, axis=1)
+            avg_pool, var_pool = tf.nn.moments(feature_map, axes=[1])
+            tmp_pool = tf.concat([max_pool, avg_pool], 1)
 
     print('Temporal pooling: ' + str(tmp_pool.shape))
     # dense layer with dropout
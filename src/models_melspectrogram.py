@@ -0,0 +1,123 @@
+import numpy as np
+import tensorflow.compat.v1 as tf
+tf.disable_v2_behavior()
+
+# Mel-spectrogram front-ends computed inside the graph from waveform patches. The parameters
+# mirror Essentia's TensorflowInputMusiCNN and TensorflowInputVGGish, which are used to
+# precompute the `musicnn-melspectrogram` and `vggish-melspectrogram` features.
+MELSPECTROGRAMS = {
+    'musicnn': {
+        'sample_rate': 16000,
+        'frame_size': 512,
+        'hop_size': 256,
+        'fft_size': 512,
+        'number_bands': 96,
+        'low_frequency_bound': 0,
+        'high_frequency_bound': 8000,
+        'warping_formula': 'slaneyMel',
+        'weighting': 'linear',
+        'normalize': 'unit_tri',
+        'type': 'power',
+        'scale': 10000,
+        'shift': 1,
+        'log': 'log10',
+    },
+    'vggish': {
+        'sample_rate': 16000,
+        'frame_size': 400,
+        'hop_size': 160,
+        'fft_size': 512,
+        'number_bands': 64,
+        'low_frequency_bound': 125,
+        'high_frequency_bound': 7500,
+        'warping_formula': 'htkMel',
+        'weighting': 'warping',
+        'normalize': 'unit_max',
+        'type': 'magnitude',
+        'scale': 1,
+        'shift': 0.01,
+        'log': 'log',
+    },
+}
+
+
+def hz2mel(hz, warping_formula):
+    hz = np.asarray(hz, dtype='float64')
+    if warping_formula == 'htkMel':
+        return 1127.0 * np.log(1 + hz / 700.0)
+    elif warping_formula == 'slaneyMel':
+        # linear below 1 kHz and logarithmic above
+        f_sp, min_log_hz = 200.0 / 3, 1000.0
+        log_step = np.log(6.4) / 27.0
+        return np.where(hz < min_log_hz, hz / f_sp, min_log_hz / f_sp + np.log(np.maximum(hz, 1e-10) / min_log_hz) / log_step)
+    raise ValueError('Warping formula {} not implemented.'.format(warping_formula))
+
+
+def mel2hz(mel, warping_formula):
+    mel = np.asarray(mel, dtype='float64')
+    if warping_formula == 'htkMel':
+        return 700.0 * (np.exp(mel / 1127.0) - 1)
+    elif warping_formula == 'slaneyMel':
+        f_sp, min_log_hz = 200.0 / 3, 1000.0
+        min_log_mel = min_log_hz / f_sp
+        log_step = np.log(6.4) / 27.0
+        return np.where(mel < min_log_mel, mel * f_sp, min_log_hz * np.exp(log_step * (mel - min_log_mel)))
+    raise ValueError('Warping formula {} not implemented.'.format(warping_formula))
+
+
+def mel_filterbank(params):
+    # triangular filters as in Essentia's MelBands. With `linear` weighting the triangles
+    # are defined in Hz, and with `warping` weighting in the mel scale
+    spectrum_size = params['fft_size'] // 2 + 1
+    warping_formula = params['warping_formula']
+    mels = np.linspace(hz2mel(params['low_frequency_bound'], warping_formula),
+                       hz2mel(params['high_frequency_bound'], warping_formula),
+                       params['number_bands'] + 2)
+    band_frequencies = mel2hz(mels, warping_formula)
+    bin_frequencies = np.arange(spectrum_size) * (params['sample_rate'] / 2.0) / (spectrum_size - 1)
+
+    if params['weighting'] == 'warping':
+        band_frequencies, bin_frequencies = mels, hz2mel(bin_frequencies, warping_formula)
+
+    filterbank = np.zeros([spectrum_size, params['number_bands']])
+    for i in range(params['number_bands']):
+        low, center, high = band_frequencies[i:i + 3]
+        rising = (bin_frequencies >= low) & (bin_frequencies < center)
+        falling = (bin_frequencies >= center) & (bin_frequencies < high)
+        filterbank[rising, i] = (bin_frequencies[rising] - low) / (center - low)
+        filterbank[falling, i] = (high - bin_frequencies[falling]) / (high - center)
+
+        if params['normalize'] == 'unit_tri':
+            filterbank[:, i] *= 2.0 / (high - low)
+
+    return filterbank.astype('float32')
+
+
+def hann(size):
+    # symmetric (non-normalized) Hann window
+    return (0.5 - 0.5 * np.cos(2 * np.pi * np.arange(size) / (size - 1))).astype('float32')
+
+
+def number_of_frames(patch_samples, melspectrogram_type):
+    params = MELSPECTROGRAMS[melspectrogram_type]
+    return 1 + (patch_samples - params['frame_size']) // params['hop_size']
+
+
+def melspectrogram(audio, melspectrogram_type):
+    # audio: [batch, samples] float tensor. Returns [batch, frames, bands], where frame `k`
+    # starts at sample `k * hop_size` (no padding is applied).
+    params = MELSPECTROGRAMS[melspectrogram_type]
+
+    with tf.name_scope('melspectrogram'):
+        frames = tf.signal.frame(audio, params['frame_size'], params['hop_size'], axis=-1)
+        frames = frames * hann(params['frame_size'])
+        spectrum = tf.abs(tf.signal.rfft(frames, fft_length=[params['fft_size']]))
+        if params['type'] == 'power':
+            spectrum = tf.square(spectrum)
+
+        bands = tf.tensordot(spectrum, mel_filterbank(params), axes=1)
+        bands = params['scale'] * bands + params['shift']
+
+        if params['log'] == 'log10':
+            return tf.log(bands) / np.log(10.0)
+        return tf.log(bands)
@@ -9,6 +9,10 @@ import tf_slim as slim
 # disabling deprecation warnings (caused by change from tensorflow 1.x to 2.x)
 # tf.logging.set_verbosity(tf.logging.ERROR)
 
+# collection with the output of the frozen part of each model. It can be fed with
+# precomputed activations (see `cache_activations.py`) to train only the layers on top
+FROZEN_FEATURES = 'frozen_features'
+
 
 def define_model(x, is_training, config):
     model_num = config['model_number']
@@ -281,6 +285,7 @@ def backend(feature_map, is_training, num_classes, output_units, config, type):
     dense = tf.layers.dense(inputs=flat_pool_dropout, units=output_units, activation=tf.nn.relu, trainable=False)
     bn_dense = tf.layers.batch_normalization(dense, training=False, trainable=False)
     dense_dropout = tf.layers.dropout(bn_dense, rate=0.5, training=False)
+    tf.add_to_collection(FROZEN_FEATURES, dense_dropout)
 
     # output dense layer
     if not num_classes:
@@ -363,11 +368,14 @@ def vgg(x, is_training, num_classes, config, num_filters=32):
         name="5CNN",
         trainable=non_trainable,
     )
-    bn_conv5 = tf.layers.batch_normalization(conv5, training=is_training, trainable=non_trainable)
+    # the activations can only be cached if the last batchnorm uses its moving statistics
+    bn_training = False if config.get('activation_cache') else is_training
+    bn_conv5 = tf.layers.batch_normalization(conv5, training=bn_training, trainable=non_trainable)
     pool5 = tf.layers.max_pooling2d(inputs=bn_conv5, pool_size=[4, 4], strides=[4, 4])
 
     flat_pool5 = tf.layers.flatten(pool5)
     do_pool5 = tf.layers.dropout(flat_pool5, rate=0.5, training=non_trainable)
+    tf.add_to_collection(FROZEN_FEATURES, do_pool5)
 
     if not num_classes:
         return do_pool5
@@ -451,6 +459,7 @@ def define_vggish_slim(features_tensor, is_training, num_classes):
         net = slim.repeat(net, 2, slim.fully_connected, 4096, scope="fc1")
         # The embedding layer.
         embeddings = slim.fully_connected(net, EMBEDDING_SIZE, scope="fc2", activation_fn=None)
+        tf.add_to_collection(FROZEN_FEATURES, embeddings)
         # return tf.identity(embeddings, name='embeddings')
 
     # Add a classifier layer at the end, consisting of parallel logistic
@@ -525,6 +534,7 @@ def define_small_vggish_slim(features_tensor, is_training, num_classes):
         net = slim.repeat(net, 2, slim.fully_connected, 64, scope="fc1")
         # The embedding layer.
         embeddings = slim.fully_connected(net, EMBEDDING_SIZE, scope="fc2", activation_fn=None)
+        tf.add_to_collection(FROZEN_FEATURES, embeddings)
 
     # Add a classifier layer at the end, consisting of parallel logistic
     # classifiers, one per class. This allows for multi-class tasks.
@@ -8,19 +8,19 @@ import shared
 import tensorflow.compat.v1 as tf
 tf.disable_v2_behavior()
 
-import train
+from adaptive_inference import adaptive_prediction
+from data_loaders import patch_batches
+from ensemble import Ensemble, is_frozen, variable_length_config
+import track_inference
 from tqdm import tqdm
 
 TEST_BATCH_SIZE = 64
 
 
-def prediction(batch_dispatcher, tf_vars):
+def prediction(batch_dispatcher, ensemble):
     pred_list, id_list = [], []
-    [sess, normalized_y, cost, x, y_, is_train] = tf_vars
     for batch in tqdm(batch_dispatcher):
-        pred, _ = sess.run([normalized_y, cost], feed_dict={x: batch['X'],
-                                                            y_: batch['Y'],
-                                                            is_train: False})
+        pred = ensemble.predict(batch['X'])
 
         id_list.append(batch['ID'])
         pred_list.append(pred)
@@ -32,6 +32,21 @@ def prediction(batch_dispatcher, tf_vars):
     return pred_array, id_array
 
 
+def frozen_model_config(pb_file):
+    # written next to the graph by `freeze_model.py`, or the configuration it was frozen from
+    config_file = os.path.splitext(pb_file)[0] + '.json'
+    if os.path.exists(config_file):
+        return json.load(open(config_file))
+
+    config = json.load(open(os.path.join(os.path.dirname(pb_file), 'config_whole.json')))['config_train']
+    config['xInput'] = config['feature_params']['xInput']
+    if 'audio_representation_dirs' in config:
+        config['yInput'] = sum([i['yInput'] for i in config['features_params']])
+    else:
+        config['yInput'] = config['feature_params']['yInput']
+    return config
+
+
 if __name__ == '__main__':
     # which experiment we want to evaluate?
     # Use the -l functionality to ensamble models: python arg.py -l 1234 2345 3456 4567
@@ -41,7 +56,9 @@ if __name__ == '__main__':
     parser.add_argument('model_dir')
     parser.add_argument('data_dir')
     parser.add_argument('predictions_file')
-    parser.add_argument('-l', '--list', nargs='+', help='List of models to evaluate', required=True)
+    parser.add_argument('-l', '--list', nargs='+', required=True,
+                        help='List of models (experiment ids or frozen .pb graphs, relative to model_dir) to evaluate')
+    parser.add_argument('-w', '--weights', type=float, nargs='+', help='weights of the models of the ensemble')
     parser.add_argument(
         '--data-dirs',
         nargs='+',
@@ -83,9 +100,13 @@ if __name__ == '__main__':
     print('{} ids found in the groundtruth file'.format(len(gt_ids)))
     print('using {} intersecting ids'.format(len(ids)))
 
+    experiment_folders, configs = [], []
     for model in models:
         experiment_folder = os.path.join(model_dir, str(model))
-        config = json.load(open(os.path.join(experiment_folder, 'config.json')))
+        if is_frozen(experiment_folder):
+            config = frozen_model_config(experiment_folder)
+        else:
+            config = json.load(open(os.path.join(experiment_folder, 'config.json')))
 
         if feature_combination:
             config['audio_representation_dirs'] = data_dirs
@@ -94,33 +115,56 @@ if __name__ == '__main__':
 
         print('Experiment: ' + str(model))
         print('\n' + str(config))
-
-        # pescador: define (finite, batched & parallel) streamer
-        pack = [config, 'overlap_sampling', config['xInput']]
-        streams = [pescador.Streamer(data_gen, id, id2audio_repr_path[id], [0] * config['num_classes_dataset'], pack) for id in ids]
+        experiment_folders.append(experiment_folder)
+        configs.append(config)
+
+    # the features are read once, and every batch is predicted by all the models
+    config = configs[0]
+
+    # patches every `inference_hop` frames (by default, not overlapping)
+    hop = config.get('inference_hop') or config['xInput']
+    batch_size = config.get('test_batch_size', TEST_BATCH_SIZE)
+    id2gt = {id: [0] * config['num_classes_dataset'] for id in ids}
+
+    if track_inference.shares_patches(config):
+        # the models run once over chunks of patches of every track, see `track_inference.py`
+        batch_streamer = track_inference.track_streamer(config, data_gen, ids, id2audio_repr_path, id2gt)
+        ensemble = track_inference.TrackEnsemble(configs, experiment_folders, hop,
+                                                 chunk_windows=config.get('inference_chunk_windows',
+                                                                          track_inference.CHUNK_WINDOWS),
+                                                 weights=args.weights, batch_size=batch_size)
+        pred_array, id_array = track_inference.predict_tracks(batch_streamer, ensemble)
+    elif config.get('adaptive_inference_tolerance') is not None:
+        # only the patches needed for the mean of each track to settle, see `adaptive_inference.py`.
+        # The patches used per track are stored next to the predictions
+        batch_streamer = track_inference.track_streamer(config, data_gen, ids, id2audio_repr_path, id2gt)
+        ensemble = Ensemble(configs, experiment_folders, weights=args.weights)
+        pred_array, id_array, patches_used = adaptive_prediction(batch_streamer, ensemble, config,
+                                                                 config['adaptive_inference_tolerance'])
+        with open(os.path.splitext(predictions_file)[0] + '_patches.json', 'w') as f:
+            json.dump({id: int(n) for id, n in patches_used.items()}, f)
+    else:
+        # pescador: define (finite, batched & parallel) streamer. The tracks are read whole and
+        # their patches fill the batches (short tracks at their length with `variable_length_inference`)
+        variable_length = config.get('variable_length_inference', False)
+        pack = [config, 'whole_track', None]
+        streams = [pescador.Streamer(data_gen, id, id2audio_repr_path[id], id2gt[id], pack) for id in ids]
         mux_stream = pescador.ChainMux(streams, mode='exhaustive')
-        batch_streamer = pescador.Streamer(pescador.buffer_stream, mux_stream, buffer_size=TEST_BATCH_SIZE, partial=True)
+        batch_streamer = pescador.Streamer(patch_batches, mux_stream, config['xInput'], hop, batch_size,
+                                           variable_length=variable_length)
         batch_streamer = pescador.ZMQStreamer(batch_streamer)
 
-        # tensorflow: define model and cost
-        graph = tf.Graph()
-        with graph.as_default():
-            sess = tf.Session()
-
-            [x, y_, is_train, y, normalized_y, cost, model_vars] = train.tf_define_model_and_cost(config)
-            sess.run(tf.global_variables_initializer())
-
-            saver = tf.train.Saver()
-            results_folder = experiment_folder + '/'
-            saver.restore(sess, results_folder)
-            tf_vars = [sess, normalized_y, cost, x, y_, is_train]
-
-            pred_array, id_array = prediction(batch_streamer, tf_vars)
-            sess.close()
+        # tensorflow: one graph and session per model
+        if variable_length:
+            configs = [variable_length_config(config) for config in configs]
+        ensemble = Ensemble(configs, experiment_folders, weights=args.weights)
+        pred_array, id_array = prediction(batch_streamer, ensemble)
+    ensemble.close()
 
     print('Predictions computed, now evaluating..')
 
-    y_pred, n_ids = shared.average_predictions_ids(pred_array, id_array, ids)
+    y_pred, n_ids = shared.average_predictions_ids(pred_array, id_array, ids,
+                                                   pooling=config.get('prediction_pooling', 'mean'))
 
     print('len y_pred: ', len(y_pred))
     print('len n_ids: ', len(n_ids))
@@ -1,12 +1,53 @@
 import argparse
+from collections import defaultdict, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+import hashlib
+import io
 import json
+import multiprocessing
+import os
 from pathlib import Path
+import shutil
+import tarfile
+import tempfile
+import uuid
+import zipfile
 
 import numpy as np
 from tqdm import tqdm
 
 from feature_melspectrogram import MelSpectrogramMusiCNN, MelSpectrogramVGGish
 
+# an audio file stored inside a .zip or .tar archive (or an archive split in parts)
+ArchiveMember = namedtuple('ArchiveMember', ['archive', 'member'])
+
+# rows are cast and written in chunks of about this size to keep memory usage bounded
+WRITE_CHUNK_BYTES = 2 ** 22
+
+
+def write_audio_repr(batches, audio_repr_file, dtype='float16'):
+    # Stream the extractor output to disk. Each chunk is cast on the fly, so no full-size
+    # copies of the representation are made. The data is written to a temporary file that
+    # is renamed at the end, so an interrupted run never leaves a truncated .dat behind.
+    # Each writer has its own temporary file: workers computing the same content-addressed
+    # file at the same time replace it with identical data.
+    tmp_file = audio_repr_file.with_name('{}.{}-{}.tmp'.format(audio_repr_file.name, os.getpid(), uuid.uuid4().hex))
+    length = 0
+    try:
+        with open(tmp_file, 'wb') as f:
+            for batch in batches:
+                batch = np.atleast_2d(batch)
+                chunk_rows = max(1, WRITE_CHUNK_BYTES // max(1, batch[0].nbytes))
+                for start in range(0, batch.shape[0], chunk_rows):
+                    batch[start:start + chunk_rows].astype(dtype, copy=False).tofile(f)
+                length += batch.shape[0]
+        os.replace(tmp_file, audio_repr_file)
+    except BaseException:
+        if tmp_file.exists():
+            os.remove(tmp_file)
+        raise
+    return length
+
 
 def compute_audio_repr(audio_file, audio_repr_file, extractor, force=False):
     if not force:
@@ -14,54 +55,194 @@ def compute_audio_repr(audio_file, audio_repr_file, extractor, force=False):
             print('{} exists. skipping!'.format(audio_repr_file))
             return 0
 
-    audio_repr = extractor.compute(audio_file)
+    # extractors that work in batches (e.g., the embedding models) can hand them over
+    # as they are computed instead of stacking the whole track in memory
+    if hasattr(extractor, 'compute_batches'):
+        batches = extractor.compute_batches(audio_file)
+    else:
+        batches = [extractor.compute(audio_file)]
+
+    # Transform to float16 (to save storage, and works the same) while writing.
+    # Extractors can ask for other storage types (e.g., int16 for waveforms)
+    return write_audio_repr(batches, audio_repr_file, dtype=getattr(extractor, 'dtype', 'float16'))
 
-    # Compute length
-    length = audio_repr.shape[0]
 
-    # Transform to float16 (to save storage, and works the same)
-    audio_repr = audio_repr.astype(np.float16)
+def hash_file(path, block_size=2 ** 20):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
 
-    # Write results:
-    fp = np.memmap(audio_repr_file, dtype='float16', mode='w+', shape=audio_repr.shape)
-    fp[:] = audio_repr[:]
-    del fp
-    return length
 
+def extractor_signature(feature_type, extractor):
+    # features computed with different extractor settings must not share a cache entry,
+    # so the simple-valued attributes of the extractor are part of the cache key
+    params = {k: v for k, v in vars(extractor).items() if isinstance(v, (bool, int, float, str))}
+    digest = hashlib.sha1(json.dumps([feature_type, params], sort_keys=True).encode()).hexdigest()
+    return '{}-{}'.format(feature_type, digest[:8])
 
-def do_process(files, index, extractor, audio_representation_dir):
+
+def content_addressed_path(audio_file, cache_dir, signature):
+    # duplicated audio under different ids gets the same path, so it is only computed once
+    digest = hash_file(audio_file)
+    return Path(cache_dir, signature, digest[:2], digest + '.dat')
+
+
+def index_path(audio_repr_file, audio_representation_dir):
+    # data loaders join this path with `audio_representation_dir`, so absolute paths
+    # (e.g., features stored in a cache shared across datasets) are also valid
     try:
-        [id, audio_file, audio_repr_file] = files[index]
+        return audio_repr_file.relative_to(audio_representation_dir)
+    except ValueError:
+        return audio_repr_file.resolve()
+
+
+class SplitFile(io.RawIOBase):
+    # Read-only, seekable view of an archive split in several parts
+    # (e.g., `mp3.zip.001`, `mp3.zip.002`, ... as MagnaTagATune is distributed).
+    def __init__(self, parts):
+        self.parts = [open(p, 'rb') for p in parts]
+        self.offsets = np.cumsum([0] + [os.path.getsize(p) for p in parts])
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += int(self.offsets[-1])
+        self.position = max(0, offset)
+        return self.position
+
+    def readinto(self, buffer):
+        part = int(np.searchsorted(self.offsets, self.position, side='right')) - 1
+        if part >= len(self.parts):
+            return 0
+        f = self.parts[part]
+        f.seek(self.position - int(self.offsets[part]))
+        n = f.readinto(buffer)
+        self.position += n
+        return n
+
+    def close(self):
+        for f in self.parts:
+            f.close()
+        super().close()
+
+
+def archive_parts(path):
+    # an archive is either a single file or a set of parts named `<path>.001`, `<path>.002`, ...
+    path = Path(path)
+    if path.is_file():
+        return [path]
+    return sorted(path.parent.glob(path.name + '.[0-9]*'))
+
+
+def is_archive(path):
+    if Path(path).is_dir():
+        return False
+    parts = archive_parts(path)
+    if len(parts) > 1:
+        return True
+    return len(parts) == 1 and (zipfile.is_zipfile(parts[0]) or tarfile.is_tarfile(parts[0]))
+
+
+def iter_archive(archive):
+    # Yields (member name, file object) in storage order. The archive is read sequentially,
+    # which is also the only efficient way to read compressed tarballs.
+    parts = archive_parts(archive)
+    if len(parts) > 1 or zipfile.is_zipfile(parts[0]):
+        with io.BufferedReader(SplitFile(parts)) as f, zipfile.ZipFile(f) as zf:
+            for info in zf.infolist():
+                if not info.is_dir():
+                    with zf.open(info) as member:
+                        yield info.filename, member
+    else:
+        with tarfile.open(parts[0], mode='r|*') as tf:
+            for info in tf:
+                if info.isfile():
+                    yield info.name, tf.extractfile(info)
+
+
+def member_name(name):
+    return name[2:] if name.startswith('./') else name
+
+
+def iter_jobs(files, tmp_dir):
+    # Groups the files by audio source. Archive members are spooled to a temporary file
+    # (the decoders need a file name) that is removed once its job has been processed.
+    plain, archives = defaultdict(list), defaultdict(lambda: defaultdict(list))
+    for id, src, audio_repr_file in files:
+        if isinstance(src, ArchiveMember):
+            archives[src.archive][member_name(src.member)].append((id, audio_repr_file))
+        else:
+            plain[src].append((id, audio_repr_file))
+
+    for src, targets in plain.items():
+        yield targets, src, src, '', False
+
+    for archive, members in archives.items():
+        for member, f in iter_archive(archive):
+            targets = members.pop(member_name(member), None)
+            if not targets:
+                continue
+            with tempfile.NamedTemporaryFile(suffix=Path(member).suffix, dir=tmp_dir, delete=False) as tmp:
+                shutil.copyfileobj(f, tmp)
+            yield targets, tmp.name, archive, member, True
 
+        for member in members:
+            print('"{}" not found in {}'.format(member, archive))
+
+
+def do_process(id, audio_file, audio_repr_file, extractor, audio_representation_dir,
+               cache_dir=None, signature=None, source=None, member=''):
+    # `source` and `member` describe where the audio comes from (e.g., an archive and the
+    # archive member) when `audio_file` is only a temporary copy
+    source = source or audio_file
+    try:
+        if cache_dir:
+            audio_repr_file = content_addressed_path(audio_file, cache_dir, signature)
         audio_repr_file = Path(audio_repr_file)
         audio_repr_file.parent.mkdir(parents=True, exist_ok=True)
         # compute audio representation (pre-processing)
         compute_audio_repr(audio_file, audio_repr_file, extractor)
+        audio_repr_path = index_path(audio_repr_file, audio_representation_dir)
         # index.tsv writing
         fw = open(audio_representation_dir / "index.tsv", "a")
-        fw.write("%s\t%s\n" % (id, audio_repr_file.relative_to(audio_representation_dir)))
+        fw.write("%s\t%s\n" % (id, audio_repr_path))
         fw.close()
-        print(str(index) + '/' + str(len(files)) + ' Computed: %s' % audio_file)
+        # manifest.tsv writing: provenance of every representation
+        fw = open(audio_representation_dir / "manifest.tsv", "a")
+        fw.write("%s\t%s\t%s\t%s\n" % (id, source, member, audio_repr_path))
+        fw.close()
+        print('Computed: %s %s' % (source, member))
 
     except Exception as e:
         ferrors = open(audio_representation_dir / "errors.txt", "a")
-        ferrors.write(audio_file + "\n")
+        ferrors.write("%s %s\n" % (source, member))
         ferrors.write(str(e))
         ferrors.close()
-        print('Error computing audio representation: ', audio_file)
+        print('Error computing audio representation: ', source, member)
         print(str(e))
 
 
-def process_files(files, audio_representation_dir, feature_type=None, config=None):
-
-    assert feature_type or config, "At least one shoud be provided."
-
-    # it not provided explicitly read it from the config
-    if not feature_type:
-        feature_type = config['config_train']['feature_type']
+def get_extractor(feature_type, from_melspectrogram=False, feature_params=None):
+    # `feature_params` are passed to the extractors that are configurable (e.g., the
+    # sample rate and storage type of the waveform)
+    feature_params = feature_params or dict()
 
     if feature_type == 'waveform':
-        extractor = None
+        from feature_waveform import Waveform
+        extractor = Waveform(**feature_params)
     elif feature_type == 'musicnn-melspectrogram':
         extractor = MelSpectrogramMusiCNN()
     elif feature_type == 'vggish-melspectrogram':
@@ -71,7 +252,8 @@ def process_files(files, audio_representation_dir, feature_type=None, config=Non
     # features `essentia` but the embeddings require `essentia-tensorflow`
     elif feature_type in ('effnet_b0', 'musicnn', 'openl3', 'tempocnn', 'vggish', 'yamnet'):
         from feature_embeddings import EmbeddingFromMelSpectrogram
-        extractor = EmbeddingFromMelSpectrogram(feature_type)
+        # the sources can be mel-spectrogram .dat files instead of audio files
+        extractor = EmbeddingFromMelSpectrogram(feature_type, from_melspectrogram=from_melspectrogram)
 
     elif feature_type == 'spleeter':
         from feature_embeddings import EmbeddingFromWaveform
@@ -80,8 +262,86 @@ def process_files(files, audio_representation_dir, feature_type=None, config=Non
     else:
         raise NotImplementedError('Feature {} not implemented.'.format(feature_type))
 
-    for index in tqdm(range(0, len(files))):
-        do_process(files, index, extractor, audio_representation_dir)
+    if from_melspectrogram and not getattr(extractor, 'from_melspectrogram', False):
+        raise ValueError('Feature {} can not be computed from stored mel-spectrograms.'.format(feature_type))
+
+    return extractor
+
+
+def extractor_params(config):
+    # the `feature_params` of the extractor of `config['config_train']['feature_type']`
+    if config['config_train']['feature_type'] == 'waveform':
+        waveform = config['config_preprocess'].get('waveform', dict())
+        return {'sample_rate': waveform.get('resample_sr', 16000), 'dtype': waveform.get('dtype', 'int16')}
+    return None
+
+
+# state of each worker process, set by `init_worker`
+worker = dict()
+
+
+def init_worker(feature_type, from_melspectrogram, feature_params, audio_representation_dir, cache_dir):
+    worker['extractor'] = get_extractor(feature_type, from_melspectrogram=from_melspectrogram,
+                                        feature_params=feature_params)
+    worker['audio_representation_dir'] = audio_representation_dir
+    worker['cache_dir'] = cache_dir
+    worker['signature'] = extractor_signature(feature_type, worker['extractor']) if cache_dir else None
+
+
+def process_job(job):
+    targets, audio_file, source, member, is_tmp = job
+    try:
+        for id, audio_repr_file in targets:
+            do_process(id, audio_file, audio_repr_file, worker['extractor'], worker['audio_representation_dir'],
+                       cache_dir=worker['cache_dir'], signature=worker['signature'], source=source, member=member)
+    finally:
+        if is_tmp:
+            os.remove(audio_file)
+
+
+def process_files(files, audio_representation_dir, feature_type=None, config=None, cache_dir=None,
+                  from_melspectrogram=False, n_jobs=1, feature_params=None):
+    # `files` is a list of (id, audio source, audio representation file). The audio source is
+    # either a path or an `ArchiveMember` that is read without unpacking the archive.
+
+    assert feature_type or config, "At least one shoud be provided."
+
+    # it not provided explicitly read it from the config
+    if not feature_type:
+        feature_type = config['config_train']['feature_type']
+
+    # content-addressed mode: features are stored once per audio content and extractor setup
+    init_args = (feature_type, from_melspectrogram, feature_params, audio_representation_dir, cache_dir)
+
+    # built here first, so that an unknown or unsupported feature fails with its own error
+    init_worker(*init_args)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        jobs = iter_jobs(files, tmp_dir)
+        progress = tqdm(total=len(files))
+
+        if n_jobs == 1:
+            for job in jobs:
+                process_job(job)
+                progress.update(len(job[0]))
+        else:
+            # the archives are read by this process while the workers decode and extract the
+            # features. Limit the jobs in flight to bound the disk used by the temporary files.
+            # The workers are spawned, not forked from this process and its TensorFlow models
+            with ProcessPoolExecutor(n_jobs, mp_context=multiprocessing.get_context('spawn'),
+                                     initializer=init_worker, initargs=init_args) as executor:
+                pending = dict()
+                for job in jobs:
+                    if len(pending) >= 2 * n_jobs:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            future.result()  # raise the errors of the workers
+                            progress.update(pending.pop(future))
+                    pending[executor.submit(process_job, job)] = len(job[0])
+                for future in as_completed(pending):
+                    future.result()
+                    progress.update(pending[future])
+        progress.close()
 
 
 if __name__ == '__main__':
@@ -96,16 +356,32 @@ if __name__ == '__main__':
     # set audio representations folder
     audio_representation_dir.mkdir(parents=True, exist_ok=True)
 
+    # embeddings can be computed from previously stored mel-spectrograms instead of audio
+    melspectrogram_dir = config['config_preprocess'].get('melspectrogram_dir')
+
+    # the audio can also be read from a .zip/.tar archive without unpacking it
+    audio_archive = config['config_preprocess']['audio_dir']
+    if not is_archive(audio_archive):
+        audio_archive = None
+
     # list audios to process: according to 'index_file'
     files_to_convert = []
     f = open(Path(config['data_dir'], config['config_preprocess']['index_audio_file']))
     for line in f.readlines():
         id, audio = line.strip().split("\t")
         audio_repr = audio[:audio.rfind(".")] + ".dat" # .npy or .pk
-        files_to_convert.append((id, str(Path(config['config_preprocess']['audio_dir'], audio)),
-                                 str(audio_representation_dir / audio_repr)))
+        if melspectrogram_dir:
+            src = str(Path(melspectrogram_dir, audio_repr))
+        elif audio_archive:
+            src = ArchiveMember(audio_archive, audio)
+        else:
+            src = str(Path(config['config_preprocess']['audio_dir'], audio))
+        files_to_convert.append((id, src, str(audio_representation_dir / audio_repr)))
 
     # compute audio representation
-    process_files(files_to_convert, audio_representation_dir, config=config)
+    cache_dir = config['config_preprocess'].get('cache_dir')
+    n_jobs = config['config_preprocess'].get('num_processing_units', 1)
+    process_files(files_to_convert, audio_representation_dir, config=config, cache_dir=cache_dir,
+                  from_melspectrogram=bool(melspectrogram_dir), n_jobs=n_jobs, feature_params=extractor_params(config))
 
     print("Audio representation folder: ", audio_representation_dir)
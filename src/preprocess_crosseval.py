@@ -1,18 +1,19 @@
 from pathlib import Path
 import argparse
 
-from preprocess import process_files
+from preprocess import ArchiveMember, is_archive, process_files
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('index_file', help='index file')
-    parser.add_argument('audio_dir', help='input audio folder')
+    parser.add_argument('audio_dir', help='input audio folder, or a .zip/.tar archive (possibly split in parts)')
     parser.add_argument('data_dir', help='output data file')
     parser.add_argument('--feature-type', '-ft', default='musicnn-melspectrogram',
                         choices=[
                             'musicnn-melspectrogram',
                             'vggish-melspectrogram',
+                            'waveform',
                             'musicnn',
                             'vggish',
                             'openl3',
@@ -22,12 +23,28 @@ if __name__ == '__main__':
                             'yamnet'
                         ],
                         help='input feature type')
+    parser.add_argument('--cache-dir', help=('store the features by audio content hash in this folder. '
+                                             'Duplicated audio is computed once and the cache can be '
+                                             'shared across datasets'))
+    parser.add_argument('--from-melspectrogram', metavar='MELSPECTROGRAM_DIR',
+                        help=('compute the embeddings from the mel-spectrogram .dat files in this folder '
+                              '(as stored by `musicnn-melspectrogram` or `vggish-melspectrogram`) '
+                              'instead of decoding the audio again'))
+    parser.add_argument('--sample-rate', type=int, default=16000, help='sample rate of the waveform feature')
+    parser.add_argument('--waveform-dtype', default='int16', choices=['int16', 'float16'],
+                        help='storage type of the waveform feature')
+    parser.add_argument('--n-jobs', '-j', type=int, default=1, help='number of worker processes')
     args = parser.parse_args()
 
     index_file = args.index_file
     audio_dir = Path(args.audio_dir)
     data_dir = Path(args.data_dir)
     feature_type = args.feature_type
+    audio_archive = is_archive(audio_dir)
+
+    feature_params = None
+    if feature_type == 'waveform':
+        feature_params = {'sample_rate': args.sample_rate, 'dtype': args.waveform_dtype}
 
     # set audio representations folder
     data_dir.mkdir(exist_ok=True, parents=True)
@@ -42,8 +59,15 @@ if __name__ == '__main__':
         id, audio_path = line.strip().split("\t")
         audio_repr = Path(audio_path).with_suffix(".dat")
         tgt = str(data_dir / audio_repr)
-        src = str(audio_dir / audio_path)
+        if args.from_melspectrogram:
+            src = str(Path(args.from_melspectrogram, audio_repr))
+        elif audio_archive:
+            src = ArchiveMember(str(audio_dir), audio_path)
+        else:
+            src = str(audio_dir / audio_path)
 
         files_to_convert.append((id, src, tgt))
 
-    process_files(files_to_convert, data_dir, feature_type=feature_type)
+    process_files(files_to_convert, data_dir, feature_type=feature_type, cache_dir=args.cache_dir,
+                  from_melspectrogram=bool(args.from_melspectrogram), n_jobs=args.n_jobs,
+                  feature_params=feature_params)
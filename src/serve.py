@@ -0,0 +1,226 @@
+import argparse
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import json
+from pathlib import Path
+import queue
+import threading
+import time
+
+import numpy as np
+
+import data_loaders
+from ensemble import Ensemble, is_frozen
+import shared
+
+TEST_BATCH_SIZE = 64
+# the requests that arrive while a batch is predicted share the next one anyway. Waiting for more
+# only pays off when larger batches are much cheaper per patch (e.g., on a GPU)
+MAX_LATENCY_MS = 0
+NPY_CONTENT_TYPE = 'application/x-npy'
+
+
+def feature_patches(features, config, hop):
+    # the patches of `overlap_sampling` of a track that is not stored: the features are rounded
+    # to their storage type, zero-padded to a patch and compressed as by `data_gen_standard`.
+    # Integer features are stored values (e.g., int16 waveforms), float ones are already scaled
+    dtype = config['feature_params'].get('dtype', 'float16')
+    features = np.asarray(features)
+    if np.dtype(dtype) == np.int16 and not np.issubdtype(features.dtype, np.integer):
+        # as stored by `feature_waveform.Waveform`
+        features = np.clip(np.round(features * data_loaders.INT16_SCALE), -data_loaders.INT16_SCALE,
+                           data_loaders.INT16_SCALE - 1)
+    features = data_loaders.to_float(features.astype(dtype), dtype=dtype)
+    if features.ndim != 2 or features.shape[1] != config['yInput']:
+        raise ValueError('Features of shape [frames, {}] expected, got {}.'.format(config['yInput'], features.shape))
+    if len(features) < config['xInput']:
+        features = np.vstack([features, np.zeros([config['xInput'] - len(features), config['yInput']])])
+    features = data_loaders.compress(features, compression=config['feature_params']['compression'])
+    return data_loaders.overlap_patches(features, config['xInput'], hop)
+
+
+class RequestBatcher:
+    # Coalesces the tracks of concurrent requests into shared batches. A batch is predicted once it
+    # has `batch_size` patches or when its first track has waited `max_latency` seconds; then the
+    # predictions of the patches of every track are pooled. `submit` returns a future of them
+    def __init__(self, models, batch_size, max_latency, pooling='mean'):
+        self.models = models
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.pooling = pooling
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, patches):
+        future = Future()
+        self.queue.put((patches, future, time.monotonic()))
+        return future
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _collect(self, first):
+        tracks, patches = [first], len(first[0])
+        deadline = first[2] + self.max_latency
+        while patches < self.batch_size:
+            try:
+                track = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if track is None:
+                self.queue.put(None)  # stop after this batch
+                break
+            tracks.append(track)
+            patches += len(track[0])
+        return tracks
+
+    def _run(self):
+        while True:
+            first = self.queue.get()
+            if first is None:
+                return
+            tracks = self._collect(first)
+
+            try:
+                X = np.concatenate([patches for patches, _, _ in tracks])
+                pred = np.vstack([self.models.predict(X[i:i + self.batch_size])
+                                  for i in range(0, len(X), self.batch_size)])
+                track_ids = np.repeat(np.arange(len(tracks)), [len(patches) for patches, _, _ in tracks])
+                pooled = shared.pool_predictions(pred, track_ids, range(len(tracks)), pooling=self.pooling)
+            except Exception as e:
+                for _, future, _ in tracks:
+                    future.set_exception(e)
+                continue
+            for (_, future, _), track_pred in zip(tracks, pooled):
+                future.set_result(track_pred)
+
+
+class TaggingServer(ThreadingHTTPServer):
+    # Keeps the models and the feature extractors warm between requests
+    daemon_threads = True
+
+    def __init__(self, address, config, batcher, hop, extractor_config=None, verbose=False):
+        super().__init__(address, RequestHandler)
+        self.config = config
+        self.batcher = batcher
+        self.hop = hop
+        self.extractor_config = extractor_config
+        self.verbose = verbose
+        # extractors are not thread-safe: each one is used by one request at a time
+        self.extractors = queue.Queue()
+
+    def extract(self, audio_file):
+        try:
+            extractor = self.extractors.get_nowait()
+        except queue.Empty:
+            if self.extractor_config is None:
+                raise ValueError('The server was started without feature extraction (--no_audio).')
+            from preprocess import extractor_params, get_extractor
+            extractor = get_extractor(self.config['feature_type'],
+                                      feature_params=extractor_params(self.extractor_config))
+        try:
+            return extractor.compute(audio_file)
+        finally:
+            self.extractors.put(extractor)
+
+    def predict(self, tracks):
+        futures = [self.batcher.submit(feature_patches(features, self.config, self.hop)) for features in tracks]
+        return [future.result() for future in futures]
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    # GET /health: the patch parameters of the models
+    # POST /predict: a JSON object with a list of `audio` files or of `features` ([frames, yInput]
+    # arrays), or a single track as a .npy body (`Content-Type: application/x-npy`). The answer
+    # is the list of the tag probabilities of every track: {"predictions": [[...], ...]}
+    protocol_version = 'HTTP/1.1'
+    # the headers and the body are written separately: without TCP_NODELAY, Nagle's algorithm
+    # and delayed acknowledgements add tens of milliseconds to every answer
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        if self.path != '/health':
+            return self._send(404, {'error': 'Unknown path {}'.format(self.path)})
+        config = self.server.config
+        self._send(200, {'xInput': config['xInput'], 'yInput': config['yInput'], 'hop': self.server.hop,
+                         'num_classes_dataset': config['num_classes_dataset']})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            return self._send(404, {'error': 'Unknown path {}'.format(self.path)})
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if self.headers.get('Content-Type') == NPY_CONTENT_TYPE:
+                tracks = [np.load(io.BytesIO(body), allow_pickle=False)]
+            else:
+                request = json.loads(body)
+                tracks = [self.server.extract(audio_file) for audio_file in request.get('audio', [])]
+                tracks += [np.array(features) for features in request.get('features', [])]
+            predictions = self.server.predict(tracks)
+        except (ValueError, KeyError, OSError) as e:
+            return self._send(400, {'error': str(e)})
+        except Exception as e:  # e.g., a failing model
+            return self._send(500, {'error': repr(e)})
+        self._send(200, {'predictions': [pred.astype('float64').tolist() for pred in predictions]})
+
+    def _send(self, code, answer):
+        body = json.dumps(answer).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+if __name__ == '__main__':
+    # Serves the tag probabilities of the listed models over HTTP, keeping them loaded. The
+    # tracks of concurrent requests share the batches, waiting at most --max_latency_ms for
+    # other requests to fill them. See `load_test.py` for the latency under load.
+    # Example: python serve.py ../configs/config_0.json -l 1563524626spec --port 8000
+    parser = argparse.ArgumentParser()
+    parser.add_argument('config_file', help='configuration file')
+    parser.add_argument('-l', '--list', nargs='+', required=True,
+                        help='List of models (experiment ids or frozen .pb graphs) to serve as an ensemble')
+    parser.add_argument('-w', '--weights', type=float, nargs='+', help='weights of the models of the ensemble')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max_latency_ms', type=float, default=MAX_LATENCY_MS,
+                        help='time a track waits for other requests to fill its batch')
+    parser.add_argument('--no_audio', action='store_true', help='only accept features, not audio files')
+    parser.add_argument('-v', '--verbose', action='store_true', help='log every request')
+
+    args = parser.parse_args()
+
+    with open(args.config_file, 'r') as f:
+        full_config = json.load(f)
+    config = full_config['config_train']
+
+    # set patch parameters
+    config['xInput'] = config['feature_params']['xInput']
+    if 'audio_representation_dirs' in config:
+        raise ValueError('The server computes a single feature type, not feature combinations.')
+    config['yInput'] = config['feature_params']['yInput']
+
+    experiment_folders = [Path(model) if is_frozen(model) else Path(full_config['exp_dir'], 'experiments', str(model))
+                          for model in args.list]
+    models = Ensemble([config] * len(experiment_folders), experiment_folders, weights=args.weights)
+    batcher = RequestBatcher(models, config.get('test_batch_size', TEST_BATCH_SIZE), args.max_latency_ms / 1000,
+                             pooling=config.get('prediction_pooling', 'mean'))
+    server = TaggingServer((args.host, args.port), config, batcher, config.get('inference_hop') or config['xInput'],
+                           extractor_config=None if args.no_audio else full_config, verbose=args.verbose)
+
+    print('Serving {} on http://{}:{}'.format(args.list, *server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    batcher.close()
+    models.close()
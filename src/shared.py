@@ -1,6 +1,8 @@
+import os
 import warnings
 from ast import literal_eval
 from datetime import datetime
+from pathlib import Path
 
 import numpy as np
 from sklearn import metrics
@@ -10,17 +12,53 @@ MULTICLASS_INDICATOR = "multiclass-indicator"
 
 warnings.filterwarnings("ignore")
 
+# index and ground truth files parsed in advance (e.g., by `train_folds.py` before starting
+# the processes of the folds), by loader and absolute path
+_preloaded = dict()
+
 
 def get_epoch_time():
     return int((datetime.now() - datetime(1970, 1, 1)).total_seconds())
 
 
+def make_experiment_folder(experiments_dir, experiment_id):
+    # creates `experiments_dir/experiment_id`. Several experiments (e.g., folds) may start within
+    # the same second: the later ones get the first free `experiment_id_1`, `experiment_id_2`, ...
+    Path(experiments_dir).mkdir(parents=True, exist_ok=True)
+    model_folder = Path(experiments_dir, experiment_id)
+    suffix = 1
+    while True:
+        try:
+            model_folder.mkdir()
+            return model_folder
+        except FileExistsError:
+            model_folder = Path(experiments_dir, '{}_{}'.format(experiment_id, suffix))
+            suffix += 1
+
+
+def session_config():
+    # the size of the TensorFlow thread pools can be limited with the `TF_NUM_INTRAOP_THREADS`
+    # and `TF_NUM_INTEROP_THREADS` variables (e.g., by `train_exec.py` when running several jobs)
+    import tensorflow.compat.v1 as tf
+    config = tf.ConfigProto()
+    config.intra_op_parallelism_threads = int(os.environ.get('TF_NUM_INTRAOP_THREADS', 0))
+    config.inter_op_parallelism_threads = int(os.environ.get('TF_NUM_INTEROP_THREADS', 0))
+    return config
+
+
 def count_params(trainable_variables):
     # to return number of trainable variables. Example: shared.count_params(tf.trainable_variables()))
     return np.sum([np.prod(v.get_shape().as_list()) for v in trainable_variables])
 
 
+def preload(loader, file):
+    _preloaded[(loader.__name__, os.path.abspath(file))] = loader(file)
+
+
 def load_id2gt(gt_file):
+    if ('load_id2gt', os.path.abspath(gt_file)) in _preloaded:
+        return _preloaded[('load_id2gt', os.path.abspath(gt_file))]
+
     ids = []
     fgt = open(gt_file)
     id2gt = dict()
@@ -32,6 +70,9 @@ def load_id2gt(gt_file):
 
 
 def load_id2path(index_file):
+    if ('load_id2path', os.path.abspath(index_file)) in _preloaded:
+        return _preloaded[('load_id2path', os.path.abspath(index_file))]
+
     paths = []
     fspec = open(index_file)
     id2path = dict()
@@ -98,65 +139,86 @@ def minmax_standarize(x, x_min=-1, x_max=1, headroom=0.1):
     return (x - x_min) / ((x_max + headroom) - (x_min - headroom))
 
 
-def average_predictions(pred_array, id_array, ids, id2gt=None):
-    # averaging probabilities -> one could also do majority voting
+POOLINGS = ['mean', 'median', 'max']
+
+
+def pool_predictions(pred_array, id_array, ids, pooling='mean'):
+    # pools the predictions of the patches of every id in `ids` (NaN for the ids without
+    # patches). The patches are grouped by sorting their ids once, instead of searching
+    # `id_array` for every id
+    pred_array = np.asarray(pred_array)
+    id_array = np.asarray(id_array)
+    pooled = np.full((len(ids), pred_array.shape[-1]), np.nan, dtype=pred_array.dtype)
+    if not len(id_array) or not len(ids):
+        return pooled
+    if pooling not in POOLINGS:
+        raise ValueError('Unknown pooling "{}", use one of {}.'.format(pooling, POOLINGS))
+
+    unique_ids, inverse = np.unique(id_array, return_inverse=True)
+    order = np.argsort(inverse, kind='stable')
+    counts = np.bincount(inverse)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    sorted_pred = pred_array[order]
+
+    if pooling == 'mean':
+        groups = np.add.reduceat(sorted_pred.astype('float64'), starts, axis=0) / counts[:, None]
+    elif pooling == 'max':
+        groups = np.maximum.reduceat(sorted_pred, starts, axis=0)
+    elif pooling == 'median':
+        # patches of each id in the rows of a NaN-padded array
+        positions = np.arange(len(order)) - np.repeat(starts, counts)
+        padded = np.full((len(unique_ids), counts.max(), pred_array.shape[-1]), np.nan)
+        padded[inverse[order], positions] = sorted_pred
+        groups = np.nanmedian(padded, axis=1)
+        # as the mean, the median of predictions with NaNs is NaN
+        groups[np.add.reduceat(np.isnan(sorted_pred), starts, axis=0) > 0] = np.nan
+
+    # rows of the requested ids
+    index = np.searchsorted(unique_ids, ids).clip(max=len(unique_ids) - 1)
+    found = unique_ids[index] == np.asarray(ids)
+    pooled[found] = groups[index[found]]
+    return pooled
+
+
+def valid_predictions(pooled, ids):
+    # ids with NaN or inf predictions are skipped
+    nans = np.isnan(pooled).any(axis=1)
+    posinfs = np.isposinf(pooled).any(axis=1)
+    neginfs = np.isneginf(pooled).any(axis=1)
+    for i in np.flatnonzero(nans | posinfs | neginfs):
+        if nans[i]:
+            print('{} skipped because it contains nans'.format(ids[i]))
+        elif posinfs[i]:
+            print('{} skipped because it contains pos infs'.format(ids[i]))
+        else:
+            print('{} skipped because it contains neg infs'.format(ids[i]))
+    return ~(nans | posinfs | neginfs)
+
+
+def average_predictions(pred_array, id_array, ids, id2gt=None, pooling='mean'):
+    # averaging probabilities -> one could also do majority voting (or `median` or `max` pooling)
     print('Averaging predictions')
-    y_pred = []
-    y_true = []
-    healthy_ids = []
-    for id in ids:
-        try:
-            avg = np.mean(pred_array[np.where(id_array == id)], axis=0)
-            if np.isnan(avg).any():
-                print('{} skipped because it contains nans'.format(id))
-                continue
-
-            if np.isposinf(avg).any():
-                print('{} skipped because it contains pos infs'.format(id))
-                continue
-
-            if np.isneginf(avg).any():
-                print('{} skipped because it contains neg infs'.format(id))
-                continue
-            y_pred.append(avg)
-            if id2gt:
-                y_true.append(id2gt[id])
-                healthy_ids.append(id)
-        except:
-            print(id)
+    pooled = pool_predictions(pred_array, id_array, ids, pooling=pooling)
+    valid = valid_predictions(pooled, ids)
 
     if id2gt:
-        return y_true, y_pred, healthy_ids
+        for i in np.flatnonzero(valid):
+            if ids[i] not in id2gt:
+                print(ids[i])
+                valid[i] = False
+        healthy_ids = [id for id, v in zip(ids, valid) if v]
+        return [id2gt[id] for id in healthy_ids], list(pooled[valid]), healthy_ids
     else:
-        return y_pred
+        return list(pooled[valid])
 
 
-def average_predictions_ids(pred_array, id_array, ids):
+def average_predictions_ids(pred_array, id_array, ids, pooling='mean'):
     # averages the predictions and returns the ids of the elements
     # that did not fail.
     print('Averaging predictions')
-    y_pred = []
-    ids_present = []
-    for id in ids:
-        try:
-            avg = np.mean(pred_array[np.where(id_array == id)], axis=0)
-            if np.isnan(avg).any():
-                print('{} skipped because it contains nans'.format(id))
-                continue
-
-            if np.isposinf(avg).any():
-                print('{} skipped because it contains pos infs'.format(id))
-                continue
-
-            if np.isneginf(avg).any():
-                print('{} skipped because it contains neg infs'.format(id))
-                continue
-            y_pred.append(avg)
-            ids_present.append(id)
-        except:
-            print(id)
-
-    return y_pred, ids_present
+    pooled = pool_predictions(pred_array, id_array, ids, pooling=pooling)
+    valid = valid_predictions(pooled, ids)
+    return list(pooled[valid]), [id for id, v in zip(ids, valid) if v]
 
 
 def compute_accuracy(y_true, y_pred):
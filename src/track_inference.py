@@ -0,0 +1,87 @@
+import numpy as np
+import pescador
+from tqdm import tqdm
+
+from ensemble import Ensemble, variable_length_config
+
+# patches per chunk. The chunks share the front-end and mid-end between neighbouring patches,
+# approximately (see `TrackEnsemble`)
+CHUNK_WINDOWS = 16
+
+
+def shares_patches(config):
+    # whole-track inference only pays off with several patches per chunk: with one, the patch-wise
+    # inference computes the same predictions, batched across tracks
+    return bool(config.get('whole_track_inference')) and config.get('inference_chunk_windows', CHUNK_WINDOWS) != 1
+
+
+def number_of_windows(frames, window, hop):
+    # as `overlap_sampling`, where tracks shorter than a patch are zero-padded
+    return (max(frames, window) - window) // hop + 1
+
+
+def chunk_starts(windows, chunk_windows, hop):
+    # first frame of every chunk of `chunk_windows` patches, and the number of patches of the last one
+    starts = np.arange(0, windows, chunk_windows) * hop
+    return starts, windows - (len(starts) - 1) * chunk_windows
+
+
+class TrackEnsemble:
+    # The models of an `Ensemble`, run over whole tracks: the front-end and mid-end are computed
+    # once over chunks of `chunk_windows` consecutive patches (None: the whole track), and the
+    # back-end pools the shared feature map per patch, giving the predictions of the patches of
+    # `overlap_sampling` with `param_sampling = hop`. This is an approximation: inside a chunk, the
+    # borders of a patch (the receptive field of the front-end and mid-end, 73 frames for models 10
+    # and 11) see the neighbouring frames instead of the zero padding of a single patch. Compare the
+    # validation scores of both with `evaluate.py` before using it. With `chunk_windows = 1` the
+    # predictions are the patch-wise ones, but nothing is shared (see `shares_patches`).
+    def __init__(self, configs, experiment_folders, hop, chunk_windows=CHUNK_WINDOWS, weights=None,
+                 batch_size=64):
+        if len(set(config['xInput'] for config in configs)) > 1:
+            raise ValueError('The models of an ensemble need the same `xInput`.')
+
+        self.window, self.hop, self.chunk_windows = configs[0]['xInput'], hop, chunk_windows
+        # batch of chunks, of about `batch_size` patches
+        self.batch_size = max(1, batch_size // (chunk_windows or batch_size))
+        # the models take inputs of any number of frames, pooled per patch
+        configs = [dict(variable_length_config(config), pooling_window=[self.window, hop]) for config in configs]
+        self.models = Ensemble(configs, experiment_folders, weights=weights)
+
+    def predict(self, track):
+        # predictions of the patches of `track` ([frames, yInput], at least `xInput` frames)
+        windows = number_of_windows(len(track), self.window, self.hop)
+        chunk_windows = self.chunk_windows or windows
+        starts, last_windows = chunk_starts(windows, chunk_windows, self.hop)
+        span = self.window + (chunk_windows - 1) * self.hop
+
+        predictions = []
+        full_chunks = starts if last_windows == chunk_windows else starts[:-1]
+        for i in range(0, len(full_chunks), self.batch_size):
+            chunks = np.stack([track[start: start + span] for start in full_chunks[i: i + self.batch_size]])
+            predictions.append(self.models.predict(chunks))
+        if last_windows < chunk_windows:
+            last_span = self.window + (last_windows - 1) * self.hop
+            predictions.append(self.models.predict(track[None, starts[-1]: starts[-1] + last_span]))
+        return np.vstack(predictions)
+
+    def close(self):
+        self.models.close()
+
+
+def track_streamer(config, data_gen, ids, id2audio_repr_path, id2gt):
+    # one track per batch, read in parallel
+    pack = [config, 'whole_track', None]
+    streams = [pescador.Streamer(data_gen, id, id2audio_repr_path[id], id2gt[id], pack) for id in ids]
+    mux_stream = pescador.ChainMux(streams, mode='exhaustive')
+    batch_streamer = pescador.Streamer(pescador.buffer_stream, mux_stream, buffer_size=1)
+    return pescador.ZMQStreamer(batch_streamer)
+
+
+def predict_tracks(batch_streamer, models):
+    # per-patch predictions and ids, as the batches of `overlap_sampling`
+    pred_list, id_list = [], []
+    for batch in tqdm(batch_streamer):
+        pred = models.predict(batch['X'][0])
+        pred_list.append(pred)
+        id_list.append(np.repeat(batch['ID'], len(pred)))
+    return np.vstack(pred_list), np.hstack(id_list)
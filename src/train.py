@@ -1,6 +1,9 @@
 import argparse
+from collections import deque
 import json
 from pathlib import Path
+import sys
+import tempfile
 import time
 
 import numpy as np
@@ -9,7 +12,10 @@ tf.disable_v2_behavior()
 import pescador
 
 import shared
+import checkpoint_writer
 import classification_heads
+import data_loaders
+import distributed
 
 
 def write_summary(value, tag, step, writer):
@@ -21,27 +27,142 @@ def write_summary(value, tag, step, writer):
     writer.add_summary(summary, step)
 
 
-def tf_define_model_and_cost(config):
-    return model_and_cost(config, tf.placeholder(tf.bool))
+# per-step statistics, stored in `train_steps.tsv` and averaged into the TensorBoard logs
+STEP_STATISTICS = ['data_wait', 'run_time', 'patches_per_s', 'tracks_per_s', 'fill_ratio', 'queue_depth']
+
+
+def step_statistics(batch, data_wait, run_time, batch_size, queue_depth, step_time=None):
+    # `data_wait` is the time spent waiting for the batch and `run_time` the time in `sess.run`.
+    # Long data waits with an empty loader queue mean that the training is input-bound.
+    # The rates are per `step_time`, `data_wait + run_time` unless the two overlap
+    patches = len(batch['X'])
+    tracks = len(np.unique(batch['ID'])) if 'ID' in batch else patches
+    step_time = step_time or data_wait + run_time
+    return [data_wait, run_time, patches / step_time, tracks / step_time, patches / batch_size, queue_depth]
+
+
+def accumulate_gradients(grads_and_vars):
+    # Gradient accumulation over micro-batches. `accumulate` adds the gradients of a micro-batch,
+    # and the returned gradients are their average. The accumulators (local variables, so they
+    # are not stored in the checkpoints) have to be zeroed after applying them.
+    grads_and_vars = [(g, v) for g, v in grads_and_vars if g is not None]
+    with tf.name_scope('gradient_accumulation'):
+        accumulators = [tf.Variable(tf.zeros(v.shape, v.dtype.base_dtype), trainable=False,
+                                    collections=[tf.GraphKeys.LOCAL_VARIABLES]) for _, v in grads_and_vars]
+        count = tf.Variable(0., trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES])
+
+        gradients = [tf.convert_to_tensor(g) for g, _ in grads_and_vars]
+        # the count only changes with the gradients (e.g., not on a step without input batch)
+        with tf.control_dependencies(gradients):
+            accumulate = tf.group(*[a.assign_add(g) for a, g in zip(accumulators, gradients)],
+                                  count.assign_add(1.))
+        averaged = [(a / count, v) for a, (_, v) in zip(accumulators, grads_and_vars)]
+    return averaged, accumulate, accumulators + [count]
+
+
+class InputPipeline:
+    # Batches read inside the graph (tf.data) instead of passed through `feed_dict` on every step.
+    # `start` sets the batches (an iterable of {'X', 'Y'}) of the next pass, which ends with
+    # `tf.errors.OutOfRangeError`. The number of patches of the pass is counted in `patches`.
+    # The batches read ahead are kept, in order, with the time spent waiting for them: `next_read`
+    # returns those of the batch of the last step and the number of batches still ahead
+    def __init__(self, x_shape, num_classes, size=4):
+        self.batches = iter(())
+        self.patches = 0
+        self.read = deque()
+        dataset = tf.data.Dataset.from_generator(
+            self._generate, (tf.float32, tf.float32),
+            (tf.TensorShape([None] + x_shape), tf.TensorShape([None, num_classes])))
+        self.iterator = tf.data.make_initializable_iterator(dataset.prefetch(size))
+        self.batch = self.iterator.get_next()
+
+    def _generate(self):
+        batches = iter(self.batches)
+        while True:
+            wait_start = time.time()
+            batch = next(batches, None)
+            if batch is None:
+                return
+            self.read.append((batch, time.time() - wait_start))
+            self.patches += len(batch['X'])
+            yield batch['X'], batch['Y']
+
+    def next_read(self):
+        batch, data_wait = self.read.popleft()
+        return batch, data_wait, len(self.read)
+
+    def start(self, sess, batches):
+        self.batches, self.patches = batches, 0
+        self.read.clear()
+        sess.run(self.iterator.initializer)
+
+
+def streaming_cost(cost, name):
+    # mean of `cost` over the steps, kept in metric (local) variables and read once per epoch.
+    # Returns the update op, the [total, count] variables and the op resetting them
+    with tf.variable_scope(name), tf.control_dependencies([cost]):
+        _, update = tf.metrics.mean(cost)
+    variables = tf.get_collection(tf.GraphKeys.METRIC_VARIABLES, scope=name + '/')
+    return update, variables, tf.variables_initializer(variables)
+
+
+def load_resume_state(sess, saver, resume_folder):
+    # resume checkpoints are written by `checkpoint_writer.write_resume_state`
+    with open(resume_folder / 'state.json', 'r') as f:
+        state = json.load(f)
+    saver.restore(sess, state['checkpoint'])
+    random_state = state['numpy_random_state']
+    np.random.set_state((random_state[0], np.array(random_state[1], dtype=np.uint32), *random_state[2:]))
+    return state
+
+
+def tf_define_model_and_cost(config, inputs=None):
+    return model_and_cost(config, tf.placeholder(tf.bool), inputs=inputs)
 
 
 def tf_define_model_and_cost_freeze(config):
     return model_and_cost(config, False)
 
 
-def model_and_cost(config, is_train):
+def in_graph_melspectrogram(x, config):
+    # x contains waveform patches ([batch, samples, 1]). The models are defined
+    # on the resulting mel-spectrogram, so their patch parameters are updated
+    import models_melspectrogram
+    melspectrogram_type = config['feature_params']['melspectrogram']
+    params = models_melspectrogram.MELSPECTROGRAMS[melspectrogram_type]
+
+    x_mel = models_melspectrogram.melspectrogram(x[:, :, 0], melspectrogram_type)
+
+    model_config = dict(config)
+    model_config['xInput'] = models_melspectrogram.number_of_frames(config['xInput'], melspectrogram_type)
+    model_config['yInput'] = params['number_bands']
+    model_config['feature_params'] = dict(config['feature_params'], n_mels=params['number_bands'])
+    return x_mel, model_config
+
+
+def model_and_cost(config, is_train, inputs=None):
     # tensorflow: define the model
     with tf.name_scope('model'):
-        x = tf.placeholder(tf.float32, [None, config['xInput'], config['yInput']])
-        y_ = tf.placeholder(tf.float32, [None, config['num_classes_dataset']])
+        if inputs is None:
+            x = tf.placeholder(tf.float32, [None, config['xInput'], config['yInput']])
+            y_ = tf.placeholder(tf.float32, [None, config['num_classes_dataset']])
+        else:
+            # read from an in-graph pipeline (`InputPipeline`), unless values are fed
+            x = tf.placeholder_with_default(inputs[0], [None, config['xInput'], config['yInput']])
+            y_ = tf.placeholder_with_default(inputs[1], [None, config['num_classes_dataset']])
+
+        # waveform patches can be turned into mel-spectrograms inside the graph
+        x_model, model_config = x, config
+        if config['feature_params'].get('melspectrogram'):
+            x_model, model_config = in_graph_melspectrogram(x, config)
 
         # choose between transfer learning or fully trainable models
         if config['load_model'] is not None:
             import models_transfer_learning
-            y = models_transfer_learning.define_model(x, is_train, config)
+            y = models_transfer_learning.define_model(x_model, is_train, model_config)
         else:
             import models
-            y = models.model_number(x, is_train, config)
+            y = models.model_number(x_model, is_train, model_config)
 
         y = classification_heads.regular(y, config)
 
@@ -80,9 +201,28 @@ if __name__ == '__main__':
     parser.add_argument('config_file', help='configuration file')
     parser.add_argument('-s', '--single_batch', action='store_true', help='iterate over a single batch')
     parser.add_argument('-n', '--number_samples', type=int, help='iterate over a just n random samples')
+    parser.add_argument('-r', '--resume', nargs='?', const='', metavar='EXPERIMENT_ID',
+                        help=('resume an interrupted training from its last resume checkpoint. By default, '
+                              'the experiment in `experiment_id_{fold}` is resumed'))
+    parser.add_argument('-w', '--workers', type=int,
+                        help='data-parallel training with this number of worker processes on this machine')
+    parser.add_argument('--worker_hosts',
+                        help=('comma-separated `host:port` list of the data-parallel workers. The same '
+                              'command has to be run on every host with its `--task_index`'))
+    parser.add_argument('--task_index', type=int, default=0, help='index of this worker in `--worker_hosts`')
 
     args = parser.parse_args()
 
+    if args.workers and not args.worker_hosts:
+        sys.exit(distributed.launch_local_workers(args.workers, sys.argv))
+
+    # the first worker (chief) is the one writing the logs and checkpoints
+    cluster = None
+    is_chief = True
+    if args.worker_hosts:
+        cluster = distributed.Cluster(args.worker_hosts.split(','), args.task_index)
+        is_chief = cluster.is_chief
+
     config_file = args.config_file
     single_batch = args.single_batch
     number_samples = args.number_samples
@@ -111,14 +251,19 @@ if __name__ == '__main__':
         config['yInput'] = config['feature_params']['yInput']
 
     # get the data loader
-    print('Loading data generator for regular training')
-    if feature_combination:
+    file_index = data_dir / 'index_repr.tsv'
+    if config.get('activation_cache'):
+        print('Loading data generator for cached activations')
+        from data_loaders import data_gen_activations as data_gen
+        file_index = Path(config['activation_cache']) / 'index_activations.tsv'
+    elif feature_combination:
+        print('Loading data generator for regular training')
         from data_loaders import data_gen_feature_combination as data_gen
     else:
+        print('Loading data generator for regular training')
         from data_loaders import data_gen_standard as data_gen
 
     # load audio representation paths
-    file_index = data_dir / 'index_repr.tsv'
     [audio_repr_paths, id2audio_repr_path] = shared.load_id2path(file_index)
 
     # load training data
@@ -134,36 +279,103 @@ if __name__ == '__main__':
 
     print('# Train:', len(ids_train))
     print('# Val:', len(ids_val))
+
+    if cluster:
+        ids_train = cluster.shard(ids_train)
+        ids_val = ids_val[cluster.task_index::cluster.num_workers]
+        print('# Train (worker {}):'.format(cluster.task_index), len(ids_train))
+        print('# Val (worker {}):'.format(cluster.task_index), len(ids_val))
     print('# Classes:', config['classes_vector'])
 
     # save experimental settings
-    experiment_id = str(shared.get_epoch_time()) + config['feature_type']
+    if args.resume is None:
+        experiment_id = str(shared.get_epoch_time()) + config['feature_type']
+    elif args.resume:
+        experiment_id = args.resume
+    else:
+        with open(exp_dir / 'experiment_id_{}'.format(config['fold']), 'r') as f:
+            experiment_id = f.read().strip()
     model_folder = exp_dir / 'experiments' / experiment_id
-    if not model_folder.exists():
-        model_folder.mkdir(parents=True, exist_ok=True)
-    json.dump(config, open(model_folder / 'config.json', 'w'))
-    print('\nConfig file saved: ' + str(config))
+    if is_chief and args.resume is None:
+        model_folder = shared.make_experiment_folder(exp_dir / 'experiments', experiment_id)
+        experiment_id = model_folder.name
+    if is_chief:
+        if not model_folder.exists():
+            model_folder.mkdir(parents=True, exist_ok=True)
+        json.dump(config, open(model_folder / 'config.json', 'w'))
+        print('\nConfig file saved: ' + str(config))
+
+    # with `input_pipeline: dataset` the batches are read inside the graph and the costs are
+    # accumulated in metric variables, instead of going through `feed_dict` on every step
+    pipeline = None
+    if config.get('input_pipeline', 'feed_dict') == 'dataset':
+        if config.get('activation_cache'):
+            raise ValueError('`input_pipeline: dataset` is not available with `activation_cache`.')
+        pipeline = InputPipeline([config['xInput'], config['yInput']], config['num_classes_dataset'],
+                                 size=config.get('prefetch_batches', 4))
 
     # tensorflow: define model and cost
-    [x, y_, is_train, y, normalized_y, cost, model_vars] = tf_define_model_and_cost(config)
+    [x, y_, is_train, y, normalized_y, cost, model_vars] = tf_define_model_and_cost(
+        config, inputs=pipeline.batch if pipeline else None)
+
+    # with cached activations the frozen layers are not run, their output is fed instead.
+    # The graph (and so the checkpoints) stays the same
+    x_feed = x
+    if config.get('activation_cache'):
+        from models_transfer_learning import FROZEN_FEATURES
+        x_feed = tf.get_collection(FROZEN_FEATURES)[0]
+        config['activation_dims'] = int(x_feed.shape[-1])
 
     # tensorflow: define optimizer
     update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)  # needed for batchnorm
     with tf.control_dependencies(update_ops):
         lr = tf.placeholder(tf.float32)
-        if config['optimizer'] == 'SGD_clip':
+        if config['optimizer'] in ('SGD_clip', 'SGD'):
             optimizer = tf.train.GradientDescentOptimizer(lr)
-            gradients, variables = zip(*optimizer.compute_gradients(cost))
-            gradients, _ = tf.clip_by_global_norm(gradients, 5.0)
-            train_step = optimizer.apply_gradients(zip(gradients, variables))
-        elif config['optimizer'] == 'SGD':
-            optimizer = tf.train.GradientDescentOptimizer(lr)
-            train_step = optimizer.minimize(cost)
         elif config['optimizer'] == 'Adam':
             optimizer = tf.train.AdamOptimizer(learning_rate=lr)
-            train_step = optimizer.minimize(cost)
 
-    sess = tf.InteractiveSession()
+        grads_and_vars = optimizer.compute_gradients(cost)
+
+    # with gradient accumulation, `train_step` only accumulates the gradients of a batch (and
+    # updates the batchnorm statistics), and `apply_step` applies their average every
+    # `accumulation_steps` batches. The effective batch size is `batch_size * accumulation_steps`
+    accumulation_steps = config.get('accumulation_steps', 1)
+    if accumulation_steps > 1:
+        grads_and_vars, train_step, accumulators = accumulate_gradients(grads_and_vars)
+
+    if cluster:
+        # average the gradients of all workers before applying them
+        grads_and_vars = cluster.average_gradients(grads_and_vars)
+
+    if config['optimizer'] == 'SGD_clip':
+        gradients, variables = zip(*grads_and_vars)
+        gradients, _ = tf.clip_by_global_norm(gradients, 5.0)
+        grads_and_vars = zip(gradients, variables)
+
+    if accumulation_steps > 1:
+        with tf.control_dependencies([optimizer.apply_gradients(grads_and_vars)]):
+            apply_step = tf.group(*[a.assign(tf.zeros_like(a)) for a in accumulators])
+    else:
+        train_step = optimizer.apply_gradients(grads_and_vars)
+
+    if pipeline:
+        train_cost_update, train_cost_vars, reset_train_cost = streaming_cost(cost, 'train_cost')
+        val_cost_update, val_cost_vars, reset_val_cost = streaming_cost(cost, 'val_cost')
+        train_step = tf.group(train_step, train_cost_update)
+
+    if cluster:
+        # copy the chief weights (and training state) to the other workers, and keep the
+        # batchnorm statistics (updated locally on every step) in sync after every epoch
+        sync_variables = cluster.sync_variables(tf.global_variables(), broadcast=True)
+        bn_variables = distributed.batchnorm_statistics()
+        sync_bn = cluster.sync_variables(bn_variables) if bn_variables else tf.no_op()
+        state_in, state_out = cluster.scalars(5, broadcast=True)
+        costs_in, costs_out = cluster.scalars(4)
+
+        sess = cluster.session()
+    else:
+        sess = tf.InteractiveSession(config=shared.session_config())
     tf.keras.backend.set_session(sess)
 
     print('\nEXPERIMENT: ', str(experiment_id))
@@ -184,14 +396,15 @@ if __name__ == '__main__':
         config['ids_val'] = ids_val
 
         # Re-dump config with ids
-        json.dump(config, open(model_folder + 'config.json', 'w'))
+        if is_chief:
+            json.dump(config, open(model_folder / 'config.json', 'w'))
 
     # pescador train: define streamer
     train_pack = [config, config['train_sampling'], config['param_train_sampling']]
     train_streams = [pescador.Streamer(data_gen, id, id2audio_repr_path[id], id2gt_train[id], train_pack)
                      for id in ids_train]
     train_mux_stream = pescador.StochasticMux(train_streams,
-                                              n_active=config['batch_size'] * 2,
+                                              n_active=config.get('n_active') or config['batch_size'] * 2,
                                               rate=None,
                                               mode='exhaustive'
                                               )
@@ -212,41 +425,97 @@ if __name__ == '__main__':
                                            partial=True)
     val_batch_streamer = pescador.ZMQStreamer(val_batch_streamer)
 
-    train_file_writer = tf.summary.FileWriter(str(model_folder / 'logs' / 'train'), sess.graph)
-    val_file_writer = tf.summary.FileWriter(str(model_folder / 'logs' / 'val'), sess.graph)
+    # the validation patches do not change across epochs, so they can be read and
+    # pre-processed only once and kept in memory or in a memmap (`val_cache`)
+    if config.get('val_cache'):
+        cache_file = None
+        if config['val_cache'] == 'memmap':
+            cache_file = Path(tempfile.mkdtemp(dir=config.get('val_cache_dir')), 'val')
+        X_val, Y_val = data_loaders.cache_patches(val_batch_streamer, cache_file=cache_file)
+        if cache_file:
+            cache_file.parent.rmdir()
+        print('Validation patches cached: {} ({:.1f} MB)'.format(len(X_val), (X_val.nbytes + Y_val.nbytes) / 2**20))
+
+    if is_chief:
+        train_file_writer = tf.summary.FileWriter(str(model_folder / 'logs' / 'train'), sess.graph)
+        val_file_writer = tf.summary.FileWriter(str(model_folder / 'logs' / 'val'), sess.graph)
 
     # tensorflow: create a session to run the tensorflow graph
     sess.run(tf.global_variables_initializer())
     # Required by the accuracy metrics
     sess.run(tf.local_variables_initializer())
 
-    if config['load_model'] is not None:  # restore model weights from previously saved model
+    if config['load_model'] is not None and args.resume is None:  # restore model weights from previously saved model
         saver = tf.train.Saver(var_list=model_vars[:-4])
-        saver.restore(sess, config['load_model'])  # end with /!
+        saver.restore(sess, checkpoint_writer.checkpoint_prefix(config['load_model']))
         print('Pre-trained model loaded!')
 
     # After restoring make it aware of the rest of the variables
     # saver.var_list = model_vars
     saver = tf.train.Saver()
 
-    # writing headers of the train_log.tsv
-    fy = open(model_folder / 'train_log.tsv', 'a')
-    fy.write('Epoch\ttrain_cost\tval_cost\tepoch_time\tlearing_rate\n')
+    # periodic checkpoints to resume the training (e.g., on preemptible nodes)
+    resume_folder = model_folder / 'resume'
+    resume_every = config.get('resume_every', 1)
 
-    fy.close()
-
-    # automate the evaluation process
-    experiment_id_file = exp_dir / 'experiment_id_{}'.format(config['fold'])
-    with open(experiment_id_file, 'w') as f:
-        f.write(str(experiment_id))
+    # checkpoints are written in the background from a snapshot of the variables
+    writer = None
+    if is_chief:
+        writer = checkpoint_writer.CheckpointWriter(tf.global_variables(),
+                                                    max_pending=config.get('checkpoint_backlog', 2))
 
     # training
+    start_epoch = 0
+    global_step = 0
     k_patience = 0
     cost_best_model = np.Inf
     tmp_learning_rate = config['learning_rate']
+
+    if args.resume is not None and is_chief:
+        state = load_resume_state(sess, saver, resume_folder)
+        start_epoch = state['epoch']
+        global_step = state.get('global_step', 0)
+        k_patience = state['k_patience']
+        cost_best_model = state['cost_best_model']
+        tmp_learning_rate = state['learning_rate']
+        print('Resuming {} from epoch {}'.format(experiment_id, start_epoch + 1))
+    elif is_chief:
+        # writing headers of the train_log.tsv
+        fy = open(model_folder / 'train_log.tsv', 'a')
+        fy.write('Epoch\ttrain_cost\tval_cost\tepoch_time\tlearing_rate\tdata_wait_ratio\tpatches_per_s\n')
+
+        fy.close()
+
+        with open(model_folder / 'train_steps.tsv', 'a') as f:
+            f.write('\t'.join(['epoch', 'step'] + STEP_STATISTICS) + '\n')
+
+    if cluster:
+        sess.run(sync_variables)
+        start_epoch, global_step, k_patience, cost_best_model, tmp_learning_rate = sess.run(
+            state_out, feed_dict={state_in: [start_epoch, global_step, k_patience, cost_best_model,
+                                             tmp_learning_rate]}).tolist()
+        start_epoch, global_step, k_patience = int(start_epoch), int(global_step), int(k_patience)
+
+        # every worker has to run the same number of steps per epoch
+        steps_per_epoch = config.get('steps_per_epoch')
+        if not steps_per_epoch:
+            if config['train_sampling'] != 'random':
+                raise ValueError('Set `steps_per_epoch` for data-parallel training with `{}`.'.format(
+                    config['train_sampling']))
+            steps_per_epoch = int(np.ceil(len(ids_train) * config['param_train_sampling'] / config['batch_size']))
+
+    # automate the evaluation process
+    if is_chief:
+        experiment_id_file = exp_dir / 'experiment_id_{}'.format(config['fold'])
+        with open(experiment_id_file, 'w') as f:
+            f.write(str(experiment_id))
+
+    summary_every = config.get('summary_every', 50)
+    prefetch_batches = config.get('prefetch_batches', 4)
+
     print('Training started..')
 
-    for i in range(config['epochs']):
+    for i in range(start_epoch, config['epochs']):
         # training: do not train first epoch, to see random weights behaviour
 
         # modify the seed number on every epoch so that we get different patches
@@ -255,31 +524,155 @@ if __name__ == '__main__':
 
         start_time = time.time()
         array_train_cost = []
-        if i != 0:
-            for train_batch in train_batch_streamer:
+        array_step_stats = []
+        if pipeline:
+            sess.run(reset_train_cost)
+        if i != 0 and pipeline:
+            train_batches = train_batch_streamer
+            if cluster:
+                train_batches = distributed.repeat(train_batch_streamer, steps_per_epoch)
+            pipeline.start(sess, train_batches)
+
+            # the batches are read by the pipeline while the previous steps run: `data_wait` is the
+            # time it waited for them from the loaders, and the rates are per step (`sess.run` included)
+            steps = 0
+            step_start = time.time()
+            while True:
+                tf_start = time.time()
+                try:
+                    sess.run(train_step, feed_dict={lr: tmp_learning_rate, is_train: True})
+                except tf.errors.OutOfRangeError:
+                    break
+                tf_end = time.time()
+                steps += 1
+                if accumulation_steps > 1 and steps % accumulation_steps == 0:
+                    sess.run(apply_step, feed_dict={lr: tmp_learning_rate})
+                train_batch, data_wait, queue_depth = pipeline.next_read()
+                array_step_stats.append(step_statistics(train_batch, data_wait, tf_end - tf_start,
+                                                        config['batch_size'], queue_depth,
+                                                        step_time=time.time() - step_start))
+                global_step += 1
+
+                if is_chief and global_step % summary_every == 0:
+                    for name, value in zip(STEP_STATISTICS, np.mean(array_step_stats[-summary_every:], axis=0)):
+                        write_summary(value, 'steps/' + name, global_step, train_file_writer)
+                    # running mean of the epoch
+                    total, count = sess.run(train_cost_vars)
+                    write_summary(total / count, 'steps/cost', global_step, train_file_writer)
+                step_start = time.time()
+
+            if accumulation_steps > 1 and steps % accumulation_steps:
+                sess.run(apply_step, feed_dict={lr: tmp_learning_rate})
+            train_patches = pipeline.patches
+        elif i != 0:
+            train_batches = train_batch_streamer
+            if cluster:
+                train_batches = distributed.repeat(train_batch_streamer, steps_per_epoch)
+            train_batches = data_loaders.Prefetcher(train_batches, size=prefetch_batches)
+
+            wait_start = time.time()
+            for train_batch in train_batches:
                 tf_start = time.time()
                 _, train_cost = sess.run([train_step, cost],
-                                         feed_dict={x: train_batch['X'],
+                                         feed_dict={x_feed: train_batch['X'],
                                                     y_: train_batch['Y'],
                                                     lr: tmp_learning_rate,
                                                     is_train: True})
+                tf_end = time.time()
                 array_train_cost.append(train_cost)
+                if accumulation_steps > 1 and len(array_train_cost) % accumulation_steps == 0:
+                    sess.run(apply_step, feed_dict={lr: tmp_learning_rate})
+                array_step_stats.append(step_statistics(train_batch, tf_start - wait_start, tf_end - tf_start,
+                                                        config['batch_size'], train_batches.depth()))
+                global_step += 1
+
+                if is_chief and global_step % summary_every == 0:
+                    for name, value in zip(STEP_STATISTICS, np.mean(array_step_stats[-summary_every:], axis=0)):
+                        write_summary(value, 'steps/' + name, global_step, train_file_writer)
+                    write_summary(np.mean(array_train_cost[-summary_every:]), 'steps/cost', global_step,
+                                  train_file_writer)
+                wait_start = time.time()
+
+            # apply the gradients of the last batches of the epoch
+            if accumulation_steps > 1 and len(array_train_cost) % accumulation_steps:
+                sess.run(apply_step, feed_dict={lr: tmp_learning_rate})
+        train_time = time.time() - start_time
+
+        if cluster:
+            sess.run(sync_bn)
 
         # validation
         array_val_cost = []
-        for val_batch in val_batch_streamer:
-            val_cost = sess.run([cost],
-                                feed_dict={x: val_batch['X'], y_: val_batch['Y'], is_train: False})
-            array_val_cost.append(val_cost)
+        val_run_time = 0
+        val_batches = val_batch_streamer
+        if config.get('val_cache'):
+            val_batches = data_loaders.iterate_patches(X_val, Y_val, config['val_batch_size'])
+        val_start = time.time()
+        if pipeline:
+            sess.run(reset_val_cost)
+            pipeline.start(sess, val_batches)
+            while True:
+                try:
+                    sess.run(val_cost_update, feed_dict={is_train: False})
+                except tf.errors.OutOfRangeError:
+                    break
+            val_run_time = time.time() - val_start
+        else:
+            for val_batch in val_batches:
+                tf_start = time.time()
+                val_cost = sess.run([cost],
+                                    feed_dict={x_feed: val_batch['X'], y_: val_batch['Y'], is_train: False})
+                val_run_time += time.time() - tf_start
+                array_val_cost.append(val_cost)
+        val_time = time.time() - val_start
 
         # Keep track of average loss of the epoch
-        train_cost = np.mean(array_train_cost)
-
-        val_cost = np.mean(array_val_cost)
+        if pipeline:
+            train_total, train_count, val_total, val_count = sess.run(train_cost_vars + val_cost_vars)
+        else:
+            train_total, train_count = np.sum(array_train_cost), len(array_train_cost)
+            val_total, val_count = np.sum(array_val_cost), len(array_val_cost)
+        if cluster:
+            # the costs of all workers, so that they take the same learning rate and patience decisions
+            train_total, train_count, val_total, val_count = sess.run(
+                costs_out, feed_dict={costs_in: [train_total, train_count, val_total, val_count]})
+        train_cost = train_total / train_count if train_count else np.nan
+        val_cost = val_total / val_count
         epoch_time = time.time() - start_time
-        fy = open(model_folder / 'train_log.tsv', 'a')
-        fy.write('%g\t%g\t%g\t%gs\t%g\n' % (i + 1, train_cost, val_cost, epoch_time, tmp_learning_rate))
-        fy.close()
+
+        # fraction of the time waiting for data and training throughput of the epoch
+        data_wait, patches_per_s = np.nan, np.nan
+        if pipeline and train_count:
+            # the waits of the pipeline overlap the steps: only the throughput is comparable
+            patches_per_s = train_patches / train_time
+        elif array_step_stats:
+            step_stats = np.array(array_step_stats)
+            data_wait = step_stats[:, 0].sum() / train_time
+            patches_per_s = (step_stats[:, 4].sum() * config['batch_size']) / train_time
+
+        if is_chief:
+            fy = open(model_folder / 'train_log.tsv', 'a')
+            fy.write('%g\t%g\t%g\t%gs\t%g\t%g\t%g\n' % (i + 1, train_cost, val_cost, epoch_time, tmp_learning_rate,
+                                                     data_wait, patches_per_s))
+            fy.close()
+
+            with open(model_folder / 'train_steps.tsv', 'a') as f:
+                for step, stats in enumerate(array_step_stats):
+                    f.write('\t'.join(['%d' % (i + 1), '%d' % step] + ['%g' % v for v in stats]) + '\n')
+
+            if train_count:
+                write_summary(train_cost, 'epoch/cost', i + 1, train_file_writer)
+                write_summary(data_wait, 'epoch/data_wait', i + 1, train_file_writer)
+                write_summary(patches_per_s, 'epoch/patches_per_s', i + 1, train_file_writer)
+                write_summary(train_time, 'epoch/time', i + 1, train_file_writer)
+            write_summary(val_cost, 'epoch/cost', i + 1, val_file_writer)
+            write_summary(1 - val_run_time / val_time, 'epoch/data_wait', i + 1, val_file_writer)
+            write_summary(val_time, 'epoch/time', i + 1, val_file_writer)
+            write_summary(tmp_learning_rate, 'epoch/learning_rate', i + 1, train_file_writer)
+            train_file_writer.flush()
+            val_file_writer.flush()
+
+        checkpoint_writes = []
 
         # Decrease the learning rate after not improving in the validation set
         if config['patience'] and k_patience >= config['patience']:
@@ -299,7 +692,11 @@ if __name__ == '__main__':
 
         else:
             # save model weights to disk
-            save_path = saver.save(sess, str(model_folder) + '/')  # TF needs this trailing `/`
+            save_path = None
+            if is_chief:
+                checkpoint_writes.append(lambda save, epoch=i + 1: checkpoint_writer.write_best_model(
+                    save, model_folder, epoch, keep=config.get('keep_checkpoints', 1)))
+                save_path = str(model_folder) + '/'
             print('Epoch %d, train cost %g, '
                   'val cost %g, '
                   'epoch-time %gs, lr %g, time-stamp %s - [BEST MODEL]'
@@ -308,4 +705,24 @@ if __name__ == '__main__':
                    str(time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())), save_path))
             cost_best_model = val_cost
 
+        # the sampler is seeded with `seed + epoch`, so storing the next epoch is enough
+        # to continue with exactly the same sequence of training patches
+        if is_chief and ((i + 1) % resume_every == 0 or i + 1 == config['epochs']):
+            state = {
+                'epoch': i + 1,
+                'global_step': global_step,
+                'k_patience': k_patience,
+                'cost_best_model': float(cost_best_model),
+                'learning_rate': tmp_learning_rate,
+                'numpy_random_state': [v.tolist() if isinstance(v, np.ndarray) else v for v in np.random.get_state()],
+            }
+            checkpoint_writes.append(lambda save, state=state: checkpoint_writer.write_resume_state(
+                save, resume_folder, state))
+
+        if checkpoint_writes:
+            writer.submit(writer.snapshot(sess), checkpoint_writes)
+
+    if writer:
+        writer.close()
+
     print('\nEVALUATE EXPERIMENT -> ' + str(experiment_id))
@@ -1,28 +1,172 @@
+import argparse
+from collections import defaultdict
+import glob
+import json
 import os
-import numpy as np
-import time
+from pathlib import Path
+import queue
 import subprocess
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-setups = ['spec', 'spec', 'spec']
-GPU = 0
-script = 'train.py'
+SRC_DIR = Path(__file__).resolve().parent
+STAGES = ['train', 'evaluate', 'score']
 
-if __name__ == '__main__':
-    start = time.time()
-    for stp in setups:
-        str_exec = 'CUDA_VISIBLE_DEVICES=' + str(GPU) + ' python ' + str(script) + ' ' + str(stp)
-        #str_exec = 'CUDA_VISIBLE_DEVICES=' + str(GPU) + ' python3 ' + str(script) + ' ' + str(stp)
-        print(str_exec)
-        
+
+def expand_configs(patterns):
+    config_files = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            raise FileNotFoundError('No configuration files match "{}"'.format(pattern))
+        config_files += [str(Path(m).resolve()) for m in matches]
+    return config_files
+
+
+def core_sets(n_jobs, threads):
+    # disjoint sets of `threads` cores for the concurrent jobs (wrapping around if there are
+    # not enough cores)
+    cores = sorted(os.sched_getaffinity(0))
+    return [[cores[(i * threads + j) % len(cores)] for j in range(threads)] for i in range(n_jobs)]
+
+
+def job_env(threads):
+    # limit the thread pools of TensorFlow (see `shared.session_config`) and the numerical libraries
+    env = dict(os.environ)
+    for var in ['TF_NUM_INTRAOP_THREADS', 'OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+        env[var] = str(threads)
+    env['TF_NUM_INTEROP_THREADS'] = str(min(2, threads))
+    return env
+
+
+class Scheduler:
+    def __init__(self, config_files, n_jobs, threads, log_dir, stages):
+        self.config_files = config_files
+        self.log_dir = log_dir
+        self.stages = stages
+        self.env = job_env(threads)
+
+        # each running job takes a set of cores
+        self.slots = queue.Queue()
+        for cores in core_sets(n_jobs, threads):
+            self.slots.put(cores)
+        self.n_jobs = n_jobs
+
+        self.lock = threading.Lock()
+        self.results = []
+
+        # the folds of each experiment (`exp_dir`) are scored once all of them are evaluated
+        self.configs = {}
+        for config_file in config_files:
+            with open(config_file, 'r') as f:
+                self.configs[config_file] = json.load(f)
+        self.names = {f: '{:03d}_{}'.format(i, Path(f).stem) for i, f in enumerate(config_files)}
+        self.pending = defaultdict(set)
+        folds = set()
+        for config_file, config in self.configs.items():
+            fold = (config['exp_dir'], config['config_train']['fold'])
+            if fold in folds:
+                raise ValueError('Several configurations write to fold {} of "{}".'.format(fold[1], fold[0]))
+            folds.add(fold)
+            self.pending[config['exp_dir']].add(config_file)
+        self.failed = set()
+
+    def run_stage(self, config_file, stage, command, cores):
+        log_file = self.log_dir / '{}.{}.log'.format(self.names[config_file], stage)
+        print('[{}] {} {}'.format(time.strftime('%H:%M:%S'), stage, config_file))
+
+        # the cores are set by `taskset`: a `preexec_fn` is not safe in the threads of the scheduler
+        command = ['taskset', '-c', ','.join(str(core) for core in cores)] + command
+        start = time.time()
+        with open(log_file, 'w') as log:
+            process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, cwd=SRC_DIR, env=self.env)
+            exit_code = process.wait()
+        duration = time.time() - start
+
+        with self.lock:
+            self.results.append((config_file, stage, exit_code, duration, log_file))
+        print('[{}] {} {} returned {} ({:.1f} min)'.format(
+            time.strftime('%H:%M:%S'), stage, config_file, exit_code, duration / 60))
+        return exit_code == 0
+
+    def run_job(self, config_file):
+        cores = self.slots.get()
         try:
-            retcode = subprocess.call(str_exec, shell=True)
-            if retcode < 0:
-                print("Terminated by signal", retcode)
-            else:
-                print("Returned", retcode)
-        except OSError as e:
-                print("Execution failed:", e)
+            config = self.configs[config_file]
+            exp_dir = config['exp_dir']
+            success = True
+
+            if 'train' in self.stages:
+                success = self.run_stage(config_file, 'train', [sys.executable, 'train.py', config_file], cores)
+
+            if success and 'evaluate' in self.stages:
+                experiment_id_file = Path(exp_dir, 'experiment_id_{}'.format(config['config_train']['fold']))
+                if experiment_id_file.exists():
+                    experiment_id = experiment_id_file.read_text().strip()
+                    success = self.run_stage(config_file, 'evaluate',
+                                             [sys.executable, 'evaluate.py', config_file, '-l', experiment_id], cores)
+                else:
+                    print('Not evaluating {}: "{}" not found'.format(config_file, experiment_id_file))
+                    success = False
+
+            with self.lock:
+                self.pending[exp_dir].discard(config_file)
+                if not success:
+                    self.failed.add(exp_dir)
+                score = not self.pending[exp_dir] and exp_dir not in self.failed
+
+            # the last fold to finish scores the experiment, provided that all the folds were run
+            if score and 'score' in self.stages:
+                n_folds = config['config_train']['n_folds']
+                n_configs = sum(c['exp_dir'] == exp_dir for c in self.configs.values())
+                if n_configs == n_folds:
+                    self.run_stage(config_file, 'score', [sys.executable, 'score_predictions.py', config_file], cores)
+                else:
+                    print('Not scoring "{}": only {} of {} folds were run'.format(exp_dir, n_configs, n_folds))
+        finally:
+            self.slots.put(cores)
+
+    def run(self):
+        with ThreadPoolExecutor(max_workers=self.n_jobs) as executor:
+            for future in [executor.submit(self.run_job, f) for f in self.config_files]:
+                future.result()
+
+        with open(self.log_dir / 'summary.tsv', 'w') as f:
+            f.write('config\tstage\texit_code\tminutes\tlog\n')
+            for config_file, stage, exit_code, duration, log_file in self.results:
+                f.write('{}\t{}\t{}\t{:.2f}\t{}\n'.format(config_file, stage, exit_code, duration / 60, log_file))
+
+        return sum(result[2] != 0 for result in self.results)
 
+
+if __name__ == '__main__':
+    # Runs the train > evaluate pipeline of several configuration files (e.g., one per fold,
+    # dataset and feature) concurrently, and scores each experiment once all its folds are done.
+    # Example: python train_exec.py "../configs/*/config_*.json" --jobs 4
+    parser = argparse.ArgumentParser()
+    parser.add_argument('config_files', nargs='+', help='configuration files or glob patterns')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of jobs to run at the same time')
+    parser.add_argument('-t', '--threads', type=int,
+                        help='cores (and TensorFlow threads) per job. By default, the available cores are split')
+    parser.add_argument('--logs', default='train_exec_logs', help='folder for the logs of every job')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES, help='stages to run')
+
+    args = parser.parse_args()
+
+    config_files = expand_configs(args.config_files)
+    threads = args.threads or max(1, len(os.sched_getaffinity(0)) // args.jobs)
+    log_dir = Path(args.logs)
+    log_dir.mkdir(parents=True, exist_ok=True)
+
+    print('Running {} configurations, {} at a time with {} threads each'.format(len(config_files), args.jobs, threads))
+
+    start = time.time()
+    failures = Scheduler(config_files, args.jobs, threads, log_dir, args.stages).run()
     end = time.time()
+
     print('\nDone! It took: %7.2f hours' % ((end - start) / 3600.0))
+    if failures:
+        print('{} stages failed, see {}'.format(failures, log_dir / 'summary.tsv'))
+        sys.exit(1)
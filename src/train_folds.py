@@ -0,0 +1,162 @@
+import argparse
+import copy
+import json
+import multiprocessing
+from multiprocessing.connection import wait
+import os
+from pathlib import Path
+import runpy
+import sys
+import time
+
+import shared
+from train_exec import core_sets, job_env
+
+SRC_DIR = Path(__file__).resolve().parent
+SPLITS = ['train', 'val', 'test']
+
+
+def fold_config(config, fold):
+    # the ground truth files of every fold follow the `gt_{split}_{fold}.csv` pattern
+    config = copy.deepcopy(config)
+    config_train = config['config_train']
+    config_train['fold'] = fold
+    for split in SPLITS:
+        gt_folder = Path(config_train['gt_' + split]).parent
+        config_train['gt_' + split] = str(gt_folder / 'gt_{}_{}.csv'.format(split, fold))
+    return config
+
+
+def absolute_paths(config):
+    # the folds run from `SRC_DIR`: the paths of the configuration are resolved from the current
+    # folder before, so that they also match the files preloaded by this process
+    config = copy.deepcopy(config)
+    for key in ['exp_dir', 'data_dir']:
+        config[key] = os.path.abspath(config[key])
+    config_train = config['config_train']
+    for key in ['gt_' + split for split in SPLITS] + ['audio_representation_dir', 'activation_cache']:
+        if config_train.get(key):
+            config_train[key] = os.path.abspath(config_train[key])
+    if 'audio_representation_dirs' in config_train:
+        config_train['audio_representation_dirs'] = [os.path.abspath(d)
+                                                     for d in config_train['audio_representation_dirs']]
+    return config
+
+
+def warm_page_cache(paths):
+    # asks the kernel to read the features in advance. The page cache is then shared by the
+    # processes of all the folds
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+
+def run_script(script, argv):
+    sys.argv = [script] + argv
+    runpy.run_path(str(SRC_DIR / script), run_name='__main__')
+
+
+def run_fold(config_file, experiment_id_file, cores, env, log_file):
+    # runs in a forked process, which inherits the preloaded index and ground truth
+    os.sched_setaffinity(0, cores)
+    os.environ.update(env)
+
+    log = open(log_file, 'w')
+    os.dup2(log.fileno(), sys.stdout.fileno())
+    os.dup2(log.fileno(), sys.stderr.fileno())
+
+    os.chdir(SRC_DIR)
+    sys.path.insert(0, str(SRC_DIR))
+    run_script('train.py', [str(config_file)])
+    experiment_id = experiment_id_file.read_text().strip()
+    run_script('evaluate.py', [str(config_file), '-l', experiment_id])
+
+
+if __name__ == '__main__':
+    # Trains and evaluates the cross-validation folds of an experiment concurrently. The index
+    # and ground truth files are parsed once and the features are loaded in the page cache
+    # before starting one process per fold. The outputs are the same as running `train.py` and
+    # `evaluate.py` for every fold, followed by `score_predictions.py`.
+    parser = argparse.ArgumentParser()
+    parser.add_argument('config_file', help='configuration file (of any of the folds)')
+    parser.add_argument('-f', '--folds', type=int, nargs='+', help='folds to run. By default, all of them')
+    parser.add_argument('-j', '--jobs', type=int, help='number of folds to run at the same time. By default, all')
+    parser.add_argument('-t', '--threads', type=int, help='cores per fold. By default, the available cores are split')
+    parser.add_argument('--no-warm-cache', action='store_true', help='do not pre-load the features in the page cache')
+
+    args = parser.parse_args()
+
+    with open(args.config_file, 'r') as f:
+        config = absolute_paths(json.load(f))
+    exp_dir = Path(config['exp_dir'])
+    config_train = config['config_train']
+
+    folds = args.folds if args.folds is not None else list(range(config_train['n_folds']))
+    jobs = args.jobs or len(folds)
+    threads = args.threads or max(1, len(os.sched_getaffinity(0)) // jobs)
+
+    # one configuration file per fold, as expected by `train.py` and `evaluate.py`
+    (exp_dir / 'configs').mkdir(parents=True, exist_ok=True)
+    (exp_dir / 'logs').mkdir(parents=True, exist_ok=True)
+    config_files = dict()
+    for fold in folds:
+        config_files[fold] = exp_dir / 'configs' / 'config_{}.json'.format(fold)
+        with open(config_files[fold], 'w') as f:
+            json.dump(fold_config(config, fold), f)
+
+    # parse the index and ground truth once
+    start = time.time()
+    index_file = Path(config['data_dir'], 'index_repr.tsv')
+    shared.preload(shared.load_id2path, index_file)
+    ids = set()
+    for fold in folds:
+        for split in SPLITS:
+            gt_file = fold_config(config, fold)['config_train']['gt_' + split]
+            shared.preload(shared.load_id2gt, gt_file)
+            ids.update(shared.load_id2gt(gt_file)[0])
+    print('Index and ground truth of {} folds loaded ({:.1f}s)'.format(len(folds), time.time() - start))
+
+    if not args.no_warm_cache:
+        _, id2audio_repr_path = shared.load_id2path(index_file)
+        audio_representation_dirs = config_train.get('audio_representation_dirs',
+                                                      [config_train['audio_representation_dir']])
+        warm_page_cache([Path(d, id2audio_repr_path[id]) for d in audio_representation_dirs
+                         for id in ids if id in id2audio_repr_path])
+
+    # start the folds as cores get free
+    context = multiprocessing.get_context('fork')
+    free_cores = core_sets(jobs, threads)
+    env = job_env(threads)
+    pending, running, exit_codes = list(folds), dict(), dict()
+    while pending or running:
+        while pending and free_cores:
+            fold = pending.pop(0)
+            cores = free_cores.pop()
+            process = context.Process(target=run_fold, args=(
+                config_files[fold], exp_dir / 'experiment_id_{}'.format(fold), cores, env,
+                exp_dir / 'logs' / 'fold_{}.log'.format(fold)))
+            process.start()
+            running[process.sentinel] = (process, fold, cores)
+            print('Fold {} started (log: {})'.format(fold, exp_dir / 'logs' / 'fold_{}.log'.format(fold)))
+
+        for sentinel in wait(list(running)):
+            process, fold, cores = running.pop(sentinel)
+            process.join()
+            free_cores.append(cores)
+            exit_codes[fold] = process.exitcode
+            print('Fold {} finished with exit code {}'.format(fold, process.exitcode))
+
+    if any(exit_codes.values()):
+        print('Some folds failed: {}'.format({f: c for f, c in exit_codes.items() if c}))
+        sys.exit(1)
+
+    if sorted(folds) == list(range(config_train['n_folds'])):
+        run_script('score_predictions.py', [str(config_files[folds[0]])])
+
+    print('\nDone! It took: %7.2f hours' % ((time.time() - start) / 3600.0))
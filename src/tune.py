@@ -0,0 +1,212 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import json
+import multiprocessing
+from pathlib import Path
+import resource
+import time
+
+import numpy as np
+import pescador
+
+import shared
+
+BATCH_SIZES = [16, 32, 64, 128, 256]
+N_ACTIVE_FACTORS = [1, 2, 4, 8]
+STEPS = 20
+WARMUP_STEPS = 3
+LOADER_BATCHES = 50
+
+
+def patch_config(config):
+    # patch parameters, as set by `train.py`
+    config['xInput'] = config['feature_params']['xInput']
+    if 'audio_representation_dirs' in config:
+        config['yInput'] = sum([i['yInput'] for i in config['features_params']])
+    else:
+        config['yInput'] = config['feature_params']['yInput']
+    return config
+
+
+def probe_model(config, batch_size, training, steps=STEPS):
+    # runs in a fresh process, so that the peak memory is the one of this batch size. The model
+    # is fed synthetic patches: only the computation is measured, not the data loading
+    import tensorflow.compat.v1 as tf
+    tf.disable_v2_behavior()
+    import train
+
+    [x, y_, is_train, y, normalized_y, cost, _] = train.tf_define_model_and_cost(config)
+    x_feed = x
+    if config.get('activation_cache'):
+        from models_transfer_learning import FROZEN_FEATURES
+        x_feed = tf.get_collection(FROZEN_FEATURES)[0]
+
+    if training:
+        # same optimizer as `train.py`, its slots also take memory
+        with tf.control_dependencies(tf.get_collection(tf.GraphKeys.UPDATE_OPS)):
+            if config['optimizer'] == 'Adam':
+                optimizer = tf.train.AdamOptimizer(learning_rate=config['learning_rate'])
+            else:
+                optimizer = tf.train.GradientDescentOptimizer(config['learning_rate'])
+            fetches = [optimizer.minimize(cost), cost]
+    else:
+        fetches = normalized_y
+
+    sess = tf.Session(config=shared.session_config())
+    sess.run(tf.global_variables_initializer())
+
+    feed_dict = {x_feed: np.random.randn(batch_size, *x_feed.shape.as_list()[1:]).astype('float32'),
+                 y_: np.eye(config['num_classes_dataset'])[np.random.randint(config['num_classes_dataset'],
+                                                                             size=batch_size)],
+                 is_train: training}
+    for _ in range(WARMUP_STEPS):
+        sess.run(fetches, feed_dict=feed_dict)
+    start = time.time()
+    for _ in range(steps):
+        sess.run(fetches, feed_dict=feed_dict)
+    duration = time.time() - start
+    sess.close()
+
+    return {'steps_per_s': steps / duration,
+            'patches_per_s': steps * batch_size / duration,
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'input_dims': int(x_feed.shape[-1])}
+
+
+def run_probe(config, batch_size, training):
+    # a probe that runs out of memory (or crashes) returns None
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        try:
+            return executor.submit(probe_model, config, batch_size, training).result()
+        except (BrokenProcessPool, MemoryError) as e:
+            print('Batch size {} failed: {}'.format(batch_size, repr(e)))
+        except Exception as e:  # e.g., tf.errors.ResourceExhaustedError
+            print('Batch size {} failed: {}'.format(batch_size, e.__class__.__name__))
+    return None
+
+
+def probe_loader(config, data_gen, id2audio_repr_path, ids, id2gt, batch_size, n_active):
+    # the training streamer of `train.py`, reading real patches
+    pack = [config, config['train_sampling'], config['param_train_sampling']]
+    streams = [pescador.Streamer(data_gen, id, id2audio_repr_path[id], id2gt[id], pack) for id in ids]
+    mux_stream = pescador.StochasticMux(streams, n_active=n_active, rate=None, mode='exhaustive')
+    batch_streamer = pescador.Streamer(pescador.buffer_stream, mux_stream, buffer_size=batch_size, partial=True)
+    batch_streamer = pescador.ZMQStreamer(batch_streamer)
+
+    patches, start = 0, None
+    for i, batch in enumerate(batch_streamer):
+        if i == 0:
+            start = time.time()  # skip the start of the streamer
+        else:
+            patches += len(batch['X'])
+        if i == LOADER_BATCHES:
+            break
+    if not patches:
+        return None
+    return {'patches_per_s': patches / (time.time() - start)}
+
+
+def recommend(results, tolerance, max_memory=None):
+    # the smallest setting within `tolerance` of the best throughput that fits in memory
+    valid = {k: r for k, r in results.items() if r and (max_memory is None or r.get('peak_rss_mb', 0) <= max_memory)}
+    if not valid:
+        return None
+    best = max(r['patches_per_s'] for r in valid.values())
+    return min(k for k, r in valid.items() if r['patches_per_s'] >= (1 - tolerance) * best)
+
+
+def tuned_config_file(config_file):
+    # by default the recommendations are written next to the configuration: `config_0_tuned.json`
+    config_file = Path(config_file)
+    return config_file.with_name(config_file.stem + '_tuned' + config_file.suffix)
+
+
+def write_config(full_config, recommendation, output):
+    full_config = dict(full_config, config_train=dict(full_config['config_train'], **recommendation))
+    with open(output, 'w') as f:
+        json.dump(full_config, f, indent=4)
+
+
+def print_results(title, results, key_name):
+    print('\n' + title)
+    columns = [('steps_per_s', 'steps/s', '{:>12.2f}'), ('patches_per_s', 'patches/s', '{:>12.1f}'),
+               ('peak_rss_mb', 'peak MB', '{:>12.0f}')]
+    print('{:>12}'.format(key_name) + ''.join(' {:>12}'.format(name) for _, name, _ in columns))
+    for key, result in sorted(results.items()):
+        if result is None:
+            print('{:>12} {:>12}'.format(key, 'failed'))
+        else:
+            print('{:>12}'.format(key) + ''.join(' ' + (fmt.format(result[k]) if k in result else '{:>12}'.format('-'))
+                                                 for k, _, fmt in columns))
+
+
+if __name__ == '__main__':
+    # Measures the throughput of the configured model for several batch sizes (training and
+    # inference) and of the training data loader for several numbers of active streams
+    # (pescador's `n_active`), and writes the recommended `batch_size`, `val_batch_size`,
+    # `test_batch_size` and `n_active` into a copy of the configuration file.
+    # Example: python tune.py ../configs/config_0.json --max_memory 8000
+    parser = argparse.ArgumentParser()
+    parser.add_argument('config_file', help='configuration file')
+    parser.add_argument('-b', '--batch_sizes', type=int, nargs='+', default=BATCH_SIZES, help='batch sizes to probe')
+    parser.add_argument('-n', '--n_active_factors', type=int, nargs='+', default=N_ACTIVE_FACTORS,
+                        help='numbers of active streams to probe, as multiples of the batch size')
+    parser.add_argument('--max_memory', type=float, help='maximum peak memory (MB) of the training process')
+    parser.add_argument('--tolerance', type=float, default=0.05,
+                        help='prefer smaller settings within this fraction of the best throughput')
+    parser.add_argument('--synthetic', action='store_true', help='do not probe the data loader (no data needed)')
+    parser.add_argument('-o', '--output',
+                        help='configuration file to write. By default, `config_file` with a `_tuned` suffix')
+
+    args = parser.parse_args()
+
+    with open(args.config_file, 'r') as f:
+        full_config = json.load(f)
+    config = patch_config(dict(full_config['config_train']))
+    np.random.seed(seed=config['seed'])
+
+    recommendation = dict()
+
+    train_results = {b: run_probe(config, b, True) for b in args.batch_sizes}
+    print_results('Training', train_results, 'batch_size')
+    recommendation['batch_size'] = recommend(train_results, args.tolerance, args.max_memory)
+
+    inference_results = {b: run_probe(config, b, False) for b in args.batch_sizes}
+    print_results('Inference', inference_results, 'batch_size')
+    recommendation['val_batch_size'] = recommend(inference_results, args.tolerance, args.max_memory)
+    recommendation['test_batch_size'] = recommendation['val_batch_size']
+
+    if not args.synthetic and recommendation['batch_size']:
+        batch_size = recommendation['batch_size']
+        if config.get('activation_cache'):
+            from data_loaders import data_gen_activations as data_gen
+            file_index = Path(config['activation_cache']) / 'index_activations.tsv'
+            config['activation_dims'] = train_results[batch_size]['input_dims']
+        elif 'audio_representation_dirs' in config:
+            from data_loaders import data_gen_feature_combination as data_gen
+            file_index = Path(full_config['data_dir']) / 'index_repr.tsv'
+        else:
+            from data_loaders import data_gen_standard as data_gen
+            file_index = Path(full_config['data_dir']) / 'index_repr.tsv'
+        [_, id2audio_repr_path] = shared.load_id2path(file_index)
+        [ids_train, id2gt_train] = shared.load_id2gt(config['gt_train'])
+
+        loader_results = {f * batch_size: probe_loader(config, data_gen, id2audio_repr_path, ids_train, id2gt_train,
+                                                       batch_size, f * batch_size)
+                          for f in args.n_active_factors}
+        print_results('Data loader (batch size {})'.format(batch_size), loader_results, 'n_active')
+        recommendation['n_active'] = recommend(loader_results, args.tolerance)
+
+        loader_best = max([r['patches_per_s'] for r in loader_results.values() if r] or [0])
+        train_best = train_results[batch_size]['patches_per_s']
+        if loader_best < train_best:
+            print('\nThe data loader ({:.1f} patches/s) is slower than the training ({:.1f} patches/s): '
+                  'the training will be input-bound.'.format(loader_best, train_best))
+
+    recommendation = {k: v for k, v in recommendation.items() if v is not None}
+    print('\nRecommended settings: {}'.format(recommendation))
+
+    output = args.output or tuned_config_file(args.config_file)
+    write_config(full_config, recommendation, output)
+    print('Configuration written to {}'.format(output))
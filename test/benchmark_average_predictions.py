@@ -0,0 +1,54 @@
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+import shared  # noqa: E402
+
+
+def average_predictions_loop(pred_array, id_array, ids):
+    # previous implementation: a search of `id_array` per id
+    y_pred = []
+    for id in ids:
+        avg = np.mean(pred_array[np.where(id_array == id)], axis=0)
+        if np.isfinite(avg).all():
+            y_pred.append(avg)
+    return y_pred
+
+
+if __name__ == '__main__':
+    # Compares the per-id loop with `shared.average_predictions_ids` on a test set of the size of
+    # the MSD one. Example: python test/benchmark_average_predictions.py --tracks 28000
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tracks', type=int, default=28000)
+    parser.add_argument('--patches', type=int, default=30, help='patches per track')
+    parser.add_argument('--classes', type=int, default=50)
+    parser.add_argument('--loop_tracks', type=int, default=2000,
+                        help='tracks timed with the loop, whose cost is extrapolated to all the tracks')
+
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    ids = np.array(['TR{:016d}'.format(i) for i in range(args.tracks)])
+    id_array = np.repeat(ids, args.patches)
+    pred_array = rng.rand(len(id_array), args.classes).astype('float32')
+
+    start = time.time()
+    expected = average_predictions_loop(pred_array, id_array, ids[:args.loop_tracks])
+    loop_time = (time.time() - start) * args.tracks / args.loop_tracks
+
+    times = {}
+    for pooling in shared.POOLINGS:
+        start = time.time()
+        y_pred, _ = shared.average_predictions_ids(pred_array, id_array, ids, pooling=pooling)
+        times[pooling] = time.time() - start
+        if pooling == 'mean':
+            np.testing.assert_allclose(y_pred[:args.loop_tracks], expected, rtol=1e-6)
+
+    print('{} tracks x {} patches x {} classes'.format(args.tracks, args.patches, args.classes))
+    print('loop (extrapolated): {:8.2f}s'.format(loop_time))
+    for pooling, duration in times.items():
+        print('{:19} {:8.2f}s ({:.0f}x)'.format(pooling + ':', duration, loop_time / duration))
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+import adaptive_inference
+
+
+def test_spread_order():
+    for n in [1, 2, 5, 8, 13]:
+        order = adaptive_inference.spread_order(n)
+        assert sorted(order) == list(range(n))
+    np.testing.assert_array_equal(adaptive_inference.spread_order(8), [4, 2, 6, 1, 5, 3, 7, 0])
+
+
+class MeanModel:
+    def predict(self, X):
+        return 1 / (1 + np.exp(-X.mean(axis=1)))
+
+
+def test_adaptive_averager():
+    # the averager stops at the patch found from the predictions of all the patches
+    rng = np.random.RandomState(0)
+    tracks = [{'X': rng.randn(1, n, 2).astype('float32'), 'ID': np.array([str(i)])}
+              for i, n in enumerate([2, 4, 30, 60, 90, 17])]
+    model = MeanModel()
+    for tolerance in [0, 0.005, 0.05]:
+        averager = adaptive_inference.AdaptiveAverager(model, 2, 1, tolerance, min_patches=3, batch_size=4)
+        results = {id: (mean, used, total) for id, mean, used, total in averager.predict(tracks)}
+        assert len(results) == len(tracks)
+        for track in tracks:
+            patches = adaptive_inference.overlap_patches(track['X'][0], 2, 1)
+            pred = model.predict(patches)[adaptive_inference.spread_order(len(patches))]
+            n = adaptive_inference.exit_point(pred, tolerance, min_patches=3)
+            mean, used, total = results[track['ID'][0]]
+            assert (used, total) == (n, len(patches))
+            np.testing.assert_allclose(mean, pred[:n].mean(axis=0), rtol=1e-6)
+            if tolerance == 0:
+                assert used == total
+
+
+def test_adaptive_averager_reads_ahead():
+    # at most `batch_size` tracks are read from the stream before they are predicted
+    rng = np.random.RandomState(0)
+    tracks = [{'X': rng.randn(1, 20, 2).astype('float32'), 'ID': np.array([str(i)])} for i in range(40)]
+    pulled = []
+
+    def stream():
+        for track in tracks:
+            pulled.append(track['ID'][0])
+            yield track
+
+    averager = adaptive_inference.AdaptiveAverager(MeanModel(), 2, 1, 0, batch_size=4)
+    for done, (id, _, used, total) in enumerate(averager.predict(stream()), start=1):
+        assert used == total
+        assert len(pulled) <= done + 3
+    assert done == len(tracks)
+
+
+def test_adaptive_prediction():
+    config = {'xInput': 2, 'inference_hop': 1, 'num_classes_dataset': 2}
+    tracks = [{'X': np.random.RandomState(0).randn(1, 9, 2).astype('float32'), 'ID': np.array(['a'])}]
+    pred, ids, used = adaptive_inference.adaptive_prediction(tracks, MeanModel(), config, 0.01)
+    assert pred.shape == (1, 2) and list(ids) == ['a'] and 2 <= used['a'] <= 8
+
+    # no tracks
+    pred, ids, used = adaptive_inference.adaptive_prediction([], MeanModel(), config, 0.01)
+    assert pred.shape == (0, 2) and len(ids) == 0 and used == {}
+
+    # the patches are averaged: no other pooling
+    with pytest.raises(ValueError):
+        adaptive_inference.adaptive_prediction(tracks, MeanModel(), dict(config, prediction_pooling='max'), 0.01)
@@ -0,0 +1,49 @@
+import numpy as np
+import tensorflow.compat.v1 as tf
+
+import cache_activations
+import data_loaders
+from models_transfer_learning import FROZEN_FEATURES
+import train
+
+
+def test_cached_activations(tmp_path):
+    config = {'xInput': 32, 'yInput': 96, 'num_classes_dataset': 3, 'model_number': 11, 'seed': 0,
+              'is_multilabel_task': True, 'weight_decay': None, 'load_model': str(tmp_path / 'pretrained') + '/',
+              'feature_params': {'n_mels': 96}, 'activation_cache': str(tmp_path / 'cache')}
+    patches = np.random.RandomState(0).rand(70, 32, 96).astype('float32')
+
+    # the training graph with random weights, stored as the pre-trained model
+    graph = tf.Graph()
+    with graph.as_default():
+        x, y_, is_train, y, normalized_y, cost, model_vars = train.tf_define_model_and_cost(dict(config))
+        sess = tf.Session()
+        sess.run(tf.global_variables_initializer())
+        tf.train.Saver().save(sess, config['load_model'])
+
+    # the activations computed and stored as by `cache_activations.py`, with the frozen graph
+    with tf.Graph().as_default():
+        x_frozen, _, _, _, _, _, frozen_vars = train.tf_define_model_and_cost_freeze(dict(config))
+        with tf.Session() as frozen_sess:
+            frozen_sess.run(tf.global_variables_initializer())
+            tf.train.Saver(var_list=frozen_vars[:-4]).restore(frozen_sess, config['load_model'])
+            activations = cache_activations.compute_activations(
+                frozen_sess, x_frozen, tf.get_collection(FROZEN_FEATURES)[0], patches)
+    (tmp_path / 'cache').mkdir()
+    activations.astype('float16').tofile(str(tmp_path / 'cache' / 'track.dat'))
+
+    # `train.py` feeds them (read by `data_gen_activations`) to the frozen features
+    with graph.as_default():
+        x_feed = tf.get_collection(FROZEN_FEATURES)[0]
+        config['activation_dims'] = int(x_feed.shape[-1])
+        cached = np.stack([patch['X'] for patch in data_loaders.data_gen_activations(
+            'id', 'track.dat', [0, 1, 0], [config, 'overlap_sampling', None])])
+        assert cached.shape == (len(patches), config['activation_dims'])
+
+        expected = sess.run(normalized_y, feed_dict={x: patches, is_train: False})
+        np.testing.assert_allclose(sess.run(x_feed, feed_dict={x: patches, is_train: False}), activations, rtol=1e-4,
+                                   atol=1e-5)
+        # up to the float16 storage of the activations
+        np.testing.assert_allclose(sess.run(normalized_y, feed_dict={x_feed: cached, is_train: False}), expected,
+                                   atol=1e-4)
+        sess.close()
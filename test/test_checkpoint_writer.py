@@ -0,0 +1,35 @@
+import numpy as np
+import tensorflow.compat.v1 as tf
+
+import checkpoint_writer
+
+
+def test_write_best_model(tmp_path):
+    graph = tf.Graph()
+    with graph.as_default():
+        variable = tf.Variable(np.zeros(3, dtype='float32'), name='weights')
+        sess = tf.Session()
+        sess.run(tf.global_variables_initializer())
+
+        writer = checkpoint_writer.CheckpointWriter([variable], max_pending=1)
+        for epoch in range(1, 4):
+            variable.load(np.full(3, epoch, dtype='float32'), sess)
+            writer.submit(writer.snapshot(sess), [
+                lambda save, epoch=epoch: checkpoint_writer.write_best_model(save, tmp_path, epoch, keep=2)])
+        writer.close()
+
+        # the last snapshot is the checkpoint of the experiment, also after moving its folder
+        model_folder = tmp_path.rename(tmp_path.with_name(tmp_path.name + '-moved'))
+        variable.load(np.zeros(3, dtype='float32'), sess)
+        tf.train.Saver().restore(sess, checkpoint_writer.checkpoint_prefix(model_folder))
+        np.testing.assert_array_equal(sess.run(variable), [3, 3, 3])
+
+        # a checkpoint being written is not read
+        (model_folder / 'checkpoints' / '.tmp-epoch-4').mkdir()
+        assert checkpoint_writer.checkpoint_prefix(model_folder) == str(model_folder / 'checkpoints' / 'epoch-3') + '/'
+
+        # experiments without a `checkpoint` file are read from their `model_folder/` prefix
+        tf.train.Saver().save(sess, str(tmp_path) + '/', write_state=False)
+        assert checkpoint_writer.checkpoint_prefix(tmp_path) == str(tmp_path) + '/'
+
+    assert sorted(f.name for f in (model_folder / 'checkpoints').iterdir()) == ['.tmp-epoch-4', 'epoch-2', 'epoch-3']
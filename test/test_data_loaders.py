@@ -0,0 +1,110 @@
+import numpy as np
+import pytest
+
+import data_loaders
+
+
+def waveform_config(tmp_path, x_input):
+    return {
+        'audio_representation_dir': str(tmp_path),
+        'xInput': x_input,
+        'yInput': 1,
+        'feature_params': {'compression': None, 'dtype': 'int16'},
+    }
+
+
+def test_data_gen_waveform_int16(tmp_path):
+    audio = np.linspace(-1, 0.99, 1000).astype('float32')
+    np.round(audio * data_loaders.INT16_SCALE).astype('int16').tofile(str(tmp_path / 'track.dat'))
+
+    config = waveform_config(tmp_path, x_input=300)
+    pack = [config, 'overlap_sampling', 300]
+    patches = list(data_loaders.data_gen_standard('id', 'track.dat', [1, 0], pack))
+
+    assert len(patches) == 3
+    assert patches[0]['X'].shape == (300, 1)
+    np.testing.assert_allclose(patches[1]['X'][:, 0], audio[300:600], atol=1e-4)
+
+
+def test_data_gen_waveform_int16_random(tmp_path):
+    audio = np.linspace(-1, 0.99, 1000).astype('float32')
+    np.round(audio * data_loaders.INT16_SCALE).astype('int16').tofile(str(tmp_path / 'track.dat'))
+
+    config = waveform_config(tmp_path, x_input=300)
+    pack = [config, 'random', 5]
+    patches = list(data_loaders.data_gen_standard('id', 'track.dat', [1, 0], pack))
+
+    assert len(patches) == 5
+    for patch in patches:
+        assert patch['X'].shape == (300, 1)
+        assert np.abs(patch['X']).max() <= 1
+
+
+def test_cache_patches(tmp_path):
+    rng = np.random.RandomState(0)
+    batches = [{'X': rng.randn(n, 4, 3), 'Y': rng.randint(0, 2, (n, 2)).astype('float64')} for n in (5, 5, 2)]
+
+    for cache_file in (None, tmp_path / 'val'):
+        X, Y = data_loaders.cache_patches(iter(batches), cache_file=cache_file)
+        assert X.shape == (12, 4, 3) and X.dtype == np.float16
+        assert Y.shape == (12, 2)
+
+        cached = list(data_loaders.iterate_patches(X, Y, 8))
+        assert [len(batch['X']) for batch in cached] == [8, 4]
+        np.testing.assert_allclose(cached[1]['X'][2:], batches[2]['X'].astype('float16'))
+        np.testing.assert_array_equal(cached[0]['Y'][:5], batches[0]['Y'])
+
+        with pytest.raises(ValueError):
+            data_loaders.cache_patches(iter([]), cache_file=cache_file)
+
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_prefetcher():
+    prefetcher = data_loaders.Prefetcher(({'X': np.full(2, i)} for i in range(10)), size=3)
+    assert [batch['X'][0] for batch in prefetcher] == list(range(10))
+    assert prefetcher.depth() == 0
+
+    def failing():
+        yield {'X': np.zeros(2)}
+        raise IOError('broken stream')
+
+    with pytest.raises(IOError):
+        list(data_loaders.Prefetcher(failing()))
+
+
+def test_overlap_patches():
+    audio_rep = np.arange(2 * 37 * 5, dtype='float32').reshape(37, 10)[:, ::2]  # not contiguous
+    for window, hop in [(8, 3), (8, 8), (37, 1), (1, 5)]:
+        patches = data_loaders.overlap_patches(audio_rep, window, hop)
+        expected = [audio_rep[start: start + window] for start in range(0, len(audio_rep) - window + 1, hop)]
+        np.testing.assert_array_equal(patches, expected)
+        assert not patches.flags.writeable
+
+    with pytest.raises(ValueError):
+        data_loaders.overlap_patches(audio_rep, 38, 1)
+
+
+def test_patch_batches(tmp_path):
+    rng = np.random.RandomState(0)
+    config = {'audio_representation_dir': str(tmp_path), 'xInput': 10, 'yInput': 3,
+              'feature_params': {'compression': None}}
+    for i, frames in enumerate([37, 4, 25, 4, 6, 10]):
+        rng.rand(frames, 3).astype('float16').tofile(str(tmp_path / '{}.dat'.format(i)))
+
+    def tracks(sampling):
+        for i in range(6):
+            yield from data_loaders.data_gen_standard(str(i), '{}.dat'.format(i), [0], [config, sampling, 4])
+
+    # the patches and ids of `overlap_sampling`, in batches filled across tracks
+    patches = list(tracks('overlap_sampling'))
+    batches = list(data_loaders.patch_batches(tracks('whole_track'), 10, 4, batch_size=5))
+    assert [len(batch['X']) for batch in batches] == [5, 5, 5]
+    np.testing.assert_array_equal(np.concatenate([batch['X'] for batch in batches]),
+                                  np.stack([patch['X'] for patch in patches]))
+    np.testing.assert_array_equal(np.hstack([batch['ID'] for batch in batches]), [patch['ID'] for patch in patches])
+
+    # the short tracks are not padded, and batched by length
+    batches = list(data_loaders.patch_batches(tracks('whole_track'), 10, 4, batch_size=5, variable_length=True))
+    assert [batch['X'].shape[:2] for batch in batches] == [(5, 10), (5, 10), (2, 10), (2, 4), (1, 6)]
+    np.testing.assert_array_equal(batches[3]['ID'], ['1', '3'])
@@ -0,0 +1,65 @@
+import argparse
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import tensorflow.compat.v1 as tf
+
+import distributed
+
+
+def run_worker(output_dir, worker_hosts, task_index):
+    # toy variables and values that differ between the workers, reduced by every collective
+    cluster = distributed.Cluster(worker_hosts.split(','), task_index)
+    rank = float(task_index)
+
+    weights = tf.Variable([rank + 1, 2 * rank + 2], name='weights')
+    moving_mean = tf.Variable([rank, 10 * rank], name='moving_mean')
+    x = tf.placeholder(tf.float32, [2])
+    grads_and_vars = tf.train.GradientDescentOptimizer(0.1).compute_gradients(tf.reduce_sum(weights * x),
+                                                                              [weights])
+    [(gradient, _)] = cluster.average_gradients(grads_and_vars)
+    broadcast_weights = cluster.sync_variables([weights], broadcast=True)
+    average_statistics = cluster.sync_variables(distributed.batchnorm_statistics())
+    sums_in, sums_out = cluster.scalars(3)
+    state_in, state_out = cluster.scalars(2, broadcast=True)
+
+    with cluster.session() as sess:
+        sess.run(tf.global_variables_initializer())
+        results = {'gradient': sess.run(gradient, {x: [rank, 3 * rank + 1]}).tolist()}
+        sess.run([broadcast_weights, average_statistics])
+        results['weights'], results['moving_mean'] = [v.tolist() for v in sess.run([weights, moving_mean])]
+        results['sums'] = sess.run(sums_out, {sums_in: [rank, 1, 2 * rank]}).tolist()
+        results['state'] = sess.run(state_out, {state_in: [rank + 5, rank]}).tolist()
+
+    with open(Path(output_dir, 'worker_{}.json'.format(task_index)), 'w') as f:
+        json.dump(results, f)
+
+
+def test_local_workers(tmp_path, monkeypatch):
+    # the workers run this file, as `train.py --workers 2` runs `train.py`
+    monkeypatch.setenv('PYTHONPATH', os.pathsep.join([str(Path(distributed.__file__).parent),
+                                                      os.environ.get('PYTHONPATH', '')]))
+    assert distributed.launch_local_workers(2, [__file__, str(tmp_path)]) == 0
+
+    results = []
+    for task_index in range(2):
+        with open(tmp_path / 'worker_{}.json'.format(task_index)) as f:
+            results.append(json.load(f))
+    assert results[0] == results[1]
+
+    np.testing.assert_allclose(results[0]['gradient'], [0.5, 2.5])  # averaged
+    np.testing.assert_allclose(results[0]['weights'], [1, 2])  # the chief values
+    np.testing.assert_allclose(results[0]['moving_mean'], [0.5, 5])  # averaged
+    np.testing.assert_allclose(results[0]['sums'], [1, 2, 2])  # summed
+    np.testing.assert_allclose(results[0]['state'], [5, 0])  # the chief values
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('output_dir')
+    parser.add_argument('--worker_hosts')
+    parser.add_argument('--task_index', type=int)
+    args = parser.parse_args()
+    run_worker(args.output_dir, args.worker_hosts, args.task_index)
@@ -0,0 +1,48 @@
+import numpy as np
+import tensorflow.compat.v1 as tf
+
+import ensemble
+import linear_probe
+
+
+def test_ensemble(tmp_path):
+    config = {'xInput': 1, 'yInput': 5, 'num_classes_dataset': 3, 'coupling_layer_units': 6, 'model_number': 0,
+              'load_model': None, 'seed': 0, 'is_multilabel_task': True, 'weight_decay': None,
+              'feature_params': {}}
+    rng = np.random.RandomState(0)
+    X = rng.randn(10, 5).astype('float32')
+
+    # two linear models stored as perceptrons
+    weights = [(rng.randn(5, 3), rng.randn(3)) for _ in range(2)]
+    for i, (W, b) in enumerate(weights):
+        linear_probe.export_model(config, W, b, tmp_path / str(i))
+    predictions = [linear_probe.predict(X, W, b) for W, b in weights]
+
+    models = ensemble.Ensemble([config] * 2, [tmp_path / '0', tmp_path / '1'], weights=[3, 1])
+    np.testing.assert_allclose(models.predict(X[:, None, :]), 0.75 * predictions[0] + 0.25 * predictions[1],
+                               rtol=1e-4, atol=1e-6)
+    models.close()
+
+
+def test_frozen_model(tmp_path):
+    config = {'xInput': 1, 'yInput': 5, 'num_classes_dataset': 3, 'coupling_layer_units': 6, 'model_number': 0,
+              'load_model': None, 'seed': 0, 'is_multilabel_task': True, 'weight_decay': None,
+              'feature_params': {}}
+    rng = np.random.RandomState(0)
+    X = rng.randn(10, 1, 5).astype('float32')
+    linear_probe.export_model(config, rng.randn(5, 3), rng.randn(3), tmp_path)
+
+    # the weights as constants, as `freeze_model.py` does
+    graph = tf.Graph()
+    with graph.as_default():
+        linear_probe.train.tf_define_model_and_cost_freeze(config)
+        sess = tf.Session()
+        tf.train.Saver().restore(sess, str(tmp_path) + '/')
+        graph_def = tf.graph_util.convert_variables_to_constants(sess, graph.as_graph_def(), ['model/Sigmoid'])
+        tf.io.write_graph(graph_def, str(tmp_path), 'model.pb', as_text=False)
+
+    frozen = ensemble.Ensemble([config], [tmp_path / 'model.pb'])
+    restored = ensemble.Ensemble([config], [tmp_path])
+    np.testing.assert_allclose(frozen.predict(X), restored.predict(X), rtol=1e-6)
+    frozen.close()
+    restored.close()
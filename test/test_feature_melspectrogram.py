@@ -0,0 +1,56 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+import feature_melspectrogram
+import preprocess
+
+MODELS_PATH = Path(feature_melspectrogram.__file__).parent / 'models'
+
+
+def write_melspectrogram(path, frames, bands=96):
+    mel = np.random.RandomState(0).rand(frames, bands).astype('float32')
+    assert preprocess.write_audio_repr(iter([mel[:frames // 2], mel[frames // 2:]]), path) == frames
+    return mel
+
+
+def test_melspectrogram_from_file(tmp_path):
+    # the number of frames is found from the size of the file
+    mel = write_melspectrogram(tmp_path / 'track.dat', 301)
+    stored = feature_melspectrogram.MelSpectrogramFromFile(96).compute(str(tmp_path / 'track.dat'))
+    assert stored.shape == mel.shape and stored.dtype == 'float32'
+    np.testing.assert_array_equal(stored, mel.astype('float16'))
+
+    # the features that are not embeddings are not computed from stored mel-spectrograms
+    for feature_type in ['waveform', 'musicnn-melspectrogram']:
+        with pytest.raises(ValueError):
+            preprocess.get_extractor(feature_type, from_melspectrogram=True)
+
+
+class StoredMelSpectrogram:
+    def __init__(self, mel):
+        self.mel = mel
+
+    def compute(self, audio_file):
+        return self.mel
+
+
+def test_embedding_from_melspectrogram(tmp_path):
+    if not hasattr(pytest.importorskip('essentia.standard'), 'TensorflowPredict'):
+        pytest.skip('needs essentia-tensorflow')
+    import feature_embeddings
+
+    # only the models taking the stored mel-spectrogram types
+    with pytest.raises(ValueError):
+        feature_embeddings.EmbeddingFromMelSpectrogram('openl3', models_path=MODELS_PATH, from_melspectrogram=True)
+
+    mel = write_melspectrogram(tmp_path / 'track.dat', 400)
+    extractor = feature_embeddings.EmbeddingFromMelSpectrogram('musicnn', models_path=MODELS_PATH,
+                                                                from_melspectrogram=True)
+    assert isinstance(extractor.mel_extractor, feature_melspectrogram.MelSpectrogramFromFile)
+    embeddings = extractor.compute(str(tmp_path / 'track.dat'))
+
+    # the same as the embeddings of the mel-spectrogram computed from the audio
+    extractor.mel_extractor = StoredMelSpectrogram(mel.astype('float16').astype('float32'))
+    np.testing.assert_allclose(embeddings, extractor.compute(None), rtol=1e-5)
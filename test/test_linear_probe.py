@@ -0,0 +1,25 @@
+import numpy as np
+import tensorflow.compat.v1 as tf
+
+import linear_probe
+
+
+def test_export_model(tmp_path):
+    rng = np.random.RandomState(0)
+    X = rng.randn(20, 5).astype('float32')
+    Y = (X[:, :3] > 0).astype('float32')
+    W, b = linear_probe.fit(X, Y, C=1.)
+
+    config = {'xInput': 1, 'yInput': 5, 'num_classes_dataset': 3, 'coupling_layer_units': 8, 'model_number': 0,
+              'load_model': None, 'seed': 0, 'is_multilabel_task': True, 'weight_decay': None,
+              'feature_params': {}}
+    linear_probe.export_model(config, W, b, tmp_path)
+
+    # the restored perceptron predicts as the linear model
+    graph = tf.Graph()
+    with graph.as_default():
+        [x, y_, is_train, y, normalized_y, cost, _] = linear_probe.train.tf_define_model_and_cost(config)
+        sess = tf.Session()
+        tf.train.Saver().restore(sess, str(tmp_path) + '/')
+        pred = sess.run(normalized_y, feed_dict={x: X[:, None, :], is_train: False})
+    np.testing.assert_allclose(pred, linear_probe.predict(X, W, b), rtol=1e-4, atol=1e-6)
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+import tensorflow.compat.v1 as tf
+
+import models_melspectrogram
+
+
+def compute(audio, melspectrogram_type):
+    with tf.Graph().as_default():
+        x = tf.placeholder(tf.float32, [None, None])
+        mel = models_melspectrogram.melspectrogram(x, melspectrogram_type)
+        with tf.Session() as sess:
+            return sess.run(mel, feed_dict={x: audio[np.newaxis]})[0]
+
+
+@pytest.mark.parametrize('melspectrogram_type', ['musicnn', 'vggish'])
+def test_melspectrogram_sine(melspectrogram_type):
+    params = models_melspectrogram.MELSPECTROGRAMS[melspectrogram_type]
+    sample_rate = params['sample_rate']
+    audio = np.sin(2 * np.pi * 1000 * np.arange(sample_rate) / sample_rate).astype('float32')
+
+    mel = compute(audio, melspectrogram_type)
+
+    assert mel.shape == (models_melspectrogram.number_of_frames(len(audio), melspectrogram_type),
+                         params['number_bands'])
+
+    # the band with more energy is the one centered closer to 1 kHz
+    mels = np.linspace(models_melspectrogram.hz2mel(params['low_frequency_bound'], params['warping_formula']),
+                       models_melspectrogram.hz2mel(params['high_frequency_bound'], params['warping_formula']),
+                       params['number_bands'] + 2)
+    centers = models_melspectrogram.mel2hz(mels, params['warping_formula'])[1:-1]
+    assert abs(np.argmax(mel.mean(axis=0)) - np.argmin(np.abs(centers - 1000))) <= 1
+
+
+@pytest.mark.parametrize('melspectrogram_type', ['musicnn', 'vggish'])
+def test_melspectrogram_matches_essentia(melspectrogram_type):
+    es = pytest.importorskip('essentia.standard')
+    params = models_melspectrogram.MELSPECTROGRAMS[melspectrogram_type]
+    if melspectrogram_type == 'musicnn':
+        extractor = es.TensorflowInputMusiCNN()
+    else:
+        extractor = es.TensorflowInputVGGish()
+
+    audio = np.random.RandomState(0).uniform(-0.5, 0.5, params['sample_rate']).astype('float32')
+    expected = np.array([extractor(frame) for frame in es.FrameGenerator(
+        audio, frameSize=params['frame_size'], hopSize=params['hop_size'])])
+
+    # Essentia centers the first frame at the first sample
+    padded = np.hstack([np.zeros(params['frame_size'] // 2, dtype='float32'), audio])
+    mel = compute(padded, melspectrogram_type)
+
+    n = min(len(mel), len(expected))
+    np.testing.assert_allclose(mel[:n], expected[:n], atol=1e-3, rtol=1e-3)
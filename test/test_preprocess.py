@@ -0,0 +1,155 @@
+import tarfile
+import wave
+import zipfile
+
+import numpy as np
+import pytest
+
+from data_loaders import INT16_SCALE, read_mmap
+import preprocess
+
+WAVEFORM_PARAMS = {'sample_rate': 16000, 'dtype': 'int16'}
+
+
+def write_wav(path, samples):
+    with wave.open(str(path), 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(16000)
+        f.writeframes(samples.astype('<i2').tobytes())
+
+
+def read_index(audio_representation_dir):
+    with open(audio_representation_dir / 'index.tsv') as f:
+        index = dict(line.rstrip('\n').split('\t') for line in f)
+    return {id: np.fromfile(audio_representation_dir / path, dtype='int16') for id, path in index.items()}, index
+
+
+def make_audio(folder):
+    rng = np.random.RandomState(0)
+    audio = {name: rng.randint(-2 ** 15, 2 ** 15, size=size).astype('int16')
+             for name, size in [('a.wav', 8000), ('b.wav', 12345), ('c.wav', 300)]}
+    folder.mkdir()
+    for name, samples in audio.items():
+        write_wav(folder / name, samples)
+    return audio
+
+
+def test_write_audio_repr(tmp_path, monkeypatch):
+    # batches of several sizes, cast and written in chunks of a few rows
+    monkeypatch.setattr(preprocess, 'WRITE_CHUNK_BYTES', 64)
+    rng = np.random.RandomState(0)
+    batches = [rng.rand(size, 5).astype('float32') for size in [7, 1, 20, 3]]
+    audio_repr = np.vstack(batches)
+
+    audio_repr_file = tmp_path / 'track.dat'
+    assert preprocess.write_audio_repr(iter(batches), audio_repr_file) == len(audio_repr)
+    np.testing.assert_array_equal(read_mmap(audio_repr_file, 8, 5, len(audio_repr)), audio_repr.astype('float16'))
+
+    # waveforms stored as int16, read back in [-1, 1)
+    samples = np.clip(np.round((audio_repr[:, :1] * 2 - 1) * INT16_SCALE), -INT16_SCALE, INT16_SCALE - 1)
+    batches = np.split(samples.astype('int16'), [5, 6, 30])
+    assert preprocess.write_audio_repr((b for b in batches), audio_repr_file, dtype='int16') == len(samples)
+    np.testing.assert_array_equal(read_mmap(audio_repr_file, 8, 1, len(samples), dtype='int16'),
+                                  samples / INT16_SCALE)
+    assert not list(tmp_path.glob('*.tmp'))
+
+
+class ConstantExtractor:
+    def __init__(self, hop_size=256):
+        self.hop_size = hop_size
+        self.model = object()  # not part of the signature
+
+    def compute(self, audio_file):
+        return np.full([4, 3], self.hop_size, dtype='float32')
+
+
+def test_content_addressed_cache(tmp_path):
+    for name, content in [('a.mp3', b'audio a'), ('a-copy.mp3', b'audio a'), ('b.mp3', b'audio b')]:
+        (tmp_path / name).write_bytes(content)
+    assert preprocess.hash_file(tmp_path / 'a.mp3', block_size=3) == preprocess.hash_file(tmp_path / 'a-copy.mp3')
+    assert preprocess.hash_file(tmp_path / 'a.mp3') != preprocess.hash_file(tmp_path / 'b.mp3')
+
+    signature = preprocess.extractor_signature('musicnn-melspectrogram', ConstantExtractor())
+    assert signature.startswith('musicnn-melspectrogram-')
+    assert signature == preprocess.extractor_signature('musicnn-melspectrogram', ConstantExtractor())
+    assert signature != preprocess.extractor_signature('musicnn-melspectrogram', ConstantExtractor(hop_size=512))
+    assert signature != preprocess.extractor_signature('vggish-melspectrogram', ConstantExtractor())
+
+    # identical content gets the same path, whatever its name
+    cache_dir = tmp_path / 'cache'
+    path = preprocess.content_addressed_path(tmp_path / 'a.mp3', cache_dir, signature)
+    assert path == preprocess.content_addressed_path(tmp_path / 'a-copy.mp3', cache_dir, signature)
+    assert path != preprocess.content_addressed_path(tmp_path / 'b.mp3', cache_dir, signature)
+    assert path.parent.parent == cache_dir / signature and path.suffix == '.dat'
+
+    # the index has the paths relative to the representation folder, or absolute outside of it
+    for audio_representation_dir in [tmp_path / 'repr', cache_dir]:
+        audio_representation_dir.mkdir(exist_ok=True)
+        for id, audio in [('1', 'a.mp3'), ('2', 'a-copy.mp3'), ('3', 'b.mp3')]:
+            preprocess.do_process(id, str(tmp_path / audio), None, ConstantExtractor(), audio_representation_dir,
+                                  cache_dir=cache_dir, signature=signature)
+        with open(audio_representation_dir / 'index.tsv') as f:
+            index = dict(line.rstrip('\n').split('\t') for line in f)
+        assert index['1'] == index['2'] != index['3']
+        if audio_representation_dir == cache_dir:
+            assert index['1'] == str(path.relative_to(cache_dir))
+        else:
+            assert index['1'] == str(path.resolve())
+        np.testing.assert_array_equal(np.fromfile(str(path), dtype='float16'), np.full(12, 256))
+
+
+def test_process_files_parallel(tmp_path):
+    audio = make_audio(tmp_path / 'audio')
+    for cache_dir in [None, tmp_path / 'cache']:
+        audio_representation_dir = tmp_path / ('repr-cached' if cache_dir else 'repr')
+        audio_representation_dir.mkdir()
+        # the same audio under two ids: with the cache, both workers write the same file
+        files = [(name, str(tmp_path / 'audio' / name), str(audio_representation_dir / name.replace('.wav', '.dat')))
+                 for name in audio]
+        files.append(('copy', str(tmp_path / 'audio' / 'a.wav'), str(audio_representation_dir / 'copy.dat')))
+        preprocess.process_files(files, audio_representation_dir, feature_type='waveform', cache_dir=cache_dir,
+                                 n_jobs=2, feature_params=WAVEFORM_PARAMS)
+
+        features, index = read_index(audio_representation_dir)
+        assert sorted(features) == ['a.wav', 'b.wav', 'c.wav', 'copy']
+        for name, samples in audio.items():
+            np.testing.assert_array_equal(features[name], samples)
+        np.testing.assert_array_equal(features['copy'], audio['a.wav'])
+        if cache_dir:
+            assert index['copy'] == index['a.wav']
+        assert not (audio_representation_dir / 'errors.txt').exists()
+        assert not list(tmp_path.glob('**/*.tmp'))
+
+    # the extractor is checked before starting the workers
+    with pytest.raises(NotImplementedError):
+        preprocess.process_files(files, tmp_path / 'repr', feature_type='unknown', n_jobs=2)
+
+
+def test_process_files_archive(tmp_path):
+    audio = make_audio(tmp_path / 'audio')
+    with zipfile.ZipFile(tmp_path / 'audio.zip', 'w') as zf:
+        for name in audio:
+            zf.write(tmp_path / 'audio' / name, 'mp3/' + name)
+    with tarfile.open(tmp_path / 'audio.tar.gz', 'w:gz') as tf:
+        for name in audio:
+            tf.add(tmp_path / 'audio' / name, './mp3/' + name)  # members named as by `tar -C dir .`
+
+    for archive in ['audio.zip', 'audio.tar.gz']:
+        assert preprocess.is_archive(tmp_path / archive)
+        for n_jobs in [1, 2]:
+            audio_representation_dir = tmp_path / '{}-{}'.format(archive, n_jobs)
+            audio_representation_dir.mkdir()
+            files = [(name, preprocess.ArchiveMember(tmp_path / archive, 'mp3/' + name),
+                      str(audio_representation_dir / name.replace('.wav', '.dat'))) for name in audio]
+            files.append(('missing', preprocess.ArchiveMember(tmp_path / archive, 'mp3/missing.wav'),
+                          str(audio_representation_dir / 'missing.dat')))
+            preprocess.process_files(files, audio_representation_dir, feature_type='waveform', n_jobs=n_jobs,
+                                     feature_params=WAVEFORM_PARAMS)
+
+            features, _ = read_index(audio_representation_dir)
+            assert sorted(features) == sorted(audio)
+            for name, samples in audio.items():
+                np.testing.assert_array_equal(features[name], samples)
+            # the temporary copies of the members are removed
+            assert not list(audio_representation_dir.glob('*.wav'))
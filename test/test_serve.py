@@ -0,0 +1,81 @@
+import io
+import json
+import threading
+import urllib.request
+
+import numpy as np
+
+import data_loaders
+import ensemble
+import linear_probe
+import serve
+
+
+def test_feature_patches(tmp_path):
+    config = {'audio_representation_dir': str(tmp_path), 'xInput': 8, 'yInput': 3,
+              'feature_params': {'compression': 'logC'}}
+    for frames in [30, 5]:
+        features = np.random.RandomState(frames).rand(frames, 3)
+        features.astype('float16').tofile(str(tmp_path / 'track.dat'))
+        patches = [p['X'] for p in data_loaders.data_gen_standard('id', 'track.dat', [0], [config, 'overlap_sampling', 3])]
+        np.testing.assert_allclose(serve.feature_patches(features, config, 3), patches)
+
+    # waveforms stored as int16: the stored values, or float samples in [-1, 1)
+    config = dict(config, yInput=1, feature_params={'compression': None, 'dtype': 'int16'})
+    samples = np.random.RandomState(0).randint(-2 ** 15, 2 ** 15, size=(50, 1)).astype('int16')
+    samples.tofile(str(tmp_path / 'track.dat'))
+    patches = [p['X'] for p in data_loaders.data_gen_standard('id', 'track.dat', [0], [config, 'overlap_sampling', 3])]
+    for features in [samples, samples.astype('int64'), samples / data_loaders.INT16_SCALE,
+                     (samples / data_loaders.INT16_SCALE).astype('float32')]:
+        np.testing.assert_array_equal(serve.feature_patches(features, config, 3), patches)
+
+
+class SumModel:
+    def __init__(self):
+        self.batches = []
+
+    def predict(self, X):
+        self.batches.append(len(X))
+        return X.sum(axis=(1, 2))[:, None]
+
+
+def test_request_batcher():
+    # the tracks submitted within the latency budget share a batch, and are pooled separately
+    model = SumModel()
+    batcher = serve.RequestBatcher(model, batch_size=6, max_latency=10)
+    tracks = [np.full((n, 2, 1), i, dtype='float32') for i, n in enumerate([1, 3, 2])]
+    futures = [batcher.submit(patches) for patches in tracks]
+    assert [future.result()[0] for future in futures] == [0, 2, 4]
+    assert model.batches == [6]
+    batcher.close()
+
+
+def test_tagging_server(tmp_path):
+    config = {'xInput': 1, 'yInput': 5, 'num_classes_dataset': 3, 'coupling_layer_units': 6, 'model_number': 0,
+              'load_model': None, 'seed': 0, 'is_multilabel_task': True, 'weight_decay': None,
+              'feature_params': {'compression': None}}
+    rng = np.random.RandomState(0)
+    linear_probe.export_model(config, rng.randn(5, 3), rng.randn(3), tmp_path)
+    models = ensemble.Ensemble([config], [tmp_path])
+    batcher = serve.RequestBatcher(models, batch_size=4, max_latency=0)
+    server = serve.TaggingServer(('127.0.0.1', 0), config, batcher, hop=1)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}/predict'.format(server.server_address[1])
+
+    tracks = [rng.rand(n, 5).astype('float16') for n in [3, 7]]
+    expected = [models.predict(track[:, None, :].astype('float32')).mean(axis=0) for track in tracks]
+
+    answer = urllib.request.urlopen(urllib.request.Request(url, data=json.dumps(
+        {'features': [track.tolist() for track in tracks]}).encode()))
+    np.testing.assert_allclose(json.loads(answer.read())['predictions'], expected, rtol=1e-5)
+
+    body = io.BytesIO()
+    np.save(body, tracks[1])
+    answer = urllib.request.urlopen(urllib.request.Request(url, data=body.getvalue(),
+                                                           headers={'Content-Type': serve.NPY_CONTENT_TYPE}))
+    np.testing.assert_allclose(json.loads(answer.read())['predictions'], [expected[1]], rtol=1e-5)
+
+    server.shutdown()
+    server.server_close()
+    batcher.close()
+    models.close()
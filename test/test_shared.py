@@ -79,3 +79,64 @@ def test_compute_accuracy_multilabel():
 
     acc_multilabel = shared.compute_accuracy(y_true_ml, y_pred_ml)
     np.testing.assert_allclose(acc_multilabel, 0.5)
+
+
+def test_preload(tmp_path):
+    """
+    Test that preloaded ground truth files are not read again
+    """
+    gt_file = tmp_path / 'gt_train_0.csv'
+    gt_file.write_text('a\t[0, 1]\nb\t[1, 0]\n')
+
+    shared.preload(shared.load_id2gt, gt_file)
+    gt_file.unlink()
+
+    ids, id2gt = shared.load_id2gt(str(gt_file))
+    assert ids == ['a', 'b']
+    assert id2gt['b'] == [1, 0]
+
+
+def average_predictions_loop(pred_array, id_array, ids, pooling=np.mean):
+    # reference implementation, searching the patches of every id
+    y_pred, present = [], []
+    for id in ids:
+        patches = pred_array[np.where(id_array == id)]
+        if not len(patches):
+            continue
+        pooled = pooling(patches, axis=0)
+        if np.isfinite(pooled).all():
+            y_pred.append(pooled)
+            present.append(id)
+    return y_pred, present
+
+
+def test_average_predictions():
+    rng = np.random.RandomState(0)
+    ids = ['track_{}'.format(i) for i in range(50)]
+    id_array = np.array([ids[i] for i in rng.randint(45, size=400)])  # the last ids have no patches
+    pred_array = rng.rand(400, 4).astype('float32')
+    pred_array[id_array == 'track_3', 1] = np.nan
+    pred_array[id_array == 'track_7', 0] = np.inf
+    id2gt = {id: [0, 1, 0, 0] for id in ids[1:]}  # an id without ground truth
+
+    for pooling, reference in [('mean', np.mean), ('median', np.median), ('max', np.max)]:
+        expected, present = average_predictions_loop(pred_array, id_array, ids, reference)
+        y_pred, ids_present = shared.average_predictions_ids(pred_array, id_array, ids, pooling=pooling)
+        assert ids_present == present
+        np.testing.assert_allclose(y_pred, expected, rtol=1e-6)
+
+        y_true, y_pred, healthy_ids = shared.average_predictions(pred_array, id_array, ids, id2gt, pooling=pooling)
+        assert healthy_ids == present[1:]
+        assert y_true == [id2gt[id] for id in healthy_ids]
+        np.testing.assert_allclose(y_pred, expected[1:], rtol=1e-6)
+
+
+def test_make_experiment_folder(tmp_path):
+    experiments_dir = tmp_path / 'experiments'
+    folders = [shared.make_experiment_folder(experiments_dir, '1563524626spec') for _ in range(3)]
+    assert [f.name for f in folders] == ['1563524626spec', '1563524626spec_1', '1563524626spec_2']
+    assert all(f.is_dir() for f in folders)
+
+    # the first free suffix
+    folders[1].rmdir()
+    assert shared.make_experiment_folder(experiments_dir, '1563524626spec').name == '1563524626spec_1'
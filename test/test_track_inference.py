@@ -0,0 +1,49 @@
+import numpy as np
+import tensorflow.compat.v1 as tf
+
+import ensemble
+import track_inference
+import train
+
+
+def test_track_ensemble(tmp_path):
+    config = {'xInput': 40, 'yInput': 16, 'num_classes_dataset': 3, 'model_number': 10, 'load_model': None,
+              'seed': 0, 'is_multilabel_task': True, 'weight_decay': None, 'feature_params': {'n_mels': 16}}
+    graph = tf.Graph()
+    with graph.as_default():
+        train.tf_define_model_and_cost(config)
+        sess = tf.Session()
+        sess.run(tf.global_variables_initializer())
+        tf.train.Saver().save(sess, str(tmp_path) + '/')
+        sess.close()
+
+    hop = 15
+    track = np.random.RandomState(0).rand(137, 16).astype('float32')
+    starts = range(0, len(track) - config['xInput'] + 1, hop)  # as `overlap_sampling`
+    assert track_inference.number_of_windows(len(track), config['xInput'], hop) == len(starts)
+
+    patches = ensemble.Ensemble([config], [tmp_path])
+    expected = patches.predict(np.stack([track[start: start + config['xInput']] for start in starts]))
+    patches.close()
+
+    # one patch per chunk: the same computation as the patch-wise inference, which is used instead
+    assert not track_inference.shares_patches({'whole_track_inference': True, 'inference_chunk_windows': 1})
+    assert track_inference.shares_patches({'whole_track_inference': True})
+    assert track_inference.shares_patches({'whole_track_inference': True, 'inference_chunk_windows': None})
+    assert not track_inference.shares_patches({})
+    models = track_inference.TrackEnsemble([config], [tmp_path], hop, chunk_windows=1, batch_size=4)
+    np.testing.assert_allclose(models.predict(track), expected, rtol=1e-4, atol=1e-6)
+    models.close()
+
+    # larger chunks approximate the patch-wise predictions (the borders of a patch see its
+    # neighbours, in the front-end and in the zero padding of the mid-end): they match the whole
+    # track computation of every chunk, including a shorter last one
+    whole = track_inference.TrackEnsemble([config], [tmp_path], hop, chunk_windows=None)
+    models = track_inference.TrackEnsemble([config], [tmp_path], hop, chunk_windows=4, batch_size=8)
+    pred = models.predict(track)
+    models.close()
+    assert pred.shape == expected.shape
+    for start in range(0, len(starts), 4):
+        chunk = track[starts[start]: starts[min(start + 3, len(starts) - 1)] + config['xInput']]
+        np.testing.assert_allclose(pred[start: start + 4], whole.predict(chunk), rtol=1e-4, atol=1e-6)
+    whole.close()
@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+import tensorflow.compat.v1 as tf
+
+import checkpoint_writer
+import train
+
+
+def test_accumulate_gradients():
+    graph = tf.Graph()
+    with graph.as_default():
+        x = tf.placeholder(tf.float32, [None, 3])
+        weights = tf.Variable(np.ones(3, dtype='float32'))
+        cost = tf.reduce_mean(tf.square(tf.reduce_sum(x * weights, axis=1)))
+        grads_and_vars = [(tf.gradients(cost, weights)[0], weights)]
+
+        averaged, accumulate, accumulators = train.accumulate_gradients(grads_and_vars)
+        sess = tf.Session()
+        sess.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
+
+        # the average over two batches of the same size is the gradient of the whole batch
+        batch = np.random.RandomState(0).randn(8, 3).astype('float32')
+        sess.run(accumulate, feed_dict={x: batch[:4]})
+        sess.run(accumulate, feed_dict={x: batch[4:]})
+        np.testing.assert_allclose(sess.run(averaged[0][0]),
+                                   sess.run(grads_and_vars[0][0], feed_dict={x: batch}), rtol=1e-5)
+
+    # the accumulators are not stored in the checkpoints
+    assert not set(accumulators) & set(graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES))
+
+
+def test_input_pipeline():
+    graph = tf.Graph()
+    with graph.as_default():
+        pipeline = train.InputPipeline([2, 3], 4, size=2)
+        x, y_ = pipeline.batch
+        cost = tf.reduce_mean(x) + tf.reduce_mean(y_)
+        update, variables, reset = train.streaming_cost(cost, 'cost')
+        sess = tf.Session()
+        sess.run(tf.local_variables_initializer())
+
+        batches = [{'X': np.full((n, 2, 3), n, dtype='float16'), 'Y': np.zeros((n, 4))} for n in [1, 2, 3]]
+        for _ in range(2):
+            # every pass reads all the batches, and its mean cost is kept in the metric variables
+            sess.run(reset)
+            pipeline.start(sess, batches)
+            for batch in batches:
+                sess.run(update)
+                # the batch of the step, whatever the batches read ahead
+                read, data_wait, queue_depth = pipeline.next_read()
+                assert read is batch and data_wait >= 0 and queue_depth >= 0
+            with pytest.raises(tf.errors.OutOfRangeError):
+                sess.run(update)
+            assert sess.run(variables) == [6, 3]
+            assert pipeline.patches == 6
+
+
+def test_load_resume_state(tmp_path):
+    resume_folder = tmp_path / 'resume'
+    graph = tf.Graph()
+    with graph.as_default():
+        weights = tf.Variable(np.zeros(3, dtype='float32'), name='weights')
+        sess = tf.Session()
+        sess.run(tf.global_variables_initializer())
+
+        # the state stored by `train.py` after two epochs, the second one replacing the first
+        writer = checkpoint_writer.CheckpointWriter(tf.global_variables())
+        np.random.seed(0)
+        for epoch in [1, 2]:
+            weights.load(np.full(3, epoch, dtype='float32'), sess)
+            state = {'epoch': epoch, 'global_step': 40 * epoch, 'k_patience': epoch - 1,
+                     'cost_best_model': 0.5 / epoch, 'learning_rate': 0.001 / epoch,
+                     'numpy_random_state': [v.tolist() if isinstance(v, np.ndarray) else v
+                                            for v in np.random.get_state()]}
+            writer.submit(writer.snapshot(sess), [
+                lambda save, state=state: checkpoint_writer.write_resume_state(save, resume_folder, state)])
+        writer.close()
+        sess.close()
+    expected_random = np.random.rand(5)
+
+    graph = tf.Graph()
+    with graph.as_default():
+        weights = tf.Variable(np.zeros(3, dtype='float32'), name='weights')
+        sess = tf.Session()
+        np.random.seed(1)
+        state = train.load_resume_state(sess, tf.train.Saver(), resume_folder)
+        np.testing.assert_array_equal(sess.run(weights), [2, 2, 2])
+        sess.close()
+
+    assert (state['epoch'], state['global_step'], state['k_patience']) == (2, 80, 1)
+    assert state['cost_best_model'] == 0.25
+    assert state['learning_rate'] == 0.0005
+    np.testing.assert_array_equal(np.random.rand(5), expected_random)  # the same training patches
+    assert sorted(f.name for f in resume_folder.glob('model-*')) == ['model-2.data-00000-of-00001', 'model-2.index']
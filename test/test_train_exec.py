@@ -0,0 +1,95 @@
+import json
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+import train_exec
+
+
+def test_core_sets(monkeypatch):
+    monkeypatch.setattr(os, 'sched_getaffinity', lambda pid: {0, 1, 2, 3, 4, 5, 6, 7})
+    assert train_exec.core_sets(4, 2) == [[0, 1], [2, 3], [4, 5], [6, 7]]
+    # more threads than cores: the sets wrap around
+    assert train_exec.core_sets(3, 4) == [[0, 1, 2, 3], [4, 5, 6, 7], [0, 1, 2, 3]]
+
+
+def test_job_env():
+    env = train_exec.job_env(4)
+    for var in ['TF_NUM_INTRAOP_THREADS', 'OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+        assert env[var] == '4'
+    assert env['TF_NUM_INTEROP_THREADS'] == '2'
+    assert train_exec.job_env(1)['TF_NUM_INTEROP_THREADS'] == '1'
+    assert env['PATH'] == os.environ['PATH']
+
+
+def write_configs(tmp_path, experiments):
+    # one configuration file per fold of every (experiment, number of folds, folds run)
+    config_files = []
+    for name, n_folds, folds in experiments:
+        exp_dir = tmp_path / name
+        exp_dir.mkdir()
+        for fold in folds:
+            (exp_dir / 'experiment_id_{}'.format(fold)).write_text('{}_{}\n'.format(name, fold))
+            config_file = tmp_path / '{}_{}.json'.format(name, fold)
+            config_file.write_text(json.dumps({'exp_dir': str(exp_dir),
+                                               'config_train': {'fold': fold, 'n_folds': n_folds}}))
+            config_files.append(str(config_file))
+    return config_files
+
+
+def test_scheduler(tmp_path, monkeypatch):
+    monkeypatch.setattr(os, 'sched_getaffinity', lambda pid: {0, 1, 2, 3})
+    config_files = write_configs(tmp_path, [('complete', 3, [0, 1, 2]), ('partial', 2, [0]),
+                                            ('failing', 2, [0, 1])])
+    scheduler = train_exec.Scheduler(config_files, 2, 2, tmp_path, train_exec.STAGES)
+
+    stages, busy_cores, lock = [], set(), threading.Lock()
+
+    def run_stage(config_file, stage, command, cores):
+        # the concurrent jobs run on disjoint cores
+        with lock:
+            assert not busy_cores & set(cores)
+            busy_cores.update(cores)
+        time.sleep(0.01)
+        with lock:
+            busy_cores.difference_update(cores)
+            stages.append((os.path.basename(config_file), stage, command[1:]))
+        return not (config_file.endswith('failing_1.json') and stage == 'train')
+
+    monkeypatch.setattr(scheduler, 'run_stage', run_stage)
+    scheduler.run()
+
+    for name in ['complete_0', 'complete_1', 'complete_2', 'partial_0', 'failing_0']:
+        assert (name + '.json', 'train', ['train.py', str(tmp_path / (name + '.json'))]) in stages
+        assert (name + '.json', 'evaluate', ['evaluate.py', str(tmp_path / (name + '.json')), '-l', name]) in stages
+    assert ('failing_1.json', 'evaluate') not in [stage[:2] for stage in stages]
+
+    # the complete experiment is scored once, after all its folds
+    scores = [stage for stage in stages if stage[1] == 'score']
+    assert len(scores) == 1 and scores[0][0].startswith('complete_')
+    evaluated = [i for i, stage in enumerate(stages) if stage[0].startswith('complete_') and stage[1] == 'evaluate']
+    assert len(evaluated) == 3 and stages.index(scores[0]) > max(evaluated)
+
+
+def test_scheduler_duplicated_fold(tmp_path):
+    config_files = write_configs(tmp_path, [('experiment', 2, [0, 1])])
+    config = json.loads(open(config_files[1]).read())
+    config['config_train']['fold'] = 0
+    with open(config_files[1], 'w') as f:
+        json.dump(config, f)
+    with pytest.raises(ValueError):
+        train_exec.Scheduler(config_files, 2, 1, tmp_path, train_exec.STAGES)
+
+
+def test_run_stage_cores(tmp_path):
+    # the stages run on the cores of their slot
+    [config_file] = write_configs(tmp_path, [('experiment', 1, [0])])
+    scheduler = train_exec.Scheduler([config_file], 1, 1, tmp_path, train_exec.STAGES)
+    cores = sorted(os.sched_getaffinity(0))[:1]
+    command = [sys.executable, '-c', 'import os; print(sorted(os.sched_getaffinity(0)))']
+    assert scheduler.run_stage(config_file, 'train', command, cores)
+    [(_, _, _, _, log_file)] = scheduler.results
+    assert log_file.read_text().strip() == str(cores)
@@ -0,0 +1,38 @@
+import shared
+import train_folds
+
+
+def test_fold_config():
+    config = {'exp_dir': '/exp', 'config_train': {'fold': 0, 'gt_train': '/data/gt/gt_train_0.csv',
+                                                   'gt_val': '/data/gt/gt_val_0.csv',
+                                                   'gt_test': 'gt/gt_test_0.csv', 'n_folds': 3}}
+    fold_config = train_folds.fold_config(config, 2)
+    assert fold_config['config_train'] == {'fold': 2, 'gt_train': '/data/gt/gt_train_2.csv',
+                                           'gt_val': '/data/gt/gt_val_2.csv', 'gt_test': 'gt/gt_test_2.csv',
+                                           'n_folds': 3}
+    assert fold_config['exp_dir'] == '/exp'
+    # the configuration of the other folds is not modified
+    assert config['config_train']['fold'] == 0 and config['config_train']['gt_val'] == '/data/gt/gt_val_0.csv'
+
+
+def test_absolute_paths(tmp_path, monkeypatch):
+    monkeypatch.setattr(shared, '_preloaded', dict())
+    monkeypatch.chdir(tmp_path)
+    config = {'exp_dir': 'exp', 'data_dir': '/data', 'config_train': {
+        'gt_train': 'gt/gt_train_0.csv', 'gt_val': '/gt/gt_val_0.csv', 'gt_test': 'gt/gt_test_0.csv',
+        'audio_representation_dirs': ['features', '/features'], 'load_model': 'models/'}}
+    config = train_folds.absolute_paths(config)
+    assert config['exp_dir'] == str(tmp_path / 'exp') and config['data_dir'] == '/data'
+    assert config['config_train'] == {
+        'gt_train': str(tmp_path / 'gt' / 'gt_train_0.csv'), 'gt_val': '/gt/gt_val_0.csv',
+        'gt_test': str(tmp_path / 'gt' / 'gt_test_0.csv'),
+        'audio_representation_dirs': [str(tmp_path / 'features'), '/features'], 'load_model': 'models/'}
+
+    # the folds find the preloaded ground truth, from any folder
+    fold_config = train_folds.fold_config(config, 1)
+    (tmp_path / 'gt').mkdir()
+    (tmp_path / 'gt' / 'gt_train_1.csv').write_text('a\t[1, 0]\n')
+    shared.preload(shared.load_id2gt, fold_config['config_train']['gt_train'])
+    (tmp_path / 'gt' / 'gt_train_1.csv').unlink()
+    monkeypatch.chdir(train_folds.SRC_DIR)
+    assert shared.load_id2gt(fold_config['config_train']['gt_train']) == (['a'], {'a': [1, 0]})
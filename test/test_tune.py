@@ -0,0 +1,45 @@
+import json
+
+import pytest
+
+import tune
+
+
+def test_recommend():
+    results = {16: {'patches_per_s': 100., 'peak_rss_mb': 500},
+               32: {'patches_per_s': 198., 'peak_rss_mb': 600},
+               64: {'patches_per_s': 200., 'peak_rss_mb': 800},
+               128: None}
+
+    # the smallest batch size close to the best throughput
+    assert tune.recommend(results, tolerance=0.05) == 32
+    assert tune.recommend(results, tolerance=0.) == 64
+    # settings above the memory limit are not considered
+    assert tune.recommend(results, tolerance=0., max_memory=700) == 32
+    assert tune.recommend(results, tolerance=0., max_memory=100) is None
+
+
+def test_probe_and_write(tmp_path):
+    full_config = {'exp_dir': 'exp', 'config_train': {
+        'feature_params': {'xInput': 32, 'yInput': 16, 'n_mels': 16}, 'num_classes_dataset': 3, 'model_number': 10,
+        'load_model': None, 'seed': 0, 'is_multilabel_task': True, 'weight_decay': None, 'optimizer': 'Adam',
+        'learning_rate': 0.001, 'batch_size': 32}}
+    config = tune.patch_config(dict(full_config['config_train']))
+
+    # every probe runs in a spawned process
+    training, inference = [tune.run_probe(config, 4, training) for training in [True, False]]
+    for result in [training, inference]:
+        assert result['patches_per_s'] > 0 and result['peak_rss_mb'] > 0 and result['input_dims'] == 16
+        assert result['patches_per_s'] == pytest.approx(4 * result['steps_per_s'])
+
+    # the recommendations are written to a copy of the configuration
+    config_file = tmp_path / 'config_0.json'
+    config_file.write_text(json.dumps(full_config))
+    output = tune.tuned_config_file(config_file)
+    assert output == tmp_path / 'config_0_tuned.json'
+    tune.write_config(full_config, {'batch_size': 4, 'val_batch_size': 8}, output)
+    assert json.loads(config_file.read_text()) == full_config
+    tuned = json.loads(output.read_text())
+    assert tuned['exp_dir'] == 'exp' and tuned['config_train']['feature_params'] == {'xInput': 32, 'yInput': 16,
+                                                                                     'n_mels': 16}
+    assert tuned['config_train']['batch_size'] == 4 and tuned['config_train']['val_batch_size'] == 8